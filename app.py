@@ -1,2021 +1,6265 @@
-# app.py (полная версия с исправлениями: исчезающие подарки, удаление сообщений и все функции)
-from flask import Flask, render_template, request, jsonify
-from datetime import datetime
-import sqlite3
-import hashlib
-import uuid
-import json
-
-app = Flask(__name__)
-DB_NAME = 'vault_messenger.db'
-
-# --- 1. ФУНКЦИИ БАЗЫ ДАННЫХ (SQLite) ---
-
-def get_db_connection():
-    """Создает и возвращает подключение к базе данных."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    """Инициализирует базу данных, создавая все необходимые таблицы."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Таблица USERS (пользователи)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            displayName TEXT NOT NULL,
-            bio TEXT,
-            avatarBase64 TEXT,
-            emailHash TEXT,
-            role TEXT DEFAULT 'user',
-            is_banned INTEGER DEFAULT 0,
-            coins INTEGER DEFAULT 15
-        )
-    """)
-    
-    # Таблица MESSAGES (сообщения)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            uuid TEXT PRIMARY KEY,
-            chat_id TEXT NOT NULL,
-            sender_id TEXT NOT NULL,
-            text TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            gift_id TEXT DEFAULT NULL
-        )
-    """)
-
-    # Таблица CHAT_PARTNERS
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_partners (
-            user_id TEXT NOT NULL,
-            partner_id TEXT NOT NULL,
-            chat_id TEXT NOT NULL,
-            PRIMARY KEY (user_id, partner_id)
-        )
-    """)
-    
-    # Таблица GIFTS
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS gifts (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            price INTEGER NOT NULL,
-            image_url TEXT NOT NULL,
-            is_rare BOOLEAN DEFAULT FALSE,
-            created_by TEXT DEFAULT 'system',
-            quantity INTEGER DEFAULT -1,
-            is_active BOOLEAN DEFAULT TRUE,
-            upgradeable BOOLEAN DEFAULT FALSE
-        )
-    """)
-    
-    # Таблица INVENTORY
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_inventory (
-            user_id TEXT NOT NULL,
-            gift_id TEXT NOT NULL,
-            quantity INTEGER DEFAULT 1,
-            displayed_in_profile BOOLEAN DEFAULT FALSE,
-            PRIMARY KEY (user_id, gift_id),
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (gift_id) REFERENCES gifts(id)
-        )
-    """)
-    
-    conn.commit()
-
-    # Таблица NFT подарков (уникальные токены)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS nft_items (
-            token_id TEXT PRIMARY KEY,
-            base_gift_id TEXT NOT NULL,
-            owner_id TEXT NOT NULL,
-            creator_admin_id TEXT NOT NULL,
-            original_sender_id TEXT NOT NULL,
-            serial_number INTEGER NOT NULL,
-            bg_variant INTEGER NOT NULL,
-            price INTEGER NOT NULL,
-            is_listed INTEGER DEFAULT 0,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (base_gift_id) REFERENCES gifts(id),
-            FOREIGN KEY (owner_id) REFERENCES users(id)
-        )
-    """)
-
-    # Таблицы для групп и каналов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS rooms (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            type TEXT NOT NULL, -- 'group' или 'channel'
-            owner_id TEXT NOT NULL,
-            avatarBase64 TEXT,
-            about TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS room_members (
-            room_id TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            role TEXT NOT NULL DEFAULT 'member', -- owner/admin/member
-            PRIMARY KEY (room_id, user_id),
-            FOREIGN KEY (room_id) REFERENCES rooms(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-
-    # --- Проверка и добавление недостающих колонок (миграции) ---
-    try:
-        cursor.execute("SELECT coins FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку coins в таблицу users...")
-        cursor.execute("ALTER TABLE users ADD COLUMN coins INTEGER DEFAULT 15")
-    
-    try:
-        cursor.execute("SELECT gift_id FROM messages LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку gift_id в таблицу messages...")
-        cursor.execute("ALTER TABLE messages ADD COLUMN gift_id TEXT DEFAULT NULL")
-    
-    try:
-        cursor.execute("SELECT is_rare FROM gifts LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем новые колонки в таблицу gifts...")
-        cursor.execute("ALTER TABLE gifts ADD COLUMN is_rare BOOLEAN DEFAULT FALSE")
-        cursor.execute("ALTER TABLE gifts ADD COLUMN created_by TEXT DEFAULT 'system'")
-        cursor.execute("ALTER TABLE gifts ADD COLUMN quantity INTEGER DEFAULT -1")
-        cursor.execute("ALTER TABLE gifts ADD COLUMN is_active BOOLEAN DEFAULT TRUE")
-
-    # Новое поле в gifts: upgradeable (можно ли юзерам апгрейдить этот подарок в NFT)
-    try:
-        cursor.execute("SELECT upgradeable FROM gifts LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку upgradeable в таблицу gifts...")
-        cursor.execute("ALTER TABLE gifts ADD COLUMN upgradeable BOOLEAN DEFAULT FALSE")
-
-    # last_seen для статусов онлайн
-    try:
-        cursor.execute("SELECT last_seen FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку last_seen в таблицу users...")
-        cursor.execute("ALTER TABLE users ADD COLUMN last_seen TEXT")
-
-    # is_read для сообщений
-    try:
-        cursor.execute("SELECT is_read FROM messages LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку is_read в таблицу messages...")
-        cursor.execute("ALTER TABLE messages ADD COLUMN is_read INTEGER DEFAULT 0")
-
-    # displayed_in_profile для NFT
-    try:
-        cursor.execute("SELECT displayed_in_profile FROM nft_items LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку displayed_in_profile в таблицу nft_items...")
-        cursor.execute("ALTER TABLE nft_items ADD COLUMN displayed_in_profile INTEGER DEFAULT 0")
-
-    # новые поля в rooms: avatarBase64 и about
-    try:
-        cursor.execute("SELECT avatarBase64 FROM rooms LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку avatarBase64 в таблицу rooms...")
-        cursor.execute("ALTER TABLE rooms ADD COLUMN avatarBase64 TEXT")
-    try:
-        cursor.execute("SELECT about FROM rooms LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Добавляем колонку about в таблицу rooms...")
-        cursor.execute("ALTER TABLE rooms ADD COLUMN about TEXT")
-    
-    conn.commit()
-    
-    # --- Добавление начальных пользователей ---
-    cursor.execute("SELECT COUNT(*) FROM users")
-    if cursor.fetchone()[0] == 0:
-        print("Добавляем начальных пользователей...")
-        initial_users = [
-            ("admin", "pass", "Администратор Vault", "Создатель системы", "", 'admin'), 
-            ("bob", "pass", "Боб Тестер", "Тестировщик приложения", "", 'user'),
-            ("user_me", "pass", "Мой Профиль", "Тестовый пользователь", "", 'user'),
-        ]
-        
-        for user_id, password, display_name, bio, avatar, role in initial_users:
-            email_hash = hashlib.md5(f"{user_id}@example.com".encode('utf-8')).hexdigest()
-            cursor.execute("""
-                INSERT INTO users (id, password, displayName, bio, avatarBase64, emailHash, role, coins)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (user_id, password, display_name, bio, avatar, email_hash, role, 15))
-    else:
-        # Обновляем существующих пользователей
-        cursor.execute("UPDATE users SET coins = 15 WHERE coins IS NULL")
-        cursor.execute("UPDATE users SET role = 'admin' WHERE id = 'admin' AND role != 'admin'")
-        
-    # --- Добавление начальных подарков ---
-    cursor.execute("SELECT COUNT(*) FROM gifts")
-    if cursor.fetchone()[0] == 0:
-        print("Добавляем начальные подарки...")
-        initial_gifts = [
-            ("gift1", "❤️ Сердце", 5, "❤️", False, "system", -1, True, False),
-            ("gift2", "⭐ Звезда", 10, "⭐", False, "system", -1, True, False),
-            ("gift3", "🎁 Подарок", 15, "🎁", False, "system", -1, True, False),
-            ("gift4", "🏆 Кубок", 20, "🏆", True, "system", -1, True, True),
-            ("gift5", "👑 Корона", 25, "👑", True, "system", -1, True, True),
-            ("gift6", "🚀 Ракета", 30, "🚀", True, "system", -1, True, True),
-            # Базовый подарок от админа, который можно апгрейдить в NFT
-            ("admin_gift", "🎖 Подарок от Админа", 0, "🎖", True, "admin", -1, True, True),
-        ]
-        
-        for gift_id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable in initial_gifts:
-            cursor.execute("""
-                INSERT OR REPLACE INTO gifts (id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (gift_id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable))
-        
-    conn.commit()
-    conn.close()
-    print("База данных инициализирована успешно!")
-
-# Вызываем инициализацию базы данных при запуске приложения
-init_db()
-
-# --- 2. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-
-def get_chat_id(user_a, user_b):
-    """Генерирует уникальный ID чата путем сортировки ID пользователей."""
-    return hashlib.md5(json.dumps(sorted([user_a, user_b])).encode('utf-8')).hexdigest()
-
-# --- 3. МАРШРУТЫ АУТЕНТИФИКАЦИИ И ПРОФИЛЯ ---
-
-@app.route('/')
-def index():
-    """Главная страница, загружает HTML-клиент."""
-    return render_template('index.html')
-
-@app.route('/api/register', methods=['POST'])
-def register():
-    """API для регистрации нового пользователя."""
-    try:
-        data = request.json
-        username = data.get('username')
-        password = data.get('password')
-        displayName = data.get('displayName')
-
-        if not username or not password or not displayName:
-            return jsonify({"status": "error", "message": "Заполните все поля"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE id = ?", (username,))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({"status": "error", "message": "Пользователь с таким ID уже есть"}), 409
-
-        email_hash = hashlib.md5(username.encode('utf-8')).hexdigest() 
-        
-        cursor.execute("""
-            INSERT INTO users (id, password, displayName, bio, avatarBase64, emailHash, role, is_banned, coins)
-            VALUES (?, ?, ?, ?, ?, ?, 'user', 0, 15)
-        """, (username, password, displayName, "", "", email_hash))
-        
-        conn.commit()
-        conn.close()
-        return jsonify({"status": "success", "message": "Регистрация успешна", "user_id": username})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка регистрации: {e}"}), 500
-
-@app.route('/api/login', methods=['POST'])
-def login():
-    """API для входа пользователя."""
-    try:
-        data = request.json
-        username = data.get('username')
-        password = data.get('password')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ? AND password = ?", (username, password))
-        user_row = cursor.fetchone()
-        
-        if user_row:
-            user = dict(user_row)
-            
-            # ПРОВЕРКА НА БАН
-            if user.get('is_banned') == 1:
-                conn.close()
-                return jsonify({"status": "error", "message": "Аккаунт заблокирован администратором"}), 403
-            
-            # обновляем last_seen
-            now_str = datetime.now().isoformat(timespec='seconds')
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET last_seen = ? WHERE id = ?", (now_str, username))
-            conn.commit()
-            conn.close()
-                
-            return jsonify({"status": "success", "user": {
-                "id": user["id"], 
-                "displayName": user["displayName"], 
-                "avatarBase64": user.get("avatarBase64", ""), 
-                "emailHash": user.get("emailHash", ""),
-                "role": user.get("role", "user"),
-                "coins": user.get("coins", 15)
-            }})
-        else:
-            return jsonify({"status": "error", "message": "Неверный ID или пароль"}), 401
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка входа: {e}"}), 500
-
-@app.route('/api/profile/<user_id>', methods=['GET', 'POST'])
-def profile(user_id):
-    """API для просмотра и редактирования профиля."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            conn.close()
-            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
-
-        user = dict(user_row)
-
-        if request.method == 'POST':
-            data = request.json
-            
-            display_name = data.get("displayName", user["displayName"])
-            bio = data.get("bio", user["bio"])
-            avatar_data = data.get("avatarBase64")
-            
-            update_query = "UPDATE users SET displayName = ?, bio = ?"
-            update_params = [display_name, bio]
-            
-            if avatar_data is not None:
-                update_query += ", avatarBase64 = ?"
-                update_params.append(avatar_data)
-            
-            update_query += " WHERE id = ?"
-            update_params.append(user_id)
-            
-            cursor.execute(update_query, tuple(update_params))
-            conn.commit()
-            
-            # Получаем обновленные данные
-            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            updated_user = dict(cursor.fetchone())
-            
-            conn.close()
-            return jsonify({"status": "success", "profile": updated_user})
-        
-        # GET-запрос: возвращаем текущий профиль
-        conn.close()
-        return jsonify({"status": "success", "profile": user})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка работы с профилем: {e}"}), 500
-
-# --- 4. МАРШРУТЫ ДЛЯ ВАЛЮТЫ И ПОДАРКОВ ---
-
-@app.route('/api/gifts', methods=['GET'])
-def get_gifts():
-    """API для получения списка доступных подарков."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # Добавлено условие AND quantity != 0, чтобы скрывать закончившиеся товары
-        cursor.execute("SELECT * FROM gifts WHERE is_active = TRUE AND quantity != 0 ORDER BY price")
-        gifts = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "gifts": gifts})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки подарков: {e}"}), 500
-
-
-@app.route('/api/admin/my_gifts', methods=['POST'])
-def admin_my_gifts():
-    """Список подарков, созданных конкретным администратором."""
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-
-        if not admin_id:
-            return jsonify({"status": "error", "message": "Не указан администратор"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Проверяем, что это администратор
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        row = cursor.fetchone()
-        if not row or row['role'] != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Нет прав"}), 403
-
-        cursor.execute("""
-            SELECT * FROM gifts
-            WHERE created_by = ?
-            ORDER BY created_by DESC, price ASC
-        """, (admin_id,))
-        gifts = [dict(r) for r in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "gifts": gifts})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки подарков администратора: {e}"}), 500
-
-@app.route('/api/inventory/<user_id>', methods=['GET'])
-def get_inventory(user_id):
-    """API для получения инвентаря пользователя."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT ui.*, g.name, g.image_url, g.is_rare, g.price, g.upgradeable 
-            FROM user_inventory ui 
-            JOIN gifts g ON ui.gift_id = g.id 
-            WHERE ui.user_id = ? AND ui.quantity > 0
-        """, (user_id,))
-        
-        inventory = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "inventory": inventory})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки инвентаря: {e}"}), 500
-
-@app.route('/api/sell_gift', methods=['POST'])
-def sell_gift():
-    """API для продажи подарка из инвентаря."""
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        gift_id = data.get('gift_id')
-        quantity = data.get('quantity', 1)
-        
-        if not user_id or not gift_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем наличие подарка в инвентаре
-        cursor.execute("SELECT quantity FROM user_inventory WHERE user_id = ? AND gift_id = ?", (user_id, gift_id))
-        inventory_item = cursor.fetchone()
-        
-        if not inventory_item or inventory_item['quantity'] < quantity:
-            conn.close()
-            return jsonify({"status": "error", "message": "Недостаточно подарков для продажи"}), 400
-        
-        # Получаем информацию о подарке
-        cursor.execute("SELECT price, is_rare FROM gifts WHERE id = ?", (gift_id,))
-        gift = cursor.fetchone()
-        if not gift:
-            conn.close()
-            return jsonify({"status": "error", "message": "Подарок не найден"}), 404
-        
-        gift_price = gift['price']
-        # Редкие подарки продаются дороже (80% от стоимости)
-        sell_price = int(gift_price * 0.8) if gift['is_rare'] else int(gift_price * 0.5)
-        total_sell_price = sell_price * quantity
-        
-        # Уменьшаем количество в инвентаре
-        cursor.execute("""
-            UPDATE user_inventory 
-            SET quantity = quantity - ? 
-            WHERE user_id = ? AND gift_id = ?
-        """, (quantity, user_id, gift_id))
-        
-        # Удаляем запись если количество стало 0
-        cursor.execute("DELETE FROM user_inventory WHERE user_id = ? AND gift_id = ? AND quantity <= 0", (user_id, gift_id))
-        
-        # Начисляем монеты
-        cursor.execute("UPDATE users SET coins = coins + ? WHERE id = ?", (total_sell_price, user_id))
-        
-        conn.commit()
-        
-        # Получаем новый баланс
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (user_id,))
-        new_balance = cursor.fetchone()[0]
-        
-        conn.close()
-        return jsonify({
-            "status": "success", 
-            "message": f"Подарки проданы за {total_sell_price} монет",
-            "new_balance": new_balance,
-            "sold_quantity": quantity
-        })
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка продажи: {e}"}), 500
-
-@app.route('/api/toggle_profile_display', methods=['POST'])
-def toggle_profile_display():
-    """API для добавления/удаления подарка из профиля."""
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        gift_id = data.get('gift_id')
-        
-        if not user_id or not gift_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем наличие подарка в инвентаре
-        cursor.execute("SELECT displayed_in_profile FROM user_inventory WHERE user_id = ? AND gift_id = ?", (user_id, gift_id))
-        inventory_item = cursor.fetchone()
-        
-        if not inventory_item:
-            conn.close()
-            return jsonify({"status": "error", "message": "Подарок не найден в инвентаре"}), 404
-        
-        new_display_state = not inventory_item['displayed_in_profile']
-        
-        cursor.execute("""
-            UPDATE user_inventory 
-            SET displayed_in_profile = ? 
-            WHERE user_id = ? AND gift_id = ?
-        """, (new_display_state, user_id, gift_id))
-        
-        conn.commit()
-        conn.close()
-        
-        action = "добавлен в" if new_display_state else "удален из"
-        return jsonify({
-            "status": "success", 
-            "message": f"Подарок {action} профиля",
-            "displayed_in_profile": new_display_state
-        })
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
-
-
-@app.route('/api/toggle_nft_profile_display', methods=['POST'])
-def toggle_nft_profile_display():
-    """Добавление/удаление NFT подарка из профиля пользователя."""
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        token_id = data.get('token_id')
-
-        if not user_id or not token_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT owner_id, displayed_in_profile FROM nft_items WHERE token_id = ?", (token_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"status": "error", "message": "NFT не найден"}), 404
-        if row["owner_id"] != user_id:
-            conn.close()
-            return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
-
-        new_state = 0 if row["displayed_in_profile"] else 1
-        cursor.execute("UPDATE nft_items SET displayed_in_profile = ? WHERE token_id = ?", (new_state, token_id))
-        conn.commit()
-        conn.close()
-
-        return jsonify({
-            "status": "success",
-            "message": "NFT " + ("добавлен в профиль" if new_state else "убран из профиля"),
-            "displayed_in_profile": bool(new_state)
-        })
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
-
-@app.route('/api/send_gift', methods=['POST'])
-def send_gift():
-    """API для отправки подарка пользователю."""
-    try:
-        data = request.json
-        sender_id = data.get('sender_id')
-        receiver_id = data.get('receiver_id')
-        gift_id = data.get('gift_id')
-        
-        if not sender_id or not receiver_id or not gift_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Получаем информацию о подарке
-        cursor.execute("SELECT * FROM gifts WHERE id = ? AND is_active = TRUE", (gift_id,))
-        gift = cursor.fetchone()
-        if not gift:
-            conn.close()
-            return jsonify({"status": "error", "message": "Подарок не найден"}), 404
-        
-        gift = dict(gift)
-        gift_price = gift['price']
-        
-        # Проверяем, есть ли подарок в наличии (если не -1)
-        if gift['quantity'] == 0:
-            conn.close()
-            return jsonify({"status": "error", "message": "Этот подарок закончился и исчез из продажи"}), 400
-            
-        # Если количество > 0, значит это лимитированный товар
-        is_limited = gift['quantity'] > 0
-        
-        # Проверяем баланс отправителя
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (sender_id,))
-        sender_row = cursor.fetchone()
-        if not sender_row:
-            conn.close()
-            return jsonify({"status": "error", "message": "Отправитель не найден"}), 404
-            
-        sender_coins = sender_row[0] or 0
-        
-        if sender_coins < gift_price:
-            conn.close()
-            return jsonify({"status": "error", "message": "Недостаточно монет"}), 400
-        
-        chat_id = get_chat_id(sender_id, receiver_id)
-        
-        message_uuid = str(uuid.uuid4())
-        # В тексте оставляем только имя подарка, без base64/URL картинки
-        message_text = f"Подарок: {gift['name']}"
-        timestamp = datetime.now().strftime("%H:%M")
-        
-        # Добавляем сообщение в чат
-        cursor.execute("""
-            INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, gift_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (message_uuid, chat_id, sender_id, message_text, timestamp, gift_id))
-        
-        # Создаем связь чата
-        cursor.execute("""
-            INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-            VALUES (?, ?, ?)
-        """, (sender_id, receiver_id, chat_id))
-        cursor.execute("""
-            INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-            VALUES (?, ?, ?)
-        """, (receiver_id, sender_id, chat_id))
-        
-        # Списание монет у отправителя
-        cursor.execute("UPDATE users SET coins = coins - ? WHERE id = ?", (gift_price, sender_id))
-        
-        # Добавляем подарок в инвентарь получателя
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_inventory (user_id, gift_id, quantity)
-            VALUES (?, ?, COALESCE((SELECT quantity FROM user_inventory WHERE user_id = ? AND gift_id = ?), 0) + 1)
-        """, (receiver_id, gift_id, receiver_id, gift_id))
-        
-        # Уменьшаем количество в магазине (Если это лимитированный подарок)
-        if is_limited:
-            cursor.execute("UPDATE gifts SET quantity = quantity - 1 WHERE id = ?", (gift_id,))
-        
-        conn.commit()
-        
-        # Получаем новый баланс отправителя
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (sender_id,))
-        new_balance = cursor.fetchone()[0]
-        
-        message_data = {
-            "uuid": message_uuid,
-            "sender_id": sender_id,
-            "text": message_text,
-            "timestamp": timestamp,
-            "gift_id": gift_id
-        }
-        
-        conn.close()
-        return jsonify({
-            "status": "success", 
-            "message": message_data,
-            "new_balance": new_balance
-        })
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка отправки подарка: {e}"}), 500
-
-@app.route('/api/admin/create_gift', methods=['POST'])
-def admin_create_gift():
-    """API для создания нового подарка администратором."""
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-        name = data.get('name')
-        price = data.get('price')
-        image_url = data.get('image_url')
-        is_rare = data.get('is_rare', False)
-        quantity = data.get('quantity', -1)
-        upgradeable = data.get('upgradeable', False)
-        
-        if not admin_id or not name or not price or not image_url:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем права администратора
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        admin_row = cursor.fetchone()
-        if not admin_row or admin_row['role'] != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
-        
-        # Создаем уникальный ID для подарка
-        gift_id = f"gift_{int(datetime.now().timestamp())}"
-        
-        cursor.execute("""
-            INSERT INTO gifts (id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable)
-            VALUES (?, ?, ?, ?, ?, ?, ?, TRUE, ?)
-        """, (gift_id, name, price, image_url, is_rare, admin_id, quantity, upgradeable))
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            "status": "success", 
-            "message": "Подарок успешно создан",
-            "gift_id": gift_id
-        })
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка создания подарка: {e}"}), 500
-
-@app.route('/api/admin/delete_gift', methods=['POST'])
-def admin_delete_gift():
-    """API для удаления подарка (скрытия из магазина)."""
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-        gift_id = data.get('gift_id')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверка прав админа
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        admin = cursor.fetchone()
-        if not admin or admin['role'] != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Нет прав"}), 403
-
-        # Скрываем подарок
-        cursor.execute("UPDATE gifts SET is_active = FALSE WHERE id = ?", (gift_id,))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({"status": "success", "message": "Подарок удален из магазина"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-
-@app.route('/api/admin/toggle_gift_upgradeable', methods=['POST'])
-def admin_toggle_gift_upgradeable():
-    """Админ включает/выключает возможность апгрейда подарка в NFT."""
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-        gift_id = data.get('gift_id')
-        enable = data.get('enable')
-
-        if admin_id is None or gift_id is None or enable is None:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        admin = cursor.fetchone()
-        if not admin or admin['role'] != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Нет прав"}), 403
-
-        cursor.execute("UPDATE gifts SET upgradeable = ? WHERE id = ?", (1 if enable else 0, gift_id))
-        conn.commit()
-        conn.close()
-
-        return jsonify({"status": "success", "message": "Настройка апгрейда обновлена", "upgradeable": bool(enable)})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
-
-@app.route('/api/user/<user_id>', methods=['GET'])
-def get_user(user_id):
-    """API для получения информации о пользователе с его инвентарем."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Основная информация о пользователе
-        cursor.execute("SELECT id, displayName, bio, avatarBase64, emailHash, coins FROM users WHERE id = ?", (user_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            conn.close()
-            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
-        
-        user = dict(user_row)
-        
-        # Подарки в профиле пользователя (обычные)
-        cursor.execute("""
-            SELECT g.id, g.name, g.image_url, g.is_rare
-            FROM user_inventory ui
-            JOIN gifts g ON ui.gift_id = g.id
-            WHERE ui.user_id = ? AND ui.displayed_in_profile = TRUE AND ui.quantity > 0
-        """, (user_id,))
-        profile_gifts = [dict(row) for row in cursor.fetchall()]
-        user['profile_gifts'] = profile_gifts
-
-        # NFT подарки, отмеченные для профиля
-        cursor.execute("""
-            SELECT ni.token_id, g.id, g.name, g.image_url, g.is_rare,
-                   ni.serial_number, ni.price, ni.bg_variant
-            FROM nft_items ni
-            JOIN gifts g ON ni.base_gift_id = g.id
-            WHERE ni.owner_id = ? AND ni.displayed_in_profile = 1
-        """, (user_id,))
-        profile_nft = [dict(row) for row in cursor.fetchall()]
-        user['profile_nft_gifts'] = profile_nft
-        
-        conn.close()
-        return jsonify({"status": "success", "user": user})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки пользователя: {e}"}), 500
-
-# --- 5. АДМИНИСТРАТИВНЫЕ МАРШРУТЫ ---
-
-@app.route('/api/admin/users', methods=['POST'])
-def admin_manage_users():
-    """API для администрирования пользователей."""
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-        action = data.get('action')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверка, является ли пользователь администратором
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        admin_row = cursor.fetchone()
-        if not admin_row or dict(admin_row).get('role') != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
-
-        if action == 'list':
-            # Вернуть список всех пользователей, кроме самого администратора
-            cursor.execute("SELECT id, displayName, role, is_banned, bio, coins FROM users WHERE id != ?", (admin_id,))
-            users_list = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            return jsonify({"status": "success", "users": users_list})
-
-        elif action == 'edit':
-            target_id = data.get('target_id')
-            new_displayName = data.get('displayName')
-            new_password = data.get('password')
-            new_is_banned = data.get('is_banned')
-            new_coins = data.get('coins')
-            
-            if not target_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Не указан целевой пользователь"}), 400
-            
-            update_parts = []
-            update_params = []
-            
-            if new_displayName is not None:
-                update_parts.append("displayName = ?")
-                update_params.append(new_displayName)
-            
-            if new_password is not None and new_password.strip():
-                update_parts.append("password = ?")
-                update_params.append(new_password)
-                
-            if new_is_banned is not None and new_is_banned in [0, 1]:
-                update_parts.append("is_banned = ?")
-                update_params.append(new_is_banned)
-                
-            if new_coins is not None and new_coins >= 0:
-                update_parts.append("coins = ?")
-                update_params.append(new_coins)
-                
-            if not update_parts:
-                conn.close()
-                return jsonify({"status": "success", "message": "Нет данных для обновления"})
-                
-            update_params.append(target_id)
-            
-            query = "UPDATE users SET " + ", ".join(update_parts) + " WHERE id = ?"
-            cursor.execute(query, tuple(update_params))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "message": f"Профиль пользователя {target_id} обновлен."})
-
-        conn.close()
-        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка администрирования: {e}"}), 500
-
-
-# --- 6.1. NFT ПОДАРКИ И МАРКЕТ ---
-
-@app.route('/api/nft/upgrade', methods=['POST'])
-def nft_upgrade_from_inventory():
-    """
-    Юзер сам апгрейдит обычный подарок из инвентаря в NFT.
-    Требует, чтобы подарок был помечен как upgradeable.
-    """
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        gift_id = data.get('gift_id')
-        price = data.get('price')
-
-        if not user_id or not gift_id or not price:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        price = int(price)
-        if price <= 0:
-            return jsonify({"status": "error", "message": "Некорректная цена"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Проверяем подарок и то, что он апгрейдится
-        cursor.execute("SELECT id, upgradeable FROM gifts WHERE id = ?", (gift_id,))
-        gift_row = cursor.fetchone()
-        if not gift_row:
-            conn.close()
-            return jsonify({"status": "error", "message": "Подарок не найден"}), 404
-        if not gift_row["upgradeable"]:
-            conn.close()
-            return jsonify({"status": "error", "message": "Этот подарок нельзя апгрейдить в NFT"}), 400
-
-        # Проверяем наличие в инвентаре
-        cursor.execute("""
-            SELECT quantity FROM user_inventory
-            WHERE user_id = ? AND gift_id = ?
-        """, (user_id, gift_id))
-        inv = cursor.fetchone()
-        if not inv or inv["quantity"] <= 0:
-            conn.close()
-            return jsonify({"status": "error", "message": "У вас нет такого подарка для апгрейда"}), 400
-
-        # Списываем 1 из инвентаря
-        cursor.execute("""
-            UPDATE user_inventory
-            SET quantity = quantity - 1
-            WHERE user_id = ? AND gift_id = ?
-        """, (user_id, gift_id))
-        cursor.execute("""
-            DELETE FROM user_inventory
-            WHERE user_id = ? AND gift_id = ? AND quantity <= 0
-        """, (user_id, gift_id))
-
-        # Определяем порядковый номер и фон
-        cursor.execute("""
-            SELECT COUNT(*) FROM nft_items WHERE base_gift_id = ?
-        """, (gift_id,))
-        serial_number = cursor.fetchone()[0] + 1
-
-        import random
-        bg_variant = random.randint(1, 5)
-        token_id = f"nft_{uuid.uuid4().hex}"
-        created_at = datetime.now().isoformat(timespec='seconds')
-
-        cursor.execute("""
-            INSERT INTO nft_items (
-                token_id, base_gift_id, owner_id, creator_admin_id,
-                original_sender_id, serial_number, bg_variant,
-                price, is_listed, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
-        """, (
-            token_id, gift_id, user_id, user_id,
-            user_id, serial_number, bg_variant,
-            price, created_at
-        ))
-
-        conn.commit()
-
-        cursor.execute("""
-            SELECT ni.*, g.name, g.image_url
-            FROM nft_items ni
-            JOIN gifts g ON ni.base_gift_id = g.id
-            WHERE ni.token_id = ?
-        """, (token_id,))
-        nft_row = dict(cursor.fetchone())
-
-        conn.close()
-        return jsonify({"status": "success", "nft": nft_row})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка апгрейда подарка в NFT: {e}"}), 500
-
-
-@app.route('/api/status/<user_id>', methods=['GET'])
-def user_status(user_id):
-    """Статус онлайн / last_seen пользователя."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT last_seen FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
-        if not row:
-            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
-        last_seen = row["last_seen"]
-        online = False
-        if last_seen:
-            try:
-                dt = datetime.fromisoformat(last_seen)
-                diff = datetime.now() - dt
-                online = diff.total_seconds() <= 60
-            except Exception:
-                online = False
-        return jsonify({"status": "success", "online": online, "last_seen": last_seen})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка статуса: {e}"}), 500
-
-
-@app.route('/api/rooms', methods=['POST'])
-def rooms_api():
-    """
-    Простое API для групп и каналов.
-    actions:
-      - create: {owner_id, name, type}
-      - list: {user_id}
-      - join: {room_id, user_id}
-      - leave: {room_id, user_id}
-    """
-    try:
-        data = request.json
-        action = data.get("action")
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        if action == "create":
-            owner_id = data.get("owner_id")
-            name = data.get("name")
-            # поддерживаем только каналы для публичного поиска
-            room_type = "channel"
-            avatar_base64 = data.get("avatarBase64")
-            about = data.get("about", "")
-            if not owner_id or not name:
-                conn.close()
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-            room_id = f"{room_type}_{uuid.uuid4().hex[:8]}"
-            cursor.execute("""
-                INSERT INTO rooms (id, name, type, owner_id, avatarBase64, about)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (room_id, name, room_type, owner_id, avatar_base64, about))
-            cursor.execute("""
-                INSERT INTO room_members (room_id, user_id, role)
-                VALUES (?, ?, 'owner')
-            """, (room_id, owner_id))
-            
-            # Добавляем канал в chat_partners для создателя
-            channel_chat_id = f"channel_{room_id}"
-            cursor.execute("""
-                INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                VALUES (?, ?, ?)
-            """, (owner_id, room_id, channel_chat_id))
-            
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "room": {"id": room_id, "name": name, "type": room_type}})
-
-        elif action == "list":
-            user_id = data.get("user_id")
-            if not user_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Не указан пользователь"}), 400
-            cursor.execute("""
-                SELECT r.id, r.name, r.type, r.owner_id, r.avatarBase64, r.about, rm.role
-                FROM room_members rm
-                JOIN rooms r ON rm.room_id = r.id
-                WHERE rm.user_id = ?
-            """, (user_id,))
-            rooms = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            return jsonify({"status": "success", "rooms": rooms})
-
-        elif action == "join":
-            room_id = data.get("room_id")
-            user_id = data.get("user_id")
-            if not room_id or not user_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            
-            # Проверяем, что это канал
-            cursor.execute("SELECT type FROM rooms WHERE id = ?", (room_id,))
-            room = cursor.fetchone()
-            if not room:
-                conn.close()
-                return jsonify({"status": "error", "message": "Канал не найден"}), 404
-            if room["type"] != "channel":
-                conn.close()
-                return jsonify({"status": "error", "message": "Это не канал"}), 400
-            
-            cursor.execute("""
-                INSERT OR IGNORE INTO room_members (room_id, user_id, role)
-                VALUES (?, ?, 'member')
-            """, (room_id, user_id))
-            
-            # Добавляем канал в chat_partners для пользователя
-            channel_chat_id = f"channel_{room_id}"
-            cursor.execute("""
-                INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                VALUES (?, ?, ?)
-            """, (user_id, room_id, channel_chat_id))
-            
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success"})
-
-        elif action == "leave":
-            room_id = data.get("room_id")
-            user_id = data.get("user_id")
-            if not room_id or not user_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            cursor.execute("""
-                DELETE FROM room_members WHERE room_id = ? AND user_id = ?
-            """, (room_id, user_id))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success"})
-
-        elif action == "update":
-            room_id = data.get("room_id")
-            owner_id = data.get("owner_id")
-            new_name = data.get("name")
-            new_about = data.get("about")
-            new_avatar = data.get("avatarBase64")
-
-            if not room_id or not owner_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-            cursor.execute("SELECT owner_id FROM rooms WHERE id = ?", (room_id,))
-            room = cursor.fetchone()
-            if not room:
-                conn.close()
-                return jsonify({"status": "error", "message": "Группа не найдена"}), 404
-            if room["owner_id"] != owner_id:
-                conn.close()
-                return jsonify({"status": "error", "message": "Только владелец может изменять группу"}), 403
-
-            fields = []
-            params = []
-            if new_name is not None:
-                fields.append("name = ?")
-                params.append(new_name)
-            if new_about is not None:
-                fields.append("about = ?")
-                params.append(new_about)
-            if new_avatar is not None:
-                fields.append("avatarBase64 = ?")
-                params.append(new_avatar)
-            if fields:
-                params.append(room_id)
-                cursor.execute("UPDATE rooms SET " + ", ".join(fields) + " WHERE id = ?", tuple(params))
-                conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "message": "Группа обновлена"})
-
-        conn.close()
-        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка групп: {e}"}), 500
-
-
-@app.route('/api/room_broadcast', methods=['POST'])
-def room_broadcast():
-    """
-    Отправка одного и того же сообщения всем участникам группы/канала.
-    Использует обычные личные чаты (messages / chat_partners) для каждого участника.
-    """
-    try:
-        data = request.json
-        sender_id = data.get('sender_id')
-        room_id = data.get('room_id')
-        text = data.get('text')
-
-        if not sender_id or not room_id or not text:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Проверяем, что комната существует и что это канал
-        cursor.execute("SELECT id, name, type FROM rooms WHERE id = ?", (room_id,))
-        room = cursor.fetchone()
-        if not room:
-            conn.close()
-            return jsonify({"status": "error", "message": "Группа не найдена"}), 404
-        if room["type"] != "channel":
-            conn.close()
-            return jsonify({"status": "error", "message": "Только каналы поддерживают рассылку"}), 400
-
-        # Получаем всех участников c ролями
-        cursor.execute("""
-            SELECT user_id, role FROM room_members
-            WHERE room_id = ?
-        """, (room_id,))
-        members_rows = cursor.fetchall()
-        members = [row["user_id"] for row in members_rows]
-
-        if sender_id not in members:
-            conn.close()
-            return jsonify({"status": "error", "message": "Вы не состоите в этой группе"}), 403
-
-        # проверяем роль отправителя: только owner или admin канала могут писать
-        sender_role = None
-        for row in members_rows:
-            if row["user_id"] == sender_id:
-                sender_role = row["role"]
-                break
-        if sender_role not in ("owner", "admin"):
-            conn.close()
-            return jsonify({"status": "error", "message": "Только владелец или админ канала может писать в канал"}), 403
-
-        # Для каналов используем специальный chat_id вида "channel_{room_id}"
-        channel_chat_id = f"channel_{room_id}"
-        now_str = datetime.now().strftime("%H:%M")
-        msg_uuid = str(uuid.uuid4())
-        
-        # Сохраняем одно сообщение для канала (все участники видят одно и то же)
-        cursor.execute("""
-            INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, is_read)
-            VALUES (?, ?, ?, ?, ?, 0)
-        """, (msg_uuid, channel_chat_id, sender_id, text, now_str))
-
-        # Обновляем chat_partners для всех участников канала
-        for member_id in members:
-            # Каждый участник видит канал как партнера с ID = room_id
-            cursor.execute("""
-                INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                VALUES (?, ?, ?)
-            """, (member_id, room_id, channel_chat_id))
-
-        conn.commit()
-        conn.close()
-        return jsonify({"status": "success", "message": "Сообщение отправлено в канал"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка рассылки по группе: {e}"}), 500
-
-@app.route('/api/admin/upgrade_to_nft', methods=['POST'])
-def admin_upgrade_to_nft():
-    """
-    Админ создает/апгрейдит NFT-подарок для пользователя.
-    Из инвентаря пользователя списывается 1 обычный подарок (если он есть),
-    и создается уникальный NFT-токен с порядковым номером и ценой.
-    """
-    try:
-        data = request.json
-        admin_id = data.get('admin_id')
-        owner_id = data.get('owner_id')
-        base_gift_id = data.get('gift_id')
-        price = data.get('price')
-
-        if not admin_id or not owner_id or not base_gift_id or not price:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Проверяем права администратора
-        cursor.execute("SELECT role FROM users WHERE id = ?", (admin_id,))
-        admin_row = cursor.fetchone()
-        if not admin_row or admin_row['role'] != 'admin':
-            conn.close()
-            return jsonify({"status": "error", "message": "Нет прав"}), 403
-
-        # Проверяем, что базовый подарок существует
-        cursor.execute("SELECT id FROM gifts WHERE id = ?", (base_gift_id,))
-        base_gift = cursor.fetchone()
-        if not base_gift:
-            conn.close()
-            return jsonify({"status": "error", "message": "Такого подарка не существует"}), 404
-
-        # Пытаемся списать 1 подарок из инвентаря пользователя (если есть)
-        cursor.execute("""
-            SELECT quantity FROM user_inventory
-            WHERE user_id = ? AND gift_id = ?
-        """, (owner_id, base_gift_id))
-        inv = cursor.fetchone()
-        if inv and inv['quantity'] > 0:
-            cursor.execute("""
-                UPDATE user_inventory
-                SET quantity = quantity - 1
-                WHERE user_id = ? AND gift_id = ?
-            """, (owner_id, base_gift_id))
-            cursor.execute("""
-                DELETE FROM user_inventory
-                WHERE user_id = ? AND gift_id = ? AND quantity <= 0
-            """, (owner_id, base_gift_id))
-
-        # Определяем порядковый номер для этого типа подарка
-        cursor.execute("""
-            SELECT COUNT(*) FROM nft_items WHERE base_gift_id = ?
-        """, (base_gift_id,))
-        serial_number = cursor.fetchone()[0] + 1
-
-        # Случайный вариант фона 1..5
-        import random
-        bg_variant = random.randint(1, 5)
-
-        token_id = f"nft_{uuid.uuid4().hex}"
-        created_at = datetime.now().isoformat(timespec='seconds')
-
-        cursor.execute("""
-            INSERT INTO nft_items (
-                token_id, base_gift_id, owner_id, creator_admin_id,
-                original_sender_id, serial_number, bg_variant,
-                price, is_listed, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
-        """, (
-            token_id, base_gift_id, owner_id, admin_id,
-            admin_id, serial_number, bg_variant,
-            int(price), created_at
-        ))
-
-        conn.commit()
-
-        cursor.execute("""
-            SELECT ni.*, g.name, g.image_url
-            FROM nft_items ni
-            JOIN gifts g ON ni.base_gift_id = g.id
-            WHERE ni.token_id = ?
-        """, (token_id,))
-        token_row = dict(cursor.fetchone())
-
-        conn.close()
-        return jsonify({"status": "success", "nft": token_row})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка апгрейда в NFT: {e}"}), 500
-
-
-@app.route('/api/nft/market', methods=['GET'])
-def nft_market_list():
-    """Список NFT, выставленных на продажу на маркете."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT ni.*, g.name, g.image_url
-            FROM nft_items ni
-            JOIN gifts g ON ni.base_gift_id = g.id
-            WHERE ni.is_listed = 1
-            ORDER BY ni.created_at DESC
-        """)
-        items = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "items": items})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки маркета: {e}"}), 500
-
-
-@app.route('/api/nft/my/<user_id>', methods=['GET'])
-def nft_my_items(user_id):
-    """NFT подарки конкретного пользователя."""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT ni.*, g.name, g.image_url
-            FROM nft_items ni
-            JOIN gifts g ON ni.base_gift_id = g.id
-            WHERE ni.owner_id = ?
-            ORDER BY ni.created_at DESC
-        """, (user_id,))
-        items = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "items": items})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка загрузки NFT пользователя: {e}"}), 500
-
-
-@app.route('/api/nft/list', methods=['POST'])
-def nft_list_item():
-    """Выставить или снять NFT с маркета."""
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        token_id = data.get('token_id')
-        price = data.get('price')
-        is_listed = data.get('is_listed', True)
-
-        if not user_id or not token_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT owner_id FROM nft_items WHERE token_id = ?", (token_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"status": "error", "message": "NFT не найден"}), 404
-        if row['owner_id'] != user_id:
-            conn.close()
-            return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
-
-        if is_listed:
-            if not price or int(price) <= 0:
-                conn.close()
-                return jsonify({"status": "error", "message": "Некорректная цена"}), 400
-            cursor.execute("""
-                UPDATE nft_items
-                SET is_listed = 1, price = ?
-                WHERE token_id = ?
-            """, (int(price), token_id))
-        else:
-            cursor.execute("""
-                UPDATE nft_items
-                SET is_listed = 0
-                WHERE token_id = ?
-            """, (token_id,))
-
-        conn.commit()
-        conn.close()
-        return jsonify({"status": "success", "message": "Статус NFT обновлен"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка выставления NFT: {e}"}), 500
-
-
-@app.route('/api/nft/buy', methods=['POST'])
-def nft_buy_item():
-    """Покупка NFT с маркета за монеты."""
-    try:
-        data = request.json
-        buyer_id = data.get('buyer_id')
-        token_id = data.get('token_id')
-
-        if not buyer_id or not token_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM nft_items WHERE token_id = ?", (token_id,))
-        token = cursor.fetchone()
-        if not token:
-            conn.close()
-            return jsonify({"status": "error", "message": "NFT не найден"}), 404
-        token = dict(token)
-
-        if token['is_listed'] != 1:
-            conn.close()
-            return jsonify({"status": "error", "message": "NFT не выставлен на продажу"}), 400
-
-        if token['owner_id'] == buyer_id:
-            conn.close()
-            return jsonify({"status": "error", "message": "Вы уже владелец этого NFT"}), 400
-
-        price = int(token['price'])
-
-        # Проверяем баланс покупателя
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (buyer_id,))
-        buyer = cursor.fetchone()
-        if not buyer:
-            conn.close()
-            return jsonify({"status": "error", "message": "Покупатель не найден"}), 404
-        buyer_coins = buyer['coins'] or 0
-        if buyer_coins < price:
-            conn.close()
-            return jsonify({"status": "error", "message": "Недостаточно монет"}), 400
-
-        # Переводим монеты продавцу
-        seller_id = token['owner_id']
-        cursor.execute("UPDATE users SET coins = coins - ? WHERE id = ?", (price, buyer_id))
-        cursor.execute("UPDATE users SET coins = coins + ? WHERE id = ?", (price, seller_id))
-
-        # Меняем владельца NFT
-        cursor.execute("""
-            UPDATE nft_items
-            SET owner_id = ?, is_listed = 0
-            WHERE token_id = ?
-        """, (buyer_id, token_id))
-
-        conn.commit()
-
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (buyer_id,))
-        new_balance = cursor.fetchone()[0]
-
-        conn.close()
-        return jsonify({"status": "success", "new_balance": new_balance})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка покупки NFT: {e}"}), 500
-
-
-@app.route('/api/nft/regift', methods=['POST'])
-def nft_regift():
-    """
-    Передаривание NFT-подарка за 25 звезд (используем 25 монет как стоимость операции).
-    """
-    try:
-        data = request.json
-        from_user = data.get('from_user')
-        to_user = data.get('to_user')
-        token_id = data.get('token_id')
-
-        if not from_user or not to_user or not token_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-        COST = 25  # 25 "звезд" = 25 монет
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM nft_items WHERE token_id = ?", (token_id,))
-        token = cursor.fetchone()
-        if not token:
-            conn.close()
-            return jsonify({"status": "error", "message": "NFT не найден"}), 404
-
-        if token['owner_id'] != from_user:
-            conn.close()
-            return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
-
-        # Проверяем баланс
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (from_user,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return jsonify({"status": "error", "message": "Отправитель не найден"}), 404
-        balance = row['coins'] or 0
-        if balance < COST:
-            conn.close()
-            return jsonify({"status": "error", "message": "Недостаточно звезд (монет) для передаривания"}), 400
-
-        cursor.execute("UPDATE users SET coins = coins - ? WHERE id = ?", (COST, from_user))
-        cursor.execute("""
-            UPDATE nft_items
-            SET owner_id = ?, is_listed = 0
-            WHERE token_id = ?
-        """, (to_user, token_id))
-
-        conn.commit()
-
-        cursor.execute("SELECT coins FROM users WHERE id = ?", (from_user,))
-        new_balance = cursor.fetchone()[0]
-
-        conn.close()
-        return jsonify({"status": "success", "new_balance": new_balance})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка передаривания NFT: {e}"}), 500
-
-# --- 6. УДАЛЕНИЕ СООБЩЕНИЙ ---
-
-@app.route('/api/delete_message', methods=['POST'])
-def delete_message():
-    """API для удаления сообщения."""
-    try:
-        data = request.json
-        user_id = data.get('user_id')
-        message_id = data.get('message_id')
-        chat_partner_id = data.get('chat_partner_id')
-        
-        if not user_id or not message_id:
-            return jsonify({"status": "error", "message": "Неполные данные"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем роль пользователя
-        cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
-            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
-        
-        user_role = user['role']
-        
-        # Проверяем существование сообщения
-        cursor.execute("SELECT * FROM messages WHERE uuid = ?", (message_id,))
-        message = cursor.fetchone()
-        
-        if not message:
-            conn.close()
-            return jsonify({"status": "error", "message": "Сообщение не найдено"}), 404
-        
-        # Проверяем права: либо пользователь - отправитель, либо админ
-        if user_role != 'admin' and message['sender_id'] != user_id:
-            conn.close()
-            return jsonify({"status": "error", "message": "Нет прав для удаления этого сообщения"}), 403
-        
-        # Если это подарок – полностью запрещаем удаление
-        if message['gift_id']:
-            conn.close()
-            return jsonify({
-                "status": "error",
-                "message": "Подарочные сообщения нельзя удалить"
-            }), 400
-        
-        # Удаляем сообщение
-        cursor.execute("DELETE FROM messages WHERE uuid = ?", (message_id,))
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            "status": "success", 
-            "message": "Сообщение удалено"
-        })
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка удаления сообщения: {e}"}), 500
-
-# --- 7. МАРШРУТЫ ЧАТА И ПОИСКА ---
-
-@app.route('/api/search', methods=['POST'])
-def search():
-    """API для поиска пользователей и каналов."""
-    try:
-        data = request.json
-        current_user_id = data.get('current_user_id')
-        term = data.get('term', '').strip().lower()
-        
-        print(f"Search request: user={current_user_id}, term='{term}'")
-        
-        if not current_user_id:
-            return jsonify({"status": "error", "message": "Не указан текущий пользователь"}), 400
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        search_term_like = f"%{term}%"
-
-        # Пользователи
-        cursor.execute("""
-            SELECT id, displayName, avatarBase64, emailHash 
-            FROM users 
-            WHERE id != ? AND (id LIKE ? OR displayName LIKE ?)
-        """, (current_user_id, search_term_like, search_term_like))
-        user_results = [dict(row) for row in cursor.fetchall()]
-        for u in user_results:
-            u["kind"] = "user"
-
-        # Каналы (rooms.type = 'channel')
-        cursor.execute("""
-            SELECT id, name, avatarBase64, about, owner_id
-            FROM rooms
-            WHERE type = 'channel' AND (id LIKE ? OR name LIKE ?)
-        """, (search_term_like, search_term_like))
-        channel_results = []
-        for row in cursor.fetchall():
-            d = dict(row)
-            d["kind"] = "channel"
-            channel_results.append(d)
-
-        conn.close()
-        
-        all_results = user_results + channel_results
-        print(f"Search found {len(all_results)} results (users+channels)")
-        return jsonify({"status": "success", "results": all_results})
-        
-    except Exception as e:
-        print(f"Search error: {e}")
-        return jsonify({"status": "error", "message": f"Ошибка поиска: {e}"}), 500
-
-@app.route('/api/messages', methods=['POST'])
-def handle_messages():
-    """API для отправки сообщений и получения истории чата."""
-    try:
-        data = request.json
-        action = data.get('action')
-        
-        if action == 'send':
-            sender_id = data.get('sender_id')
-            receiver_id = data.get('receiver_id')
-            text = data.get('text')
-            
-            if not sender_id or not receiver_id or not text:
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Проверяем, является ли receiver_id каналом (проверяем в таблице rooms)
-            cursor.execute("SELECT id, name, type FROM rooms WHERE id = ?", (receiver_id,))
-            room = cursor.fetchone()
-            if room and room["type"] == "channel":
-                # Это канал - используем room_broadcast логику
-                room_id = receiver_id
-                
-                # Проверяем роль отправителя
-                cursor.execute("""
-                    SELECT role FROM room_members
-                    WHERE room_id = ? AND user_id = ?
-                """, (room_id, sender_id))
-                member = cursor.fetchone()
-                if not member:
-                    conn.close()
-                    return jsonify({"status": "error", "message": "Вы не подписаны на этот канал"}), 403
-                if member["role"] not in ("owner", "admin"):
-                    conn.close()
-                    return jsonify({"status": "error", "message": "Только владелец или админ канала может писать"}), 403
-                
-                # Используем логику room_broadcast
-                channel_chat_id = f"channel_{room_id}"
-                now_str = datetime.now().strftime("%H:%M")
-                msg_uuid = str(uuid.uuid4())
-                
-                cursor.execute("""
-                    INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, is_read)
-                    VALUES (?, ?, ?, ?, ?, 0)
-                """, (msg_uuid, channel_chat_id, sender_id, text, now_str))
-                
-                # Обновляем chat_partners для всех участников
-                cursor.execute("""
-                    SELECT user_id FROM room_members WHERE room_id = ?
-                """, (room_id,))
-                members = [row["user_id"] for row in cursor.fetchall()]
-                for member_id in members:
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                        VALUES (?, ?, ?)
-                    """, (member_id, receiver_id, channel_chat_id))
-                
-                conn.commit()
-                conn.close()
-                return jsonify({"status": "success", "message": {"uuid": msg_uuid, "sender_id": sender_id, "text": text, "timestamp": now_str}})
-            else:
-                # Обычный чат между пользователями
-                chat_id = get_chat_id(sender_id, receiver_id)
-                now_str = datetime.now().strftime("%H:%M")
-                message = {
-                    "uuid": str(uuid.uuid4()),
-                    "sender_id": sender_id,
-                    "text": text,
-                    "timestamp": now_str
-                }
-                cursor.execute("""
-                    INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, is_read)
-                    VALUES (?, ?, ?, ?, ?, 0)
-                """, (message["uuid"], chat_id, sender_id, text, now_str))
-                
-                cursor.execute("""
-                    INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                    VALUES (?, ?, ?)
-                """, (sender_id, receiver_id, chat_id))
-                cursor.execute("""
-                    INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
-                    VALUES (?, ?, ?)
-                """, (receiver_id, sender_id, chat_id))
-
-                conn.commit()
-                conn.close()
-                return jsonify({"status": "success", "message": message})
-
-        elif action == 'history':
-            user_a = data.get('user_a')
-            user_b = data.get('user_b')
-            
-            if not user_a or not user_b:
-                return jsonify({"status": "error", "message": "Необходимо два ID"}), 400
-
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Проверяем, является ли user_b каналом (проверяем в таблице rooms)
-            cursor.execute("SELECT id, type FROM rooms WHERE id = ?", (user_b,))
-            room = cursor.fetchone()
-            if room and room["type"] == "channel":
-                # Это канал - используем специальный chat_id
-                chat_id = f"channel_{user_b}"
-            else:
-                # Обычный чат между пользователями
-                chat_id = get_chat_id(user_a, user_b)
-            
-            cursor.execute("""
-                SELECT uuid, sender_id, text, timestamp, gift_id, is_read 
-                FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp ASC
-            """, (chat_id,))
-            
-            history = []
-            for row in cursor.fetchall():
-                message_data = {
-                    "uuid": row["uuid"],
-                    "sender": row["sender_id"],
-                    "text": row["text"],
-                    "timestamp": row["timestamp"],
-                    "is_read": bool(row["is_read"])
-                }
-                if row["gift_id"]:
-                    message_data["gift_id"] = row["gift_id"]
-                    message_data["is_gift"] = True
-                history.append(message_data)
-            
-            # помечаем все входящие сообщения как прочитанные (только для обычных чатов)
-            if not (room and room["type"] == "channel"):
-                cursor.execute("""
-                    UPDATE messages
-                    SET is_read = 1
-                    WHERE chat_id = ? AND sender_id = ? AND is_read = 0
-                """, (chat_id, user_b))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "success", "messages": history})
-
-        elif action == 'chats':
-            user_id = data.get('user_id')
-            if not user_id:
-                return jsonify({"status": "error", "message": "Не указан ID пользователя"}), 400
-                
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Получаем обычные чаты с пользователями
-            cursor.execute("""
-                SELECT 
-                    u.id, 
-                    u.displayName, 
-                    u.avatarBase64, 
-                    u.emailHash,
-                    'user' as chat_type
-                FROM chat_partners cp
-                JOIN users u ON cp.partner_id = u.id
-                WHERE cp.user_id = ? AND cp.partner_id NOT LIKE 'channel_%'
-            """, (user_id,))
-            chat_partners = [dict(row) for row in cursor.fetchall()]
-            
-            # Получаем каналы, на которые подписан пользователь
-            cursor.execute("""
-                SELECT 
-                    r.id,
-                    r.name as displayName,
-                    r.avatarBase64,
-                    '' as emailHash,
-                    'channel' as chat_type,
-                    r.owner_id,
-                    rm.role
-                FROM room_members rm
-                JOIN rooms r ON rm.room_id = r.id
-                WHERE rm.user_id = ? AND r.type = 'channel'
-            """, (user_id,))
-            channels = [dict(row) for row in cursor.fetchall()]
-            
-            # Объединяем результаты
-            all_chats = chat_partners + channels
-            conn.close()
-
-            return jsonify({"status": "success", "chats": all_chats})
-
-        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка работы с сообщениями: {e}"}), 500
-
-# --- CALLS API (WebRTC Signaling) ---
-
-# Хранилище сигналов звонков в памяти (в продакшене лучше использовать Redis)
-calls_signaling = {}
-
-@app.route('/api/calls', methods=['POST'])
-def handle_calls():
-    """API для сигналинга WebRTC звонков."""
-    try:
-        data = request.json
-        action = data.get('action')
-        
-        if action == 'offer':
-            # Инициатор звонка отправляет offer
-            caller_id = data.get('caller_id')
-            callee_id = data.get('callee_id')
-            offer = data.get('offer')
-            
-            if not caller_id or not callee_id or not offer:
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            
-            call_id = f"{caller_id}_{callee_id}"
-            calls_signaling[call_id] = {
-                'caller_id': caller_id,
-                'callee_id': callee_id,
-                'offer': offer,
-                'answer': None,
-                'caller_ice': [],
-                'callee_ice': [],
-                'status': 'ringing',
-                'created_at': datetime.now().isoformat()
-            }
-            
-            return jsonify({"status": "success", "call_id": call_id})
-        
-        elif action == 'answer':
-            # Получатель звонка отправляет answer
-            call_id = data.get('call_id')
-            answer = data.get('answer')
-            
-            if not call_id or not answer:
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            
-            if call_id not in calls_signaling:
-                return jsonify({"status": "error", "message": "Звонок не найден"}), 404
-            
-            calls_signaling[call_id]['answer'] = answer
-            calls_signaling[call_id]['status'] = 'answered'
-            
-            return jsonify({"status": "success"})
-        
-        elif action == 'ice_candidate':
-            # Отправка ICE candidate
-            call_id = data.get('call_id')
-            candidate = data.get('candidate')
-            user_id = data.get('user_id')
-            
-            if not call_id or not candidate or not user_id:
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            
-            if call_id not in calls_signaling:
-                return jsonify({"status": "error", "message": "Звонок не найден"}), 404
-            
-            call_data = calls_signaling[call_id]
-            if user_id == call_data['caller_id']:
-                call_data['caller_ice'].append(candidate)
-            elif user_id == call_data['callee_id']:
-                call_data['callee_ice'].append(candidate)
-            else:
-                return jsonify({"status": "error", "message": "Неверный пользователь"}), 403
-            
-            return jsonify({"status": "success"})
-        
-        elif action == 'get_call':
-            # Получение данных звонка (для polling)
-            call_id = data.get('call_id')
-            user_id = data.get('user_id')
-            
-            if not call_id or not user_id:
-                return jsonify({"status": "error", "message": "Неполные данные"}), 400
-            
-            if call_id not in calls_signaling:
-                return jsonify({"status": "error", "message": "Звонок не найден"}), 404
-            
-            call_data = calls_signaling[call_id]
-            
-            # Определяем, какие данные нужны пользователю
-            response_data = {
-                'status': call_data['status'],
-                'caller_id': call_data['caller_id'],
-                'callee_id': call_data['callee_id']
-            }
-            
-            if user_id == call_data['caller_id']:
-                # Инициатор получает answer и ICE от получателя
-                if call_data['answer']:
-                    response_data['answer'] = call_data['answer']
-                response_data['ice_candidates'] = call_data['callee_ice']
-            elif user_id == call_data['callee_id']:
-                # Получатель получает offer и ICE от инициатора
-                response_data['offer'] = call_data['offer']
-                response_data['ice_candidates'] = call_data['caller_ice']
-            else:
-                return jsonify({"status": "error", "message": "Неверный пользователь"}), 403
-            
-            return jsonify({"status": "success", "call": response_data})
-        
-        elif action == 'end_call':
-            # Завершение звонка
-            call_id = data.get('call_id')
-            
-            if call_id and call_id in calls_signaling:
-                calls_signaling[call_id]['status'] = 'ended'
-                # Удаляем через 30 секунд
-                import threading
-                def cleanup():
-                    import time
-                    time.sleep(30)
-                    if call_id in calls_signaling:
-                        del calls_signaling[call_id]
-                threading.Thread(target=cleanup, daemon=True).start()
-            
-            return jsonify({"status": "success"})
-        
-        elif action == 'check_incoming':
-            # Проверка входящих звонков
-            user_id = data.get('user_id')
-            
-            if not user_id:
-                return jsonify({"status": "error", "message": "Не указан пользователь"}), 400
-            
-            # Ищем активные звонки для этого пользователя
-            incoming_calls = []
-            for call_id, call_data in calls_signaling.items():
-                if call_data['callee_id'] == user_id and call_data['status'] == 'ringing':
-                    incoming_calls.append({
-                        'call_id': call_id,
-                        'caller_id': call_data['caller_id'],
-                        'offer': call_data['offer']
-                    })
-            
-            return jsonify({"status": "success", "calls": incoming_calls})
-        
-        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Ошибка звонка: {e}"}), 500
-
-if __name__ == '__main__':
+# app.py (полная версия с исправлениями: исчезающие подарки, удаление сообщений и все функции)
+from flask import Flask, render_template, request, jsonify, Response, send_file, abort
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+import sqlite3
+import base64
+import bisect
+import hashlib
+import heapq
+import io
+import uuid
+import json
+import zlib
+import os
+import queue
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Pillow нужен только для уменьшенных копий аватаров; без него отдаются оригиналы
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+app = Flask(__name__)
+# Путь к базе можно переопределить (например, для бенчмарков на временной базе)
+DB_NAME = os.environ.get('VAULT_DB_PATH', 'vault_messenger.db')
+# Каталог контентно-адресуемого хранилища картинок (аватары, изображения подарков)
+MEDIA_DIR = os.path.abspath(os.environ.get('VAULT_MEDIA_DIR', 'media'))
+# Каталог архива старых сообщений (файлы SQLite по месяцам)
+ARCHIVE_DIR = os.path.abspath(os.environ.get('VAULT_ARCHIVE_DIR', 'archive'))
+
+# --- 1. ФУНКЦИИ БАЗЫ ДАННЫХ (SQLite) ---
+
+# Настройки подключений SQLite
+DB_POOL_SIZE = int(os.environ.get('VAULT_DB_POOL_SIZE', 16))
+DB_POOL_TIMEOUT_SECONDS = 10
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 20000           # PRAGMA cache_size в КиБ на одно подключение
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHED_STATEMENTS = 256         # кэш подготовленных запросов на одно подключение
+
+class ConnectionPool:
+    """
+    Пул подключений SQLite к одному файлу базы.
+    Подключения живут между запросами, поэтому PRAGMA и разбор схемы выполняются
+    один раз, а подготовленные запросы переиспользуются (cached_statements).
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            # После fork (gunicorn) подключения родителя использовать нельзя
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=DB_POOL_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Нет свободных подключений к базе данных")
+
+    def release(self, conn):
+        try:
+            # Незакоммиченные изменения (ранний return или исключение) откатываются
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._created -= 1
+
+db_pool = ConnectionPool(DB_NAME, DB_POOL_SIZE)
+
+@contextmanager
+def db_connection(pool=None):
+    """
+    Выдает подключение из пула и гарантированно возвращает его обратно,
+    в том числе при исключении. Незакоммиченная транзакция откатывается.
+    """
+    pool = pool or db_pool
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def create_base_tables(cursor):
+    """Создает таблицы, если их еще нет (схема для новой базы данных)."""
+    # Таблица USERS (пользователи)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            displayName TEXT NOT NULL,
+            bio TEXT,
+            avatarBase64 TEXT,
+            emailHash TEXT,
+            role TEXT DEFAULT 'user',
+            is_banned INTEGER DEFAULT 0,
+            coins INTEGER DEFAULT 15
+        )
+    """)
+    
+    # Таблица MESSAGES (сообщения)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            uuid TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            gift_id TEXT DEFAULT NULL,
+            seq INTEGER,
+            created_at TEXT
+        )
+    """)
+
+    # Таблица MEDIA (файлы в MEDIA_DIR, адресуемые по sha256 содержимого)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            hash TEXT PRIMARY KEY,
+            mime TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+    # Таблица MEDIA_RENDITIONS (уменьшенные копии картинок из media)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS media_renditions (
+            source_hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (source_hash, size)
+        )
+    """)
+
+    # Таблица COUNTERS (монотонные счетчики, например номер сообщения)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+
+    # Таблица CHAT_PARTNERS
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_partners (
+            user_id TEXT NOT NULL,
+            partner_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, partner_id)
+        )
+    """)
+
+    # Таблица CHAT_SUMMARIES (строка списка чатов: последнее сообщение и непрочитанные).
+    # Обновляется в той же транзакции, что и запись сообщения.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            partner_id TEXT NOT NULL,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            last_preview TEXT,
+            last_sender_id TEXT,
+            last_at TEXT,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+
+    # Таблица CHAT_READS: личный чат прочитан пользователем до сообщения с seq = read_seq.
+    # Отметка "прочитано" у отправителя выводится из нее, а не хранится в каждом сообщении.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_reads (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            read_seq INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+
+    # Таблица RETENTION_POLICIES: сроки хранения сообщений отдельного чата или канала.
+    # archive_after_days: NULL — срок по умолчанию, 0 — не архивировать;
+    # delete_after_days: NULL — хранить всегда.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            chat_id TEXT PRIMARY KEY,
+            archive_after_days INTEGER,
+            delete_after_days INTEGER,
+            updated_by TEXT,
+            updated_at TEXT
+        )
+    """)
+
+    # Таблица MESSAGE_ARCHIVE: каталог сжатых блоков сообщений, перенесенных в файлы архива.
+    # Блок — подряд идущие сообщения одного чата (seq от first_seq до last_seq).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_archive (
+            chat_id TEXT NOT NULL,
+            first_seq INTEGER NOT NULL,
+            last_seq INTEGER NOT NULL,
+            first_at TEXT,
+            last_at TEXT,
+            message_count INTEGER NOT NULL,
+            partition TEXT NOT NULL,
+            PRIMARY KEY (chat_id, first_seq)
+        )
+    """)
+
+    # Таблица MESSAGE_OUTBOX: сообщения, принятые в основной базе вместе со списанием
+    # (подарок) или проверкой прав, но еще не записанные в шард чата (см. run_message_write)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_outbox (
+            uuid TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            receiver_id TEXT NOT NULL,
+            text TEXT,
+            gift_id TEXT,
+            timestamp TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+    # Таблица ARCHIVE_DELETIONS: архивные сообщения, удаление которых закоммичено в основной
+    # базе (каталог, сводки), а блок в файле архива еще не переписан (см. delete_archived_message)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_deletions (
+            uuid TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            partition TEXT NOT NULL,
+            first_seq INTEGER NOT NULL
+        )
+    """)
+
+    # Таблица CHANNEL_STATE (последний пост канала и число постов). Сводки каналов
+    # не размножаются по подписчикам: список чатов соединяет room_members с этой таблицей.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS channel_state (
+            room_id TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            last_preview TEXT,
+            last_sender_id TEXT,
+            last_at TEXT,
+            post_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    
+    # Таблица JOBS (фоновые задачи, см. JobQueue)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL, -- queued/running/done/failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after REAL NOT NULL DEFAULT 0,
+            locked_until REAL,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+    # Журнал движения монет (только добавление): amount со знаком, баланс после операции
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS coin_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+    # Таблица GIFTS
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gifts (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            image_url TEXT NOT NULL,
+            is_rare BOOLEAN DEFAULT FALSE,
+            created_by TEXT DEFAULT 'system',
+            quantity INTEGER DEFAULT -1,
+            is_active BOOLEAN DEFAULT TRUE,
+            upgradeable BOOLEAN DEFAULT FALSE
+        )
+    """)
+    
+    # Таблица INVENTORY
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_inventory (
+            user_id TEXT NOT NULL,
+            gift_id TEXT NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            displayed_in_profile BOOLEAN DEFAULT FALSE,
+            PRIMARY KEY (user_id, gift_id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (gift_id) REFERENCES gifts(id)
+        )
+    """)
+
+    # Таблица NFT подарков (уникальные токены)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS nft_items (
+            token_id TEXT PRIMARY KEY,
+            base_gift_id TEXT NOT NULL,
+            owner_id TEXT NOT NULL,
+            creator_admin_id TEXT NOT NULL,
+            original_sender_id TEXT NOT NULL,
+            serial_number INTEGER NOT NULL,
+            bg_variant INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            is_listed INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (base_gift_id) REFERENCES gifts(id),
+            FOREIGN KEY (owner_id) REFERENCES users(id)
+        )
+    """)
+
+    # Последний выданный порядковый номер NFT для каждого базового подарка
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_serial_counters (
+            gift_id TEXT PRIMARY KEY,
+            last_serial INTEGER NOT NULL
+        )
+    """)
+
+    # История сделок NFT: продажи на маркете и передаривания (price = 0)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS nft_trades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_id TEXT NOT NULL,
+            base_gift_id TEXT NOT NULL,
+            seller_id TEXT NOT NULL,
+            buyer_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            kind TEXT NOT NULL, -- sale/regift
+            created_at TEXT NOT NULL
+        )
+    """)
+
+    # Итоги продаж по базовому подарку, обновляются при каждой сделке
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS nft_gift_stats (
+            base_gift_id TEXT PRIMARY KEY,
+            last_price INTEGER NOT NULL,
+            last_trade_at TEXT NOT NULL,
+            trade_count INTEGER NOT NULL,
+            volume_total INTEGER NOT NULL,
+            high_price INTEGER NOT NULL,
+            low_price INTEGER NOT NULL
+        )
+    """)
+
+    # Свечи OHLC по базовому подарку; bucket_start — начало интервала (unix-время)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS nft_price_buckets (
+            base_gift_id TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            open_price INTEGER NOT NULL,
+            high_price INTEGER NOT NULL,
+            low_price INTEGER NOT NULL,
+            close_price INTEGER NOT NULL,
+            volume INTEGER NOT NULL,
+            trades INTEGER NOT NULL,
+            PRIMARY KEY (base_gift_id, bucket_start)
+        )
+    """)
+
+    # Таблицы для групп и каналов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL, -- 'group' или 'channel'
+            owner_id TEXT NOT NULL,
+            avatarBase64 TEXT,
+            about TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS room_members (
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'member', -- owner/admin/member
+            PRIMARY KEY (room_id, user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+def _column_exists(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+def _add_column(cursor, table, column, definition):
+    """Добавляет колонку, если ее нет (для баз, созданных старыми версиями приложения)."""
+    if _column_exists(cursor, table, column):
+        return False
+    print(f"Добавляем колонку {column} в таблицу {table}...")
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+# --- 1.1. МИГРАЦИИ СХЕМЫ ---
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз, в своей транзакции, вместе с повышением версии.
+# Новые миграции добавляются только в конец списка MIGRATIONS.
+
+def migration_001_legacy_columns(cursor):
+    """Недостающие колонки из старых версий приложения."""
+    _add_column(cursor, "users", "coins", "INTEGER DEFAULT 15")
+    _add_column(cursor, "messages", "gift_id", "TEXT DEFAULT NULL")
+    _add_column(cursor, "gifts", "is_rare", "BOOLEAN DEFAULT FALSE")
+    _add_column(cursor, "gifts", "created_by", "TEXT DEFAULT 'system'")
+    _add_column(cursor, "gifts", "quantity", "INTEGER DEFAULT -1")
+    _add_column(cursor, "gifts", "is_active", "BOOLEAN DEFAULT TRUE")
+    # можно ли юзерам апгрейдить этот подарок в NFT
+    _add_column(cursor, "gifts", "upgradeable", "BOOLEAN DEFAULT FALSE")
+    # last_seen для статусов онлайн
+    _add_column(cursor, "users", "last_seen", "TEXT")
+    _add_column(cursor, "messages", "is_read", "INTEGER DEFAULT 0")
+    _add_column(cursor, "nft_items", "displayed_in_profile", "INTEGER DEFAULT 0")
+    _add_column(cursor, "rooms", "avatarBase64", "TEXT")
+    _add_column(cursor, "rooms", "about", "TEXT")
+
+def migration_002_message_seq(cursor):
+    """seq и created_at для сообщений."""
+    # Старые сообщения нумеруем в порядке вставки (rowid), т.к. timestamp хранит только "%H:%M"
+    if _add_column(cursor, "messages", "seq", "INTEGER"):
+        cursor.execute("UPDATE messages SET seq = rowid")
+    _add_column(cursor, "messages", "created_at", "TEXT")
+    cursor.execute("""
+        INSERT OR IGNORE INTO counters (name, value)
+        SELECT 'message_seq', COALESCE(MAX(seq), 0) FROM messages
+    """)
+
+def migration_003_hot_path_indexes(cursor):
+    """Индексы для горячих запросов."""
+    # История чата: WHERE chat_id = ? ORDER BY seq
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_seq ON messages(chat_id, seq)")
+    # Отметка прочтения (UPDATE ... is_read = 0) и MAX(seq) прочитанных для отметок "прочитано"
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_sender_read
+        ON messages(chat_id, sender_id, is_read, seq)
+    """)
+    # Порядковый номер NFT: COUNT(*) WHERE base_gift_id = ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nft_items_base_gift ON nft_items(base_gift_id)")
+    # NFT пользователя: WHERE owner_id = ? ORDER BY created_at DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nft_items_owner ON nft_items(owner_id, created_at)")
+    # Маркет: WHERE is_listed = 1 ORDER BY created_at DESC
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nft_items_listed
+        ON nft_items(created_at) WHERE is_listed = 1
+    """)
+    # Группы/каналы пользователя: room_members WHERE user_id = ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members(user_id)")
+
+def migration_004_media_store(cursor):
+    """Перенос base64-картинок из таблиц в хранилище media."""
+    for table, key, column in (("users", "id", "avatarBase64"),
+                               ("rooms", "id", "avatarBase64"),
+                               ("gifts", "id", "image_url")):
+        cursor.execute(f"SELECT {key}, {column} FROM {table} WHERE {column} LIKE 'data:%'")
+        rows = cursor.fetchall()
+        for row_id, value in rows:
+            cursor.execute(f"UPDATE {table} SET {column} = ? WHERE {key} = ?",
+                           (store_data_url(cursor, value), row_id))
+        if rows:
+            print(f"Перенесено картинок из {table}.{column}: {len(rows)}")
+
+# После переноса картинок в базе остаются мегабайты свободных страниц
+migration_004_media_store.vacuum_after = True
+
+def migration_005_chat_summaries(cursor):
+    """Сводки для списка чатов (последнее сообщение, непрочитанные)."""
+    # Список чатов: WHERE user_id = ? ORDER BY last_at DESC
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_summaries_user_recent
+        ON chat_summaries(user_id, last_at, last_seq)
+    """)
+    # Пересчет превью после удаления сообщения: WHERE chat_id = ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_summaries_chat ON chat_summaries(chat_id)")
+    # Личные чаты — из chat_partners, непрочитанные — входящие с is_read = 0
+    cursor.execute("""
+        INSERT OR IGNORE INTO chat_summaries
+            (user_id, chat_id, partner_id, last_seq, last_preview, last_sender_id, last_at, unread_count)
+        SELECT cp.user_id, cp.chat_id, cp.partner_id,
+               COALESCE(m.seq, 0), substr(m.text, 1, ?), m.sender_id, m.created_at,
+               (SELECT COUNT(*) FROM messages u
+                WHERE u.chat_id = cp.chat_id AND u.sender_id = cp.partner_id AND u.is_read = 0)
+        FROM chat_partners cp
+        LEFT JOIN messages m ON m.seq = (SELECT MAX(seq) FROM messages WHERE chat_id = cp.chat_id)
+        WHERE cp.chat_id NOT LIKE 'channel_%'
+    """, (CHAT_PREVIEW_LENGTH,))
+    # Каналы — из подписок; прочтение в каналах раньше не отслеживалось
+    cursor.execute("""
+        INSERT OR IGNORE INTO chat_summaries
+            (user_id, chat_id, partner_id, last_seq, last_preview, last_sender_id, last_at, unread_count)
+        SELECT rm.user_id, 'channel_' || r.id, r.id,
+               COALESCE(m.seq, 0), substr(m.text, 1, ?), m.sender_id, m.created_at, 0
+        FROM room_members rm
+        JOIN rooms r ON r.id = rm.room_id AND r.type = 'channel'
+        LEFT JOIN messages m ON m.seq = (SELECT MAX(seq) FROM messages WHERE chat_id = 'channel_' || r.id)
+    """, (CHAT_PREVIEW_LENGTH,))
+
+def migration_006_fulltext_search(cursor):
+    """Полнотекстовые индексы FTS5 для сообщений и имен."""
+    # Сообщения: внешний контент, rowid = messages.seq (rowid самой messages меняется при VACUUM)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_seq ON messages(seq)")
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='seq',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.seq, new.text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.seq, old.text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.seq, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.seq, new.text);
+        END
+    """)
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    # Имена пользователей и каналов: префиксный индекс по словам имени и ID.
+    # search_names дает устойчивый rowid для строки индекса по (kind, ref_id).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS search_names (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            ref_id TEXT NOT NULL,
+            UNIQUE (kind, ref_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS names_fts USING fts5(
+            name, handle,
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+        )
+    """)
+    for table, kind, name_column, condition in (("users", "user", "displayName", "1"),
+                                                ("rooms", "channel", "name", "new.type = 'channel'")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_names_ai AFTER INSERT ON {table}
+            WHEN {condition} BEGIN
+                INSERT OR IGNORE INTO search_names (kind, ref_id) VALUES ('{kind}', new.id);
+                INSERT INTO names_fts (rowid, name, handle)
+                SELECT id, new.{name_column}, new.id FROM search_names
+                WHERE kind = '{kind}' AND ref_id = new.id;
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_names_au AFTER UPDATE OF {name_column} ON {table}
+            WHEN {condition} BEGIN
+                UPDATE names_fts SET name = new.{name_column}
+                WHERE rowid = (SELECT id FROM search_names WHERE kind = '{kind}' AND ref_id = new.id);
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_names_ad AFTER DELETE ON {table} BEGIN
+                DELETE FROM names_fts
+                WHERE rowid = (SELECT id FROM search_names WHERE kind = '{kind}' AND ref_id = old.id);
+                DELETE FROM search_names WHERE kind = '{kind}' AND ref_id = old.id;
+            END
+        """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO search_names (kind, ref_id)
+        SELECT 'user', id FROM users
+        UNION ALL
+        SELECT 'channel', id FROM rooms WHERE type = 'channel'
+    """)
+    cursor.execute("""
+        INSERT INTO names_fts (rowid, name, handle)
+        SELECT s.id, COALESCE(u.displayName, r.name, ''), s.ref_id
+        FROM search_names s
+        LEFT JOIN users u ON s.kind = 'user' AND u.id = s.ref_id
+        LEFT JOIN rooms r ON s.kind = 'channel' AND r.id = s.ref_id
+    """)
+
+def migration_007_channel_state(cursor):
+    """Состояние каналов вместо сводок и chat_partners у каждого подписчика."""
+    # Сколько постов канала подписчик прочитал: непрочитанные = post_count - read_count
+    _add_column(cursor, "room_members", "read_count", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        INSERT OR IGNORE INTO channel_state
+            (room_id, last_seq, last_preview, last_sender_id, last_at, post_count)
+        SELECT r.id, COALESCE(m.seq, 0), substr(m.text, 1, ?), m.sender_id,
+               COALESCE(m.created_at, ?),
+               (SELECT COUNT(*) FROM messages WHERE chat_id = 'channel_' || r.id)
+        FROM rooms r
+        LEFT JOIN messages m ON m.seq = (SELECT MAX(seq) FROM messages WHERE chat_id = 'channel_' || r.id)
+        WHERE r.type = 'channel'
+    """, (CHAT_PREVIEW_LENGTH, datetime.now().isoformat(timespec='seconds')))
+    # Непрочитанные из старых сводок сохраняем
+    cursor.execute("""
+        UPDATE room_members SET read_count = (
+            SELECT MAX(cs.post_count - COALESCE(s.unread_count, 0), 0)
+            FROM channel_state cs
+            LEFT JOIN chat_summaries s
+                ON s.user_id = room_members.user_id AND s.chat_id = 'channel_' || cs.room_id
+            WHERE cs.room_id = room_members.room_id
+        )
+        WHERE room_id IN (SELECT room_id FROM channel_state)
+    """)
+    cursor.execute("DELETE FROM chat_summaries WHERE chat_id LIKE 'channel_%'")
+    cursor.execute("DELETE FROM chat_partners WHERE chat_id LIKE 'channel_%'")
+
+def migration_008_job_queue(cursor):
+    """Индексы очереди фоновых задач."""
+    # Выбор следующей задачи: незавершенные по run_after
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs(status, run_after, created_at)
+        WHERE status IN ('queued', 'running')
+    """)
+    # Очистка завершенных задач по updated_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(updated_at)")
+
+def migration_009_coin_ledger(cursor):
+    """Индекс журнала монет: история операций пользователя по порядку."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_coin_transactions_user ON coin_transactions(user_id, id)")
+
+def migration_010_gift_serial_counters(cursor):
+    """Счетчики порядковых номеров NFT из уже выпущенных токенов."""
+    # MAX, а не COUNT: номера, выданные дважды при гонке, не должны повториться снова
+    cursor.execute("""
+        INSERT OR IGNORE INTO gift_serial_counters (gift_id, last_serial)
+        SELECT base_gift_id, MAX(serial_number) FROM nft_items GROUP BY base_gift_id
+    """)
+
+def migration_011_market_indexes(cursor):
+    """Индексы маркета NFT под каждую сортировку, общие и внутри базового подарка."""
+    # token_id в конце индекса — второй ключ keyset-пагинации
+    cursor.execute("DROP INDEX IF EXISTS idx_nft_items_listed")
+    # Был нужен для COUNT(*) порядкового номера (теперь gift_serial_counters) и мешал
+    # планировщику выбрать частичный индекс маркета для floor по подарку
+    cursor.execute("DROP INDEX IF EXISTS idx_nft_items_base_gift")
+    for name, columns in (
+        ("newest", "created_at, token_id"),
+        ("price", "price, token_id"),
+        ("serial", "serial_number, token_id"),
+        ("gift_newest", "base_gift_id, created_at, token_id"),
+        # Также floor: MIN(price) WHERE base_gift_id = ?
+        ("gift_price", "base_gift_id, price, token_id"),
+        ("gift_serial", "base_gift_id, serial_number, token_id"),
+    ):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_nft_market_{name} ON nft_items({columns}) WHERE is_listed = 1")
+
+def migration_012_nft_trades(cursor):
+    """Индексы истории сделок NFT."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nft_trades_gift ON nft_trades(base_gift_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nft_trades_token ON nft_trades(token_id, id)")
+
+def migration_013_chat_reads(cursor):
+    """Отметки прочтения chat_reads вместо messages.is_read."""
+    # До какого seq получатель прочитал входящие — по старым флагам is_read
+    cursor.execute("""
+        INSERT OR IGNORE INTO chat_reads (user_id, chat_id, read_seq)
+        SELECT user_id, chat_id, read_seq FROM (
+            SELECT cp.user_id, cp.chat_id,
+                   (SELECT MAX(m.seq) FROM messages m
+                    WHERE m.chat_id = cp.chat_id AND m.sender_id = cp.partner_id AND m.is_read = 1) AS read_seq
+            FROM chat_partners cp
+            WHERE cp.chat_id NOT LIKE 'channel_%'
+        )
+        WHERE read_seq IS NOT NULL
+    """)
+    # is_read больше не обновляется и не читается
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_chat_sender_read")
+
+def migration_014_message_archive(cursor):
+    """Архив сообщений и incremental vacuum."""
+    # История из архива: блоки чата после seq (для after_seq)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_message_archive_chat_last
+        ON message_archive(chat_id, last_seq)
+    """)
+    # Удаление просроченных блоков и пустых файлов архива
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_message_archive_partition
+        ON message_archive(partition, last_at)
+    """)
+
+# Свободные страницы после архивации возвращаются порциями (PRAGMA incremental_vacuum);
+# режим auto_vacuum = INCREMENTAL включает VACUUM фоновой задачей после миграции
+migration_014_message_archive.vacuum_after = True
+
+def migration_015_message_dates(cursor):
+    """Дата created_at у сообщений, созданных до миграции 2."""
+    # timestamp хранит только "%H:%M", поэтому настоящей даты нет — берем время миграции:
+    # иначе архивация считала бы такие сообщения старше любого срока
+    now = datetime.now().isoformat(timespec='seconds')
+    cursor.execute("UPDATE messages SET created_at = ? WHERE created_at IS NULL", (now,))
+    cursor.execute("""
+        UPDATE message_archive SET first_at = COALESCE(first_at, ?), last_at = COALESCE(last_at, ?)
+        WHERE first_at IS NULL OR last_at IS NULL
+    """, (now, now))
+
+MIGRATIONS = [
+    migration_001_legacy_columns,
+    migration_002_message_seq,
+    migration_003_hot_path_indexes,
+    migration_004_media_store,
+    migration_005_chat_summaries,
+    migration_006_fulltext_search,
+    migration_007_channel_state,
+    migration_008_job_queue,
+    migration_009_coin_ledger,
+    migration_010_gift_serial_counters,
+    migration_011_market_indexes,
+    migration_012_nft_trades,
+    migration_013_chat_reads,
+    migration_014_message_archive,
+    migration_015_message_dates,
+]
+
+def apply_migrations(conn):
+    """
+    Применяет миграции, которых еще нет в этой базе (по PRAGMA user_version).
+    Возвращает True, если после них базу стоит сжать (VACUUM).
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    vacuum = False
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        print(f"Применяем миграцию {number}: {migration.__doc__}")
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        vacuum = vacuum or getattr(migration, "vacuum_after", False)
+    return vacuum
+
+def init_db():
+    """Инициализирует базу данных: таблицы, миграции и начальные данные."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        create_base_tables(cursor)
+        conn.commit()
+        if apply_migrations(conn):
+            # Сжатие идет фоновой задачей, чтобы не задерживать запуск приложения
+            print("Сжатие базы данных (VACUUM) поставлено в очередь задач")
+            job_queue.enqueue("vacuum", {}, cursor)
+            conn.commit()
+        message_shards.open(conn)
+        # Сообщения, не доставленные в шард до остановки процесса
+        cursor.execute("SELECT 1 FROM message_outbox LIMIT 1")
+        if cursor.fetchone():
+            job_queue.enqueue("message_outbox", {}, cursor)
+            conn.commit()
+
+        # --- Добавление начальных пользователей ---
+        cursor.execute("SELECT COUNT(*) FROM users")
+        if cursor.fetchone()[0] == 0:
+            print("Добавляем начальных пользователей...")
+            initial_users = [
+                ("admin", "pass", "Администратор Vault", "Создатель системы", "", 'admin'), 
+                ("bob", "pass", "Боб Тестер", "Тестировщик приложения", "", 'user'),
+                ("user_me", "pass", "Мой Профиль", "Тестовый пользователь", "", 'user'),
+            ]
+        
+            for user_id, password, display_name, bio, avatar, role in initial_users:
+                email_hash = hashlib.md5(f"{user_id}@example.com".encode('utf-8')).hexdigest()
+                cursor.execute("""
+                    INSERT INTO users (id, password, displayName, bio, avatarBase64, emailHash, role, coins)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, password, display_name, bio, avatar, email_hash, role, 15))
+        else:
+            # Обновляем существующих пользователей
+            cursor.execute("UPDATE users SET coins = 15 WHERE coins IS NULL")
+            cursor.execute("UPDATE users SET role = 'admin' WHERE id = 'admin' AND role != 'admin'")
+        
+        # --- Добавление начальных подарков ---
+        cursor.execute("SELECT COUNT(*) FROM gifts")
+        if cursor.fetchone()[0] == 0:
+            print("Добавляем начальные подарки...")
+            initial_gifts = [
+                ("gift1", "❤️ Сердце", 5, "❤️", False, "system", -1, True, False),
+                ("gift2", "⭐ Звезда", 10, "⭐", False, "system", -1, True, False),
+                ("gift3", "🎁 Подарок", 15, "🎁", False, "system", -1, True, False),
+                ("gift4", "🏆 Кубок", 20, "🏆", True, "system", -1, True, True),
+                ("gift5", "👑 Корона", 25, "👑", True, "system", -1, True, True),
+                ("gift6", "🚀 Ракета", 30, "🚀", True, "system", -1, True, True),
+                # Базовый подарок от админа, который можно апгрейдить в NFT
+                ("admin_gift", "🎖 Подарок от Админа", 0, "🎖", True, "admin", -1, True, True),
+            ]
+        
+            for gift_id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable in initial_gifts:
+                cursor.execute("""
+                    INSERT OR REPLACE INTO gifts (id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (gift_id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable))
+        
+        conn.commit()
+        print("База данных инициализирована успешно!")
+
+# --- 1.2. ГРУППОВОЙ КОММИТ ЗАПИСЕЙ (write batcher) ---
+# Записи сообщений из параллельных запросов (send, send_gift, посты в каналы) можно
+# объединять: один поток-писатель выполняет накопившиеся операции в одной транзакции
+# (каждую в своем SAVEPOINT) и коммитит их одним fsync. Запрос получает ответ только
+# после коммита своей группы. Включается переменной окружения VAULT_WRITE_BATCHING=1.
+
+WRITE_BATCH_ENABLED = os.environ.get('VAULT_WRITE_BATCHING', '0') == '1'
+WRITE_BATCH_MAX_SIZE = 128
+# Сколько писатель ждет новых операций, прежде чем закоммитить неполную группу
+WRITE_BATCH_MAX_DELAY_MS = float(os.environ.get('VAULT_WRITE_BATCH_DELAY_MS', 2))
+# Подключение писателя коммитит с fsync: при групповом коммите он делится на всю группу
+WRITE_BATCH_SYNCHRONOUS = os.environ.get('VAULT_WRITE_BATCH_SYNCHRONOUS', 'FULL')
+# Сколько последних групп учитывается в перцентилях метрик
+WRITE_BATCH_METRICS_WINDOW = 1024
+
+class WriteRejected(Exception):
+    """Операция записи отклонена проверкой; маршрут отвечает message с кодом status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+class WriteBatcher:
+    """Поток-писатель с отдельным подключением, который коммитит операции группами."""
+
+    def __init__(self, pool, max_size=WRITE_BATCH_MAX_SIZE, max_delay_ms=WRITE_BATCH_MAX_DELAY_MS):
+        self.pool = pool
+        self.max_size = max_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._batches = 0
+        self._operations = 0
+        self._failed = 0
+        self._max_batch_size = 0
+        self._batch_sizes = deque(maxlen=WRITE_BATCH_METRICS_WINDOW)
+        self._commit_ms = deque(maxlen=WRITE_BATCH_METRICS_WINDOW)
+
+    def _ensure_started(self):
+        with self._lock:
+            # Поток и подключение не переживают fork, поэтому в новом процессе создаем свои
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, daemon=True, name="write-batcher").start()
+
+    def submit(self, operation):
+        """Выполняет operation(cursor) в ближайшей группе и возвращает результат после коммита."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((operation, future))
+        return future.result()
+
+    def _connect(self):
+        # Те же PRAGMA, что у подключений пула; транзакциями управляет сам писатель
+        conn = self.pool._connect()
+        conn.isolation_level = None
+        conn.execute(f"PRAGMA synchronous = {WRITE_BATCH_SYNCHRONOUS}")
+        return conn
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_size:
+            try:
+                # Сначала забираем все, что накопилось, пока шел прошлый коммит
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _execute(self, conn, batch):
+        """Выполняет группу и возвращает пары (future, result) успешных операций."""
+        done = []
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for operation, future in batch:
+            cursor.execute("SAVEPOINT write_op")
+            try:
+                result = operation(cursor)
+            except Exception as e:
+                # Ошибка одной операции не откатывает остальные операции группы
+                cursor.execute("ROLLBACK TO write_op")
+                cursor.execute("RELEASE write_op")
+                future.set_exception(e)
+                continue
+            cursor.execute("RELEASE write_op")
+            done.append((future, result))
+        started = time.perf_counter()
+        cursor.execute("COMMIT")
+        return done, (time.perf_counter() - started) * 1000
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._collect()
+            try:
+                if conn is None:
+                    conn = self._connect()
+                done, commit_ms = self._execute(conn, batch)
+            except Exception as e:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                with self._lock:
+                    self._failed += len(batch)
+                continue
+            for future, result in done:
+                future.set_result(result)
+            with self._lock:
+                self._batches += 1
+                self._operations += len(batch)
+                self._failed += len(batch) - len(done)
+                self._max_batch_size = max(self._max_batch_size, len(batch))
+                self._batch_sizes.append(len(batch))
+                self._commit_ms.append(commit_ms)
+
+    def metrics(self):
+        """Размеры групп и время коммита (перцентили по последним группам)."""
+        def percentile(values, fraction):
+            return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+        with self._lock:
+            sizes = sorted(self._batch_sizes)
+            commit_ms = sorted(self._commit_ms)
+            return {
+                "enabled": True,
+                "synchronous": WRITE_BATCH_SYNCHRONOUS,
+                "batches": self._batches,
+                "operations": self._operations,
+                "failed": self._failed,
+                "queued": self._queue.qsize(),
+                "avg_batch_size": round(self._operations / self._batches, 2) if self._batches else None,
+                "max_batch_size": self._max_batch_size,
+                "batch_size_p50": percentile(sizes, 0.5),
+                "batch_size_p99": percentile(sizes, 0.99),
+                "commit_ms_p50": round(percentile(commit_ms, 0.5), 3) if commit_ms else None,
+                "commit_ms_p99": round(percentile(commit_ms, 0.99), 3) if commit_ms else None,
+            }
+
+write_batcher = WriteBatcher(db_pool) if WRITE_BATCH_ENABLED else None
+
+def run_write(operation):
+    """
+    Выполняет operation(cursor) в транзакции и возвращает результат после коммита:
+    через write_batcher, если он включен, иначе на подключении из пула.
+    operation не должна коммитить сама; отказ по проверке — исключение WriteRejected.
+    """
+    if write_batcher is not None:
+        return write_batcher.submit(operation)
+    with db_connection() as conn:
+        result = operation(conn.cursor())
+        conn.commit()
+        return result
+
+# --- 1.3. РАСПРОДАЖА ЛИМИТИРОВАННЫХ ПОДАРКОВ (flash sale) ---
+# Лимитированный подарок (gifts.quantity > 0) резервируется условным
+# UPDATE ... WHERE quantity > 0 RETURNING quantity, поэтому продать больше остатка
+# нельзя. В режиме распродажи (VAULT_FLASH_SALE=1) покупки лимитированных подарков
+# встают в очередь одного писателя (WriteBatcher), а не соревнуются за блокировку
+# записи SQLite. Закончившийся подарок отклоняется сразу, без обращения к базе.
+
+FLASH_SALE_ENABLED = os.environ.get('VAULT_FLASH_SALE', '0') == '1'
+
+class GiftSoldOut(WriteRejected):
+    """Лимитированный подарок закончился."""
+
+    def __init__(self):
+        super().__init__("Этот подарок закончился и исчез из продажи")
+
+class SoldOutGifts:
+    """
+    Закончившиеся лимитированные подарки (в памяти процесса).
+    Остаток подарка не пополняется, поэтому отметка не снимается.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gifts = set()
+        self._rejected = 0
+
+    def mark(self, gift_id):
+        with self._lock:
+            self._gifts.add(gift_id)
+
+    def check(self, gift_id):
+        """True, если подарок уже известен как закончившийся (отказ учитывается в метриках)."""
+        if gift_id not in self._gifts:
+            return False
+        with self._lock:
+            self._rejected += 1
+        return True
+
+    def metrics(self):
+        with self._lock:
+            return {"sold_out_gifts": len(self._gifts), "fast_rejected": self._rejected}
+
+sold_out_gifts = SoldOutGifts()
+flash_sale_writer = (write_batcher or WriteBatcher(db_pool)) if FLASH_SALE_ENABLED else None
+
+def reserve_gift(cursor, gift_id):
+    """Резервирует один лимитированный подарок и возвращает остаток; GiftSoldOut, если его нет."""
+    cursor.execute("""
+        UPDATE gifts SET quantity = quantity - 1 WHERE id = ? AND quantity > 0 RETURNING quantity
+    """, (gift_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise GiftSoldOut()
+    return row[0]
+
+def is_limited_gift(gift_id):
+    """Лимитированный ли подарок (quantity не -1, в том числе уже закончившийся); из кэша."""
+    def load():
+        with db_connection() as conn:
+            row = conn.execute("SELECT quantity FROM gifts WHERE id = ?", (gift_id,)).fetchone()
+        return None if row is None else row[0] is not None and row[0] != -1
+    return bool(gift_kind_cache.get(gift_id, load))
+
+def run_purchase(gift_id, operation):
+    """
+    Как run_write, но в режиме распродажи покупка лимитированного подарка
+    выполняется писателем flash_sale_writer — по очереди, группами. Писатель выбирается
+    по виду подарка, а не по остатку: остаток проверяет только reserve_gift в самой покупке.
+    """
+    if flash_sale_writer is not None and is_limited_gift(gift_id):
+        return flash_sale_writer.submit(operation)
+    return run_write(operation)
+
+# --- 1.4. ШАРДЫ СООБЩЕНИЙ (message shards) ---
+# Сообщения (messages с полнотекстовым индексом) можно разложить по VAULT_MESSAGE_SHARDS
+# файлам SQLite рядом с основной базой; чат попадает в шард по jump consistent hash
+# от chat_id. У каждого шарда свой пул подключений, своя блокировка записи и свой
+# писатель (WriteBatcher при VAULT_WRITE_BATCHING=1), поэтому сообщения в чаты разных
+# шардов пишутся параллельно. Сводки чатов, отметки прочтения и все остальное остаются
+# в основной базе и обновляются отдельной короткой транзакцией после записи сообщения.
+# Сообщение, которому предшествует транзакция основной базы (подарок: списание монет),
+# сначала попадает в message_outbox той же транзакцией и доставляется в шард оттуда.
+# seq уникален по всем шардам: номер из счетчика шарда * число шардов + номер шарда.
+# 0 (по умолчанию) — сообщения в основной базе, запись сообщения и сводок — одна
+# транзакция. Раскладка записана в counters (message_shards) и меняется только
+# tools/rebalance_shards.py при остановленном приложении.
+
+MESSAGE_SHARD_COUNT = int(os.environ.get('VAULT_MESSAGE_SHARDS', 0))
+
+def message_shard_path(index):
+    """Файл шарда рядом с основной базой: vault_messenger.messages-0.db и т.д."""
+    root, ext = os.path.splitext(DB_NAME)
+    return f"{root}.messages-{index}{ext or '.db'}"
+
+def chat_shard_key(chat_id):
+    """64-битный ключ чата: chat_id личного чата — уже md5 hex, остальные (каналы) хэшируем."""
+    if not re.fullmatch(r"[0-9a-f]{32}", chat_id):
+        chat_id = hashlib.md5(chat_id.encode('utf-8')).hexdigest()
+    return int(chat_id[:16], 16)
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping, Veach): номер шарда от 0 до buckets - 1. При росте
+    числа шардов чаты переезжают только в новые шарды, и переезжает минимальная доля.
+    """
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def message_schema(conn):
+    """DDL сообщений из основной базы (messages, FTS, индексы, триггеры, counters) — схема шарда."""
+    return [row[0] for row in conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE sql IS NOT NULL
+          AND (name IN ('messages', 'messages_fts', 'counters')
+               OR (type IN ('index', 'trigger') AND tbl_name = 'messages'))
+        ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END, rowid
+    """)]
+
+class MessageShard:
+    """Файл с сообщениями части чатов: пул подключений и писатель."""
+
+    def __init__(self, index, stride, pool, writer):
+        self.index = index
+        self.stride = stride
+        self.pool = pool
+        self.writer = writer
+        self.is_main = pool is db_pool
+
+    def run_write(self, operation):
+        """Как run_write, но в транзакции этого шарда."""
+        if self.writer is not None:
+            return self.writer.submit(operation)
+        with db_connection(self.pool) as conn:
+            result = operation(conn.cursor())
+            conn.commit()
+            return result
+
+    @contextmanager
+    def connection(self, conn=None):
+        """Подключение к шарду; без шардов — переданное подключение conn к основной базе."""
+        if self.is_main and conn is not None:
+            yield conn
+            return
+        with db_connection(self.pool) as shard_conn:
+            yield shard_conn
+
+    def seq(self, number):
+        """seq сообщения по номеру из счетчика шарда."""
+        return number * self.stride + self.index
+
+class MessageShards:
+    """Раскладка сообщений по шардам и выбор шарда чата."""
+
+    def __init__(self, count):
+        self.count = count
+        if count:
+            pools = [ConnectionPool(message_shard_path(index), DB_POOL_SIZE) for index in range(count)]
+            self.shards = [MessageShard(index, count, pool, WriteBatcher(pool) if WRITE_BATCH_ENABLED else None)
+                           for index, pool in enumerate(pools)]
+        else:
+            self.shards = [MessageShard(0, 1, db_pool, write_batcher)]
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def for_chat(self, chat_id):
+        if not self.count:
+            return self.shards[0]
+        return self.shards[jump_hash(chat_shard_key(chat_id), self.count)]
+
+    def open(self, conn):
+        """
+        Сверяет раскладку с основной базой (conn); на новой базе создает файлы шардов.
+        Несовпадение с VAULT_MESSAGE_SHARDS — ошибка: сообщения переносит только rebalance_shards.
+        """
+        cursor = conn.cursor()
+        # Несколько процессов стартуют одновременно — проверка и запись раскладки под блокировкой
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT value FROM counters WHERE name = 'message_shards'")
+        row = cursor.fetchone()
+        if row is None:
+            # Первый запуск с шардами: в базе, где сообщения уже есть, они остаются на месте
+            cursor.execute("SELECT 1 FROM messages LIMIT 1")
+            layout = 0 if cursor.fetchone() else self.count
+            if layout:
+                # Счетчики шардов продолжают номера основной базы: отметки прочтения
+                # и сводки могли ссылаться на уже удаленные сообщения
+                cursor.execute("SELECT COALESCE(MAX(value), 0) FROM counters WHERE name = 'message_seq'")
+                start = cursor.fetchone()[0] // layout
+                schema = message_schema(conn)
+                for shard in self.shards:
+                    self._create(shard, schema, start)
+            cursor.execute("INSERT INTO counters (name, value) VALUES ('message_shards', ?)", (layout,))
+        else:
+            layout = row[0]
+        conn.commit()
+        if layout != self.count:
+            where = f"{layout} шардах" if layout else "основной базе"
+            raise RuntimeError(
+                f"Сообщения лежат в {where}, а VAULT_MESSAGE_SHARDS={self.count}: остановите приложение "
+                f"и выполните python tools/rebalance_shards.py --shards {self.count}")
+        for shard in self.shards:
+            if not shard.is_main and not os.path.exists(shard.pool.path):
+                raise RuntimeError(f"Нет файла шарда сообщений {shard.pool.path}")
+
+    def _create(self, shard, schema, start):
+        conn = sqlite3.connect(shard.pool.path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone():
+                if conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+                    raise RuntimeError(f"В файле шарда {shard.pool.path} уже есть сообщения другой базы")
+                return
+            # Режим incremental vacuum в пустой базе включается без VACUUM — до WAL и первой таблицы
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            for sql in schema:
+                conn.execute(sql)
+            conn.execute("INSERT INTO counters (name, value) VALUES ('message_seq', ?)", (start,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def metrics(self):
+        """Писатели шардов (без шардов — пусто: запись идет писателем основной базы)."""
+        if not self.count:
+            return []
+        return [{"shard": shard.index, "path": shard.pool.path,
+                 **(shard.writer.metrics() if shard.writer is not None else {"enabled": False})}
+                for shard in self.shards]
+
+message_shards = MessageShards(MESSAGE_SHARD_COUNT)
+
+# --- 2. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
+
+def get_chat_id(user_a, user_b):
+    """Генерирует уникальный ID чата путем сортировки ID пользователей."""
+    return hashlib.md5(json.dumps(sorted([user_a, user_b])).encode('utf-8')).hexdigest()
+
+# Размер страницы истории по умолчанию и максимально допустимый
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def next_message_seq(cursor, chat_id):
+    """Выдает следующий номер сообщения чата (в той же транзакции шарда, что и вставка)."""
+    cursor.execute("UPDATE counters SET value = value + 1 WHERE name = 'message_seq' RETURNING value")
+    return message_shards.for_chat(chat_id).seq(cursor.fetchone()[0])
+
+def store_message(cursor, chat_id, sender_id, text, gift_id=None, pending=None):
+    """
+    Сохраняет сообщение с новым seq и возвращает его данные. cursor — шарда чата
+    (см. run_message_write). pending — строка message_outbox: uuid и время уже выданы,
+    и повторная доставка возвращает записанное сообщение, а не создает копию.
+    Коммит делает вызывающий код.
+    """
+    if pending is not None:
+        cursor.execute("SELECT seq FROM messages WHERE uuid = ?", (pending["uuid"],))
+        row = cursor.fetchone()
+        message_uuid, timestamp, created_at = pending["uuid"], pending["timestamp"], pending["created_at"]
+    else:
+        row = None
+        now = datetime.now()
+        message_uuid, timestamp, created_at = str(uuid.uuid4()), now.strftime("%H:%M"), now.isoformat(timespec='seconds')
+    message = {
+        "uuid": message_uuid,
+        "seq": row["seq"] if row else next_message_seq(cursor, chat_id),
+        "sender_id": sender_id,
+        "text": text,
+        "timestamp": timestamp,
+        "created_at": created_at
+    }
+    if gift_id:
+        message["gift_id"] = gift_id
+    if row:
+        return message
+    cursor.execute("""
+        INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, gift_id, is_read, seq, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)
+    """, (message["uuid"], chat_id, sender_id, text, message["timestamp"], gift_id,
+          message["seq"], message["created_at"]))
+    return message
+
+def finish_message(cursor, chat_id, sender_id, receiver_id, message):
+    """Основная база после нового сообщения: состояние канала или chat_partners и сводки личного чата."""
+    if chat_id.startswith("channel_"):
+        update_channel_state(cursor, receiver_id, message)
+        return
+    cursor.execute("""
+        INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
+        VALUES (?, ?, ?)
+    """, (sender_id, receiver_id, chat_id))
+    cursor.execute("""
+        INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id)
+        VALUES (?, ?, ?)
+    """, (receiver_id, sender_id, chat_id))
+    update_chat_summaries(cursor, chat_id, message, [(sender_id, receiver_id), (receiver_id, sender_id)])
+
+def queue_outbox_message(cursor, chat_id, sender_id, receiver_id, text, gift_id):
+    """Принимает сообщение в message_outbox (cursor — основная база); возвращает строку outbox."""
+    now = datetime.now()
+    pending = {"uuid": str(uuid.uuid4()), "chat_id": chat_id, "sender_id": sender_id,
+               "receiver_id": receiver_id, "text": text, "gift_id": gift_id,
+               "timestamp": now.strftime("%H:%M"), "created_at": now.isoformat(timespec='seconds')}
+    cursor.execute("""
+        INSERT INTO message_outbox (uuid, chat_id, sender_id, receiver_id, text, gift_id, timestamp, created_at)
+        VALUES (:uuid, :chat_id, :sender_id, :receiver_id, :text, :gift_id, :timestamp, :created_at)
+    """, pending)
+    return pending
+
+def deliver_outbox_message(pending):
+    """
+    Записывает сообщение из message_outbox в шард чата, затем сводки и удаление из outbox —
+    одной транзакцией основной базы, так что сводки обновятся ровно один раз.
+    """
+    chat_id = pending["chat_id"]
+    message = message_shards.for_chat(chat_id).run_write(lambda cursor: store_message(
+        cursor, chat_id, pending["sender_id"], pending["text"], pending["gift_id"], pending=pending))
+
+    def finish(cursor):
+        cursor.execute("DELETE FROM message_outbox WHERE uuid = ?", (pending["uuid"],))
+        # Строки уже нет — сообщение доставил параллельный повтор (задача message_outbox)
+        if cursor.rowcount:
+            finish_message(cursor, chat_id, pending["sender_id"], pending["receiver_id"], message)
+        return cursor.rowcount
+
+    # Подписчикам сообщает тот, кто завершил доставку: запрос или задача message_outbox
+    if run_write(finish):
+        publish_new_message(chat_id, pending["sender_id"], pending["receiver_id"], message)
+    return message
+
+def pending_outbox_message(pending):
+    """Принятое, но еще не доставленное в шард сообщение для ответа клиенту: seq пока нет."""
+    message = {key: pending[key] for key in ("uuid", "sender_id", "text", "timestamp", "created_at")}
+    message.update(seq=None, pending=True)
+    if pending["gift_id"]:
+        message["gift_id"] = pending["gift_id"]
+    return message
+
+def run_message_write(chat_id, sender_id, receiver_id, text=None, prepare=None, run=None):
+    """
+    Сохраняет сообщение sender_id в чат chat_id (receiver_id — собеседник или канал) вместе
+    с изменениями основной базы и рассылает его подписчикам; возвращает (message, context).
+    prepare(cursor) — проверки и списания до сообщения (отказ — WriteRejected), возвращает
+    (text, gift_id, context); без prepare сохраняется text. run — как выполнить prepare
+    (по умолчанию run_write).
+    Без шардов все это одна транзакция. С шардами сообщение пишет шард чата, не занимая
+    блокировку основной базы, а сводки — отдельная транзакция основной базы. Если есть
+    prepare, сообщение принимается в message_outbox в его же транзакции. Сбой после нее —
+    уже не отказ: списание состоялось, и ошибка клиенту привела бы к повторной оплате.
+    Тогда возвращается принятое сообщение с seq = None и pending = True, а доставит
+    и разошлет его задача message_outbox (или следующий запуск).
+    """
+    run = run or run_write
+    shard = message_shards.for_chat(chat_id)
+    if shard.is_main:
+        def write(cursor):
+            message_text, gift_id, context = prepare(cursor) if prepare else (text, None, None)
+            message = store_message(cursor, chat_id, sender_id, message_text, gift_id)
+            finish_message(cursor, chat_id, sender_id, receiver_id, message)
+            return message, context
+        message, context = run(write)
+        publish_new_message(chat_id, sender_id, receiver_id, message)
+        return message, context
+    if prepare is None:
+        # Обычному сообщению до записи в шард основная база не нужна; при сбое между
+        # транзакциями сообщение есть в шарде, а превью чата обновит следующее сообщение
+        message = shard.run_write(lambda cursor: store_message(cursor, chat_id, sender_id, text))
+        run_write(lambda cursor: finish_message(cursor, chat_id, sender_id, receiver_id, message))
+        publish_new_message(chat_id, sender_id, receiver_id, message)
+        return message, None
+
+    def accept(cursor):
+        message_text, gift_id, context = prepare(cursor)
+        return queue_outbox_message(cursor, chat_id, sender_id, receiver_id, message_text, gift_id), context
+
+    pending, context = run(accept)
+    try:
+        return deliver_outbox_message(pending), context
+    except Exception as e:
+        print(f"Ошибка доставки сообщения {pending['uuid']} в шард, доставит задача message_outbox: {e}")
+        try:
+            job_queue.enqueue("message_outbox", {}, delay=JOB_RETRY_BASE_SECONDS)
+        except Exception as e:
+            print(f"Ошибка постановки доставки сообщений: {e}")
+        return pending_outbox_message(pending), context
+
+def message_row_to_dict(row):
+    """Формат сообщения в ответах history и в push-событиях."""
+    message_data = {
+        "uuid": row["uuid"],
+        "seq": row["seq"],
+        "sender": row["sender_id"],
+        "text": row["text"],
+        "timestamp": row["timestamp"],
+        "created_at": row["created_at"],
+        "is_read": bool(row["is_read"])
+    }
+    if row["gift_id"]:
+        message_data["gift_id"] = row["gift_id"]
+        message_data["is_gift"] = True
+    return message_data
+
+# Поиск: сколько имен отдавать и размер страницы найденных сообщений
+SEARCH_NAMES_LIMIT = 50
+SEARCH_MESSAGES_PAGE_SIZE = 20
+SEARCH_MESSAGES_MAX_PAGE_SIZE = 100
+
+def fts_prefix_query(term):
+    """
+    Строит запрос FTS5 из пользовательского ввода: каждое слово в кавычках и как префикс,
+    чтобы операторы и спецсимволы FTS5 из ввода не интерпретировались.
+    Возвращает None, если в вводе нет ни одного слова.
+    """
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+# Длина превью последнего сообщения в списке чатов
+CHAT_PREVIEW_LENGTH = 100
+
+def update_chat_summaries(cursor, chat_id, message, members):
+    """
+    Обновляет сводки чата после нового сообщения.
+    members — пары (user_id, partner_id); у всех, кроме отправителя, растет счетчик непрочитанных.
+    С шардами сводки двух сообщений чата могут прийти не по порядку seq — последним
+    остается сообщение с большим seq.
+    """
+    preview = message["text"][:CHAT_PREVIEW_LENGTH]
+    cursor.executemany("""
+        INSERT INTO chat_summaries
+            (user_id, chat_id, partner_id, last_seq, last_preview, last_sender_id, last_at, unread_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET
+            last_seq = MAX(chat_summaries.last_seq, excluded.last_seq),
+            last_preview = CASE WHEN excluded.last_seq > chat_summaries.last_seq
+                                THEN excluded.last_preview ELSE chat_summaries.last_preview END,
+            last_sender_id = CASE WHEN excluded.last_seq > chat_summaries.last_seq
+                                  THEN excluded.last_sender_id ELSE chat_summaries.last_sender_id END,
+            last_at = CASE WHEN excluded.last_seq > chat_summaries.last_seq
+                           THEN excluded.last_at ELSE chat_summaries.last_at END,
+            unread_count = chat_summaries.unread_count + excluded.unread_count
+    """, [(user_id, chat_id, partner_id, message["seq"], preview, message["sender_id"],
+           message["created_at"], 0 if user_id == message["sender_id"] else 1)
+          for user_id, partner_id in members])
+
+def update_channel_state(cursor, room_id, message):
+    """
+    Новый пост канала: одна запись в channel_state независимо от числа подписчиков.
+    Свои посты отправитель сразу считает прочитанными.
+    """
+    cursor.execute("""
+        INSERT INTO channel_state (room_id, last_seq, last_preview, last_sender_id, last_at, post_count)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT (room_id) DO UPDATE SET
+            last_seq = MAX(channel_state.last_seq, excluded.last_seq),
+            last_preview = CASE WHEN excluded.last_seq > channel_state.last_seq
+                                THEN excluded.last_preview ELSE channel_state.last_preview END,
+            last_sender_id = CASE WHEN excluded.last_seq > channel_state.last_seq
+                                  THEN excluded.last_sender_id ELSE channel_state.last_sender_id END,
+            last_at = CASE WHEN excluded.last_seq > channel_state.last_seq
+                           THEN excluded.last_at ELSE channel_state.last_at END,
+            post_count = channel_state.post_count + 1
+    """, (room_id, message["seq"], message["text"][:CHAT_PREVIEW_LENGTH],
+          message["sender_id"], message["created_at"]))
+    mark_channel_read(cursor, room_id, message["sender_id"])
+
+def mark_channel_read(cursor, room_id, user_id):
+    """Отмечает все посты канала прочитанными подписчиком (и при подписке — старые посты)."""
+    cursor.execute("""
+        UPDATE room_members
+        SET read_count = (SELECT post_count FROM channel_state WHERE room_id = ?)
+        WHERE room_id = ? AND user_id = ?
+    """, (room_id, room_id, user_id))
+
+def last_chat_message(cursor, chat_id):
+    """Последнее живое сообщение чата (cursor — шарда чата) или None."""
+    cursor.execute("""
+        SELECT seq, text, sender_id, created_at FROM messages
+        WHERE chat_id = ? ORDER BY seq DESC LIMIT 1
+    """, (chat_id,))
+    return cursor.fetchone()
+
+def refresh_chat_summaries_after_delete(cursor, deleted, last):
+    """После удаления сообщения убирает его из непрочитанных и из превью (last — новое последнее)."""
+    chat_id = deleted["chat_id"]
+    # В каналах post_count не уменьшается: удаленный пост остается в счетчике до прочтения
+    if not chat_id.startswith("channel_"):
+        # Непрочитанным сообщение было у тех, чья отметка прочтения ниже его seq
+        cursor.execute("""
+            UPDATE chat_summaries SET unread_count = unread_count - 1
+            WHERE chat_id = ? AND user_id != ? AND unread_count > 0
+              AND ? > COALESCE((SELECT read_seq FROM chat_reads r
+                                WHERE r.user_id = chat_summaries.user_id
+                                  AND r.chat_id = chat_summaries.chat_id), 0)
+        """, (chat_id, deleted["sender_id"], deleted["seq"]))
+    if chat_id.startswith("channel_"):
+        table, key_column, key = "channel_state", "room_id", chat_id[len("channel_"):]
+    else:
+        table, key_column, key = "chat_summaries", "chat_id", chat_id
+    cursor.execute(f"""
+        UPDATE {table}
+        SET last_seq = ?, last_preview = ?, last_sender_id = ?, last_at = COALESCE(?, last_at)
+        WHERE {key_column} = ? AND last_seq = ?
+    """, (last["seq"] if last else 0,
+          last["text"][:CHAT_PREVIEW_LENGTH] if last else None,
+          last["sender_id"] if last else None,
+          last["created_at"] if last else None,
+          key, deleted["seq"]))
+
+# --- 2.1. ХРАНИЛИЩЕ КАРТИНОК (media) ---
+# Картинки хранятся файлами в MEDIA_DIR под именем sha256 содержимого, а в таблицах
+# вместо base64 лежит URL вида /media/<hash>. Файлы неизменяемы, поэтому
+# клиенты кэшируют их навсегда и не скачивают повторно при каждом запросе.
+
+MEDIA_URL_PREFIX = "/media/"
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600
+MEDIA_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?(;[\w-]+=[\w-]+)*;base64,", re.IGNORECASE)
+
+def media_path(media_hash):
+    return os.path.join(MEDIA_DIR, media_hash[:2], media_hash)
+
+def store_media(cursor, data, mime):
+    """Сохраняет файл (если его еще нет) и возвращает его hash."""
+    media_hash = hashlib.sha256(data).hexdigest()
+    path = media_path(media_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    cursor.execute("""
+        INSERT OR IGNORE INTO media (hash, mime, size, created_at)
+        VALUES (?, ?, ?, ?)
+    """, (media_hash, mime, len(data), datetime.now().isoformat(timespec='seconds')))
+    return media_hash
+
+def store_data_url(cursor, value):
+    """
+    Если value — data:...;base64 URL, сохраняет картинку в хранилище и возвращает /media/<hash>.
+    Остальные значения (эмодзи, пустая строка, готовый URL) возвращаются как есть.
+    """
+    if not isinstance(value, str):
+        return value
+    match = DATA_URL_RE.match(value)
+    if not match:
+        return value
+    data = base64.b64decode(value[match.end():])
+    mime = (match.group(1) or "application/octet-stream").lower()
+    return MEDIA_URL_PREFIX + store_media(cursor, data, mime)
+
+# Тип файла по hash: файлы неизменяемы, поэтому кэшируем без инвалидации
+_media_mime_cache = {}
+
+@app.route('/media/<media_hash>', methods=['GET'])
+def get_media(media_hash):
+    """Отдает картинку из хранилища (ETag, Range, неизменяемый кэш)."""
+    if not MEDIA_HASH_RE.match(media_hash):
+        abort(404)
+    mime = _media_mime_cache.get(media_hash)
+    if mime is None:
+        with db_connection() as conn:
+            row = conn.execute("SELECT mime FROM media WHERE hash = ?", (media_hash,)).fetchone()
+        if not row:
+            abort(404)
+        mime = _media_mime_cache[media_hash] = row["mime"]
+    path = media_path(media_hash)
+    if not os.path.exists(path):
+        abort(404)
+    response = send_file(path, mimetype=mime, conditional=True, etag=media_hash,
+                         max_age=MEDIA_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# --- 2.2. УМЕНЬШЕННЫЕ КОПИИ АВАТАРОВ ---
+# Аватар декодируется один раз, из него делаются WebP-копии фиксированных размеров.
+# Работа идет в фоновом пуле потоков, чтобы загрузка не блокировала обработчик запроса.
+# В ответах API отдается самая маленькая копия, которая не меньше нужного размера.
+
+RENDITION_SIZES = (512, 128, 48)
+RENDITION_WEBP_QUALITY = 82
+# Как долго помнить, что у картинки еще нет копий (они могут появиться позже)
+RENDITION_MISS_TTL_SECONDS = 60
+
+rendition_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="renditions")
+_renditions_cache = {}
+_renditions_lock = threading.Lock()
+
+def generate_renditions(media_hash):
+    """Создает WebP-копии картинки (выполняется в rendition_executor)."""
+    try:
+        with Image.open(media_path(media_hash)) as img:
+            img.load()
+            image = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+        created = {}
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            # От большего размера к меньшему: каждая копия уменьшается из предыдущей
+            for size in RENDITION_SIZES:
+                if max(image.size) <= size:
+                    continue
+                image.thumbnail((size, size), Image.LANCZOS)
+                buffer = io.BytesIO()
+                image.save(buffer, format="WEBP", quality=RENDITION_WEBP_QUALITY)
+                created[size] = store_media(cursor, buffer.getvalue(), "image/webp")
+                cursor.execute("""
+                    INSERT OR REPLACE INTO media_renditions (source_hash, size, hash)
+                    VALUES (?, ?, ?)
+                """, (media_hash, size, created[size]))
+            conn.commit()
+        with _renditions_lock:
+            _renditions_cache[media_hash] = (time.monotonic(), created)
+    except Exception as e:
+        print(f"Ошибка создания копий картинки {media_hash}: {e}")
+
+def schedule_renditions(url):
+    """Ставит в очередь создание копий для картинки /media/<hash>."""
+    if Image is None or not isinstance(url, str) or not url.startswith(MEDIA_URL_PREFIX):
+        return
+    rendition_executor.submit(generate_renditions, url[len(MEDIA_URL_PREFIX):])
+
+def schedule_missing_renditions():
+    """Создает копии для уже загруженных аватаров, у которых их еще нет."""
+    if Image is None:
+        return
+    with db_connection() as conn:
+        rows = conn.execute("""
+            SELECT DISTINCT avatarBase64 AS url FROM (
+                SELECT avatarBase64 FROM users UNION ALL SELECT avatarBase64 FROM rooms
+            )
+            WHERE avatarBase64 LIKE '/media/%'
+              AND substr(avatarBase64, 8) NOT IN (SELECT source_hash FROM media_renditions)
+        """).fetchall()
+    for row in rows:
+        schedule_renditions(row["url"])
+
+def get_renditions(media_hash):
+    now = time.monotonic()
+    with _renditions_lock:
+        cached = _renditions_cache.get(media_hash)
+    if cached and (cached[1] or now - cached[0] < RENDITION_MISS_TTL_SECONDS):
+        return cached[1]
+    with db_connection() as conn:
+        rows = conn.execute("SELECT size, hash FROM media_renditions WHERE source_hash = ?",
+                            (media_hash,)).fetchall()
+    renditions = {row["size"]: row["hash"] for row in rows}
+    with _renditions_lock:
+        _renditions_cache[media_hash] = (now, renditions)
+    return renditions
+
+def avatar_url(url, size):
+    """URL самой маленькой копии аватара, которая не меньше size (или оригинала)."""
+    if not isinstance(url, str) or not url.startswith(MEDIA_URL_PREFIX):
+        return url
+    renditions = get_renditions(url[len(MEDIA_URL_PREFIX):])
+    fitting = [s for s in renditions if s >= size]
+    if not fitting:
+        return url
+    return MEDIA_URL_PREFIX + renditions[min(fitting)]
+
+def with_avatar_size(rows, size):
+    """Подставляет в словари ответа аватар нужного размера."""
+    for row in rows:
+        if row.get("avatarBase64"):
+            row["avatarBase64"] = avatar_url(row["avatarBase64"], size)
+    return rows
+
+# --- 2.3. PUSH-ДОСТАВКА СОБЫТИЙ (in-process pub/sub) ---
+
+# Как часто отправлять keepalive в SSE-поток, если новых событий нет
+STREAM_KEEPALIVE_SECONDS = 15
+
+class Subscription:
+    """Одно открытое SSE-подключение пользователя."""
+
+    def __init__(self, user_id, max_queue):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.topics = set()
+        self.overflowed = False
+
+class MessageBus:
+    """
+    Простая pub/sub шина внутри процесса.
+    Топики: "user:<user_id>" для личных чатов, "room:<room_id>" для каналов
+    и "presence:<user_id>" для статуса онлайн.
+    """
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._by_topic = {}
+        self._by_user = {}
+
+    def subscribe(self, user_id, topics):
+        sub = Subscription(user_id, self.max_queue)
+        with self._lock:
+            self._by_user.setdefault(user_id, set()).add(sub)
+            for topic in topics:
+                sub.topics.add(topic)
+                self._by_topic.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._by_topic.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._by_topic[topic]
+            user_subs = self._by_user.get(sub.user_id)
+            if user_subs is not None:
+                user_subs.discard(sub)
+                if not user_subs:
+                    del self._by_user[sub.user_id]
+
+    def add_topic(self, user_id, topic):
+        """Подписывает все открытые подключения пользователя на новый топик (например, после join)."""
+        with self._lock:
+            for sub in self._by_user.get(user_id, ()):
+                sub.topics.add(topic)
+                self._by_topic.setdefault(topic, set()).add(sub)
+
+    def remove_topic(self, user_id, topic):
+        with self._lock:
+            subs = self._by_topic.get(topic)
+            for sub in self._by_user.get(user_id, ()):
+                sub.topics.discard(topic)
+                if subs is not None:
+                    subs.discard(sub)
+            if subs is not None and not subs:
+                del self._by_topic[topic]
+
+    def replace_topics(self, user_id, prefix, topics):
+        """Заменяет топики с префиксом prefix у всех подключений пользователя на topics."""
+        topics = set(topics)
+        with self._lock:
+            for sub in self._by_user.get(user_id, ()):
+                for topic in [topic for topic in sub.topics if topic.startswith(prefix) and topic not in topics]:
+                    sub.topics.discard(topic)
+                    subs = self._by_topic.get(topic)
+                    if subs is not None:
+                        subs.discard(sub)
+                        if not subs:
+                            del self._by_topic[topic]
+                for topic in topics:
+                    sub.topics.add(topic)
+                    self._by_topic.setdefault(topic, set()).add(sub)
+
+    def publish(self, topic, event):
+        with self._lock:
+            subs = list(self._by_topic.get(topic, ()))
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                # Медленный клиент: закрываем поток, после переподключения он догрузит историю сам
+                sub.overflowed = True
+
+message_bus = MessageBus()
+
+def publish_new_message(chat_id, sender_id, receiver_id, message):
+    """Рассылает только что закоммиченное сообщение подписчикам чата (в канале receiver_id — комната)."""
+    room_id = receiver_id if chat_id.startswith("channel_") else None
+    payload = message_row_to_dict({
+        "uuid": message["uuid"],
+        "seq": message["seq"],
+        "sender_id": sender_id,
+        "text": message["text"],
+        "timestamp": message["timestamp"],
+        "created_at": message["created_at"],
+        "gift_id": message.get("gift_id"),
+        "is_read": 0
+    })
+    event = {
+        "type": "new_message",
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "room_id": room_id,
+        "message": payload
+    }
+    if room_id:
+        message_bus.publish(f"room:{room_id}", event)
+    else:
+        for user_id in {sender_id, receiver_id}:
+            message_bus.publish(f"user:{user_id}", event)
+
+# --- 2.4. ПОДСКАЗКИ ПОИСКА (typeahead) ---
+# В памяти держится отсортированный список ключей "слово\0kind\0id" по ID пользователя
+# и словам имени. Поиск по префиксу — bisect и короткий проход вперед, без запросов к базе.
+# Индекс загружается при первом запросе и дальше обновляется точечно при изменении имен.
+
+TYPEAHEAD_MAX_RESULTS = 10
+TYPEAHEAD_CACHE_SIZE = 512
+# Сколько первых слов имени попадает в индекс (остальные проверяются фильтром)
+TYPEAHEAD_NAME_WORDS = 4
+# Предел просмотренных ключей на один запрос (для очень коротких префиксов)
+TYPEAHEAD_SCAN_LIMIT = 2000
+
+class TypeaheadIndex:
+    """Префиксный индекс пользователей и каналов с LRU-кэшем последних запросов."""
+
+    def __init__(self, cache_size=TYPEAHEAD_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._entries = {}
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tokens(query):
+        return [token.lstrip("@") for token in (query or "").lower().split() if token.lstrip("@")]
+
+    def _set_entry(self, kind, ref_id, display_name, avatar, email_hash):
+        words = re.findall(r"\w+", (display_name or "").lower())
+        indexed = words[:TYPEAHEAD_NAME_WORDS]
+        if kind == "user":
+            words.append(ref_id.lower())
+            indexed.append(ref_id.lower())
+        entry = {"displayName": display_name or "", "avatar": avatar or "",
+                 "emailHash": email_hash or "", "words": words,
+                 "keys": {f"{word}\0{kind}\0{ref_id}" for word in indexed}}
+        self._entries[(kind, ref_id)] = entry
+        return entry
+
+    def _load(self, rows):
+        self._entries = {}
+        keys = []
+        for kind, ref_id, display_name, avatar, email_hash in rows:
+            keys.extend(self._set_entry(kind, ref_id, display_name, avatar, email_hash)["keys"])
+        keys.sort()
+        self._keys = keys
+        self._cache.clear()
+        self._loaded = True
+
+    def load(self, rows):
+        """Полная загрузка: rows — кортежи (kind, id, displayName, avatar, emailHash)."""
+        with self._lock:
+            self._load(rows)
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        # Читаем базу под блокировкой: put() после коммита либо дождется загрузки,
+        # либо его изменение уже попадет в SELECT
+        with self._lock:
+            if self._loaded:
+                return
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 'user', id, displayName, avatarBase64, emailHash FROM users")
+                rows = cursor.fetchall()
+                cursor.execute("""
+                    SELECT 'channel', id, name, avatarBase64, '' FROM rooms WHERE type = 'channel'
+                """)
+                rows += cursor.fetchall()
+            self._load(tuple(row) for row in rows)
+
+    def put(self, kind, ref_id, display_name=None, avatar=None, email_hash=None):
+        """
+        Добавляет или обновляет запись после коммита. None — оставить прежнее значение.
+        Пока индекс не загружен, ничего не делает: загрузка прочитает данные из базы.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            old = self._entries.get((kind, ref_id))
+            old_keys = old["keys"] if old else set()
+            if old:
+                display_name = old["displayName"] if display_name is None else display_name
+                avatar = old["avatar"] if avatar is None else avatar
+                email_hash = old["emailHash"] if email_hash is None else email_hash
+            new_keys = self._set_entry(kind, ref_id, display_name, avatar, email_hash)["keys"]
+            for key in old_keys - new_keys:
+                index = bisect.bisect_left(self._keys, key)
+                if index < len(self._keys) and self._keys[index] == key:
+                    del self._keys[index]
+            for key in new_keys - old_keys:
+                bisect.insort(self._keys, key)
+            # Сбрасываем только закэшированные запросы, которые могли задеть эти ключи
+            changed = [key.split("\0", 1)[0] for key in old_keys ^ new_keys]
+            for cache_key in list(self._cache):
+                first = cache_key.split(" ", 1)[0]
+                if any(word.startswith(first) for word in changed):
+                    del self._cache[cache_key]
+
+    def _scan(self, tokens):
+        first, rest = tokens[0], tokens[1:]
+        refs = []
+        seen = set()
+        index = bisect.bisect_left(self._keys, first)
+        end = min(len(self._keys), index + TYPEAHEAD_SCAN_LIMIT)
+        while index < end and len(refs) <= TYPEAHEAD_MAX_RESULTS:
+            key = self._keys[index]
+            index += 1
+            if not key.startswith(first):
+                break
+            _, kind, ref_id = key.split("\0")
+            ref = (kind, ref_id)
+            if ref in seen:
+                continue
+            seen.add(ref)
+            words = self._entries[ref]["words"]
+            if all(any(word.startswith(token) for word in words) for token in rest):
+                refs.append(ref)
+        return refs
+
+    def lookup(self, query, limit=TYPEAHEAD_MAX_RESULTS, exclude=None):
+        """До limit записей, у которых ID или слова имени начинаются со слов запроса."""
+        tokens = self._tokens(query)
+        if not tokens:
+            return []
+        self.ensure_loaded()
+        cache_key = " ".join(tokens)
+        with self._lock:
+            refs = self._cache.get(cache_key)
+            if refs is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                # Храним на одну запись больше, чтобы исключение себя не укорачивало выдачу
+                refs = self._cache[cache_key] = self._scan(tokens)
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            results = []
+            for kind, ref_id in refs:
+                if len(results) >= limit:
+                    break
+                if kind == "user" and ref_id == exclude:
+                    continue
+                entry = self._entries[(kind, ref_id)]
+                results.append({"id": ref_id, "kind": kind, "displayName": entry["displayName"],
+                                "avatar": entry["avatar"], "emailHash": entry["emailHash"]})
+        for result in results:
+            # Отдаем только hash картинки (самой маленькой подходящей копии)
+            url = avatar_url(result["avatar"], 48)
+            result["avatar"] = url[len(MEDIA_URL_PREFIX):] if url and url.startswith(MEDIA_URL_PREFIX) else None
+        return results
+
+typeahead_index = TypeaheadIndex()
+
+# --- 2.5. ФОНОВЫЕ ЗАДАЧИ (jobs) ---
+# Долгая работа (массовые правки, обслуживание базы) не выполняется в обработчике запроса:
+# маршрут кладет задачу в таблицу jobs и сразу отвечает, а ограниченный пул потоков
+# выполняет ее короткими транзакциями. Задача в базе переживает перезапуск процесса:
+# взятая задача арендуется на JOB_LEASE_SECONDS, и после падения ее подхватит другой воркер.
+
+JOB_WORKERS = 2
+# Сколько задач может ждать в очереди; сверх этого маршруты получают 503
+JOB_MAX_QUEUED = 1000
+JOB_MAX_ATTEMPTS = 3
+# Пауза перед повтором: JOB_RETRY_BASE_SECONDS * 2^(попытка - 1)
+JOB_RETRY_BASE_SECONDS = 2
+JOB_LEASE_SECONDS = 300
+# Как часто свободный воркер проверяет базу (задачи других процессов и отложенные повторы)
+JOB_POLL_SECONDS = 1
+# Сколько хранятся завершенные задачи (для /api/jobs/<id>)
+JOB_RETENTION_SECONDS = 24 * 3600
+# Размер пачки для задач, которые обрабатывают много строк
+JOB_BATCH_SIZE = 500
+
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Регистрирует обработчик задач вида kind: handler(job_id, payload) -> result (JSON)."""
+    def register(handler):
+        JOB_HANDLERS[kind] = handler
+        return handler
+    return register
+
+class JobQueueFullError(Exception):
+    """В очереди уже JOB_MAX_QUEUED задач."""
+
+class JobQueue:
+    """Очередь задач в SQLite и пул потоков, который их выполняет."""
+
+    def __init__(self, workers):
+        self._workers = workers
+        self._cond = threading.Condition()
+        self._pid = None
+        self._last_cleanup = 0
+
+    def start(self):
+        """Запускает потоки (один раз на процесс; после fork — заново)."""
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for number in range(self._workers):
+                threading.Thread(target=self._run, daemon=True, name=f"jobs-{number}").start()
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify()
+
+    def enqueue(self, kind, payload, cursor=None, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
+        """
+        Ставит задачу в очередь и возвращает ее ID. С cursor задача пишется в транзакции
+        вызывающего кода (появится только вместе с его коммитом), и после коммита нужно
+        вызвать wake(); без cursor — в своей транзакции. delay — через сколько секунд
+        задачу можно брать (для периодических задач).
+        """
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Неизвестный вид задачи: {kind}")
+        if cursor is None:
+            with db_connection() as conn:
+                job_id = self.enqueue(kind, payload, conn.cursor(), max_attempts, delay)
+                conn.commit()
+            self.wake()
+            return job_id
+        cursor.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'")
+        if cursor.fetchone()[0] >= JOB_MAX_QUEUED:
+            raise JobQueueFullError(kind)
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat(timespec='seconds')
+        cursor.execute("""
+            INSERT INTO jobs (id, kind, payload, status, attempts, max_attempts,
+                              run_after, created_at, updated_at)
+            VALUES (?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+        """, (job_id, kind, json.dumps(payload, ensure_ascii=False), max_attempts,
+              time.time() + delay if delay else 0, now, now))
+        self.start()
+        return job_id
+
+    def get(self, job_id):
+        with db_connection() as conn:
+            row = conn.execute("""
+                SELECT id, kind, status, attempts, max_attempts, result, error, created_at, updated_at
+                FROM jobs WHERE id = ?
+            """, (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def progress(self, job_id, result):
+        """Промежуточный результат долгой задачи; заодно продлевает аренду."""
+        with db_connection() as conn:
+            conn.execute("""
+                UPDATE jobs SET result = ?, locked_until = ?, updated_at = ?
+                WHERE id = ? AND status = 'running'
+            """, (json.dumps(result, ensure_ascii=False), time.time() + JOB_LEASE_SECONDS,
+                  datetime.now().isoformat(timespec='seconds'), job_id))
+            conn.commit()
+
+    def _claim(self):
+        """Атомарно берет следующую задачу: ожидающую или брошенную упавшим воркером."""
+        now = time.time()
+        with db_connection() as conn:
+            row = conn.execute("""
+                UPDATE jobs
+                SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE (status = 'queued' AND run_after <= ?)
+                       OR (status = 'running' AND locked_until < ?)
+                    ORDER BY run_after, created_at
+                    LIMIT 1
+                )
+                RETURNING id, kind, payload, attempts, max_attempts
+            """, (now + JOB_LEASE_SECONDS, datetime.now().isoformat(timespec='seconds'),
+                  now, now)).fetchone()
+            conn.commit()
+        return row
+
+    def _finish(self, job, result=None, error=None):
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        with db_connection() as conn:
+            if error is None:
+                conn.execute("""
+                    UPDATE jobs SET status = 'done', result = ?, error = NULL, updated_at = ?
+                    WHERE id = ?
+                """, (json.dumps(result, ensure_ascii=False), updated_at, job["id"]))
+            elif job["attempts"] < job["max_attempts"]:
+                delay = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+                conn.execute("""
+                    UPDATE jobs SET status = 'queued', run_after = ?, error = ?, updated_at = ?
+                    WHERE id = ?
+                """, (time.time() + delay, error, updated_at, job["id"]))
+            else:
+                conn.execute("""
+                    UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?
+                """, (error, updated_at, job["id"]))
+            conn.commit()
+
+    def _cleanup(self):
+        if time.monotonic() - self._last_cleanup < JOB_POLL_SECONDS * 60:
+            return
+        self._last_cleanup = time.monotonic()
+        cutoff = datetime.fromtimestamp(time.time() - JOB_RETENTION_SECONDS).isoformat(timespec='seconds')
+        with db_connection() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+            conn.commit()
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._cleanup()
+                    with self._cond:
+                        self._cond.wait(JOB_POLL_SECONDS)
+                    continue
+            except Exception as e:
+                print(f"Ошибка очереди задач: {e}")
+                time.sleep(JOB_POLL_SECONDS)
+                continue
+            try:
+                result = JOB_HANDLERS[job["kind"]](job["id"], json.loads(job["payload"]))
+                self._finish(job, result=result)
+            except Exception as e:
+                print(f"Ошибка задачи {job['kind']} {job['id']} (попытка {job['attempts']}): {e}")
+                self._finish(job, error=str(e))
+
+job_queue = JobQueue(JOB_WORKERS)
+
+@job_handler("message_outbox")
+def run_message_outbox_job(job_id, payload):
+    """Доставляет в шарды сообщения, оставшиеся в message_outbox после сбоя доставки."""
+    with db_connection() as conn:
+        pending = [dict(row) for row in conn.execute("SELECT * FROM message_outbox ORDER BY created_at")]
+    for row in pending:
+        deliver_outbox_message(row)
+    return {"delivered": len(pending)}
+
+@job_handler("vacuum")
+def run_vacuum_job(job_id, payload):
+    """Сжатие базы после миграций (VACUUM берет блокировку записи на все время работы)."""
+    with db_connection() as conn:
+        # Режим auto_vacuum у существующей базы меняется только VACUUM на том же подключении
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    return {"vacuumed": True}
+
+# --- 2.6. КЭШ ЧТЕНИЯ (read-through) ---
+# Часто читаемые и редко меняющиеся данные (каталог подарков, строки пользователей,
+# витрина подарков в профиле) кэшируются в памяти процесса. Маршруты, которые их меняют,
+# сбрасывают свои ключи после коммита; TTL ограничивает устаревание в других процессах.
+
+GIFT_CATALOG_TTL_SECONDS = 60
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_SIZE = 10000
+MARKET_FLOOR_TTL_SECONDS = 30
+MARKET_FLOOR_CACHE_SIZE = 10000
+ARCHIVE_BLOCK_CACHE_SIZE = 256
+ARCHIVE_BLOCK_CACHE_TTL_SECONDS = 600
+# Вид подарка (лимитированный или нет) задается при создании и не меняется
+GIFT_KIND_CACHE_SIZE = 10000
+GIFT_KIND_TTL_SECONDS = 3600
+
+class ReadThroughCache:
+    """LRU-кэш с TTL: get(key, loader) при промахе вызывает loader() и запоминает результат."""
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Меняется при каждом сбросе: значение, загруженное до сброса, не сохраняется
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            version = self._version
+        value = loader()
+        # None (например, пользователя нет) не кэшируем
+        if value is not None:
+            with self._lock:
+                if version == self._version:
+                    self._data[key] = (now + self.ttl, value)
+                    self._data.move_to_end(key)
+                    while len(self._data) > self.maxsize:
+                        self._data.popitem(last=False)
+        return value
+
+    def get_many(self, keys, loader):
+        """Как get для нескольких ключей: loader(missing) -> {key: value} загружает все промахи разом."""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    found[key] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(key)
+            version = self._version
+        if not missing:
+            return found
+        loaded = {key: value for key, value in loader(missing).items() if value is not None}
+        found.update(loaded)
+        with self._lock:
+            if version == self._version:
+                for key, value in loaded.items():
+                    self._data[key] = (now + self.ttl, value)
+                    self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return found
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"name": self.name, "size": len(self._data), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else None}
+
+gift_catalog_cache = ReadThroughCache("gift_catalog", 1, GIFT_CATALOG_TTL_SECONDS)
+user_cache = ReadThroughCache("users", USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+profile_gifts_cache = ReadThroughCache("profile_gifts", USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+# Минимальная цена и число NFT на маркете по базовому подарку
+market_floor_cache = ReadThroughCache("market_floors", MARKET_FLOOR_CACHE_SIZE, MARKET_FLOOR_TTL_SECONDS)
+# Разжатые блоки архива сообщений (блок меняется только при удалении из него сообщения — ключ сбрасывается)
+archive_block_cache = ReadThroughCache("archive_blocks", ARCHIVE_BLOCK_CACHE_SIZE, ARCHIVE_BLOCK_CACHE_TTL_SECONDS)
+# Лимитированный ли подарок — для выбора писателя покупки (run_purchase)
+gift_kind_cache = ReadThroughCache("gift_kinds", GIFT_KIND_CACHE_SIZE, GIFT_KIND_TTL_SECONDS)
+READ_CACHES = (gift_catalog_cache, user_cache, profile_gifts_cache, market_floor_cache, archive_block_cache,
+               gift_kind_cache)
+
+def _load_user_row(user_id):
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_cached_user(user_id):
+    """Строка users (копия словаря) или None, если пользователя нет."""
+    user = user_cache.get(user_id, lambda: _load_user_row(user_id))
+    return dict(user) if user else None
+
+def get_user_role(user_id):
+    """Роль пользователя для проверок прав (None, если пользователя нет)."""
+    user = user_cache.get(user_id, lambda: _load_user_row(user_id))
+    return user["role"] if user else None
+
+def invalidate_user_cache(*user_ids):
+    """Сбрасывает кэш пользователей после изменения их строк, инвентаря или NFT."""
+    user_cache.invalidate(*user_ids)
+    profile_gifts_cache.invalidate(*user_ids)
+
+def invalidate_gift_catalog():
+    gift_catalog_cache.clear()
+
+def invalidate_market_floor(*gift_ids):
+    """Сбрасывает floor маркета подарков, у которых выставили, сняли или продали NFT."""
+    market_floor_cache.invalidate(*gift_ids)
+
+# --- 2.7. ЖУРНАЛ МОНЕТ (coin ledger) ---
+# Баланс хранится в users.coins, каждое изменение добавляется в coin_transactions
+# в той же транзакции. Списание — один условный UPDATE ... RETURNING: проверка
+# баланса и запись атомарны, без предварительного SELECT. Коммит и сброс кэша
+# пользователей делает вызывающий код.
+
+def _record_coin_transaction(cursor, user_id, amount, balance_after, reason, ref_id):
+    cursor.execute("""
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, ref_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, amount, balance_after, reason, ref_id, datetime.now().isoformat(timespec='seconds')))
+
+def debit_coins(cursor, user_id, amount, reason, ref_id=None, message="Недостаточно монет"):
+    """
+    Списывает amount монет, только если их хватает, и возвращает новый баланс.
+    Иначе WriteRejected: 404, если пользователя нет, или 400 с текстом message.
+    """
+    cursor.execute("""
+        UPDATE users SET coins = coins - ? WHERE id = ? AND coins >= ? RETURNING coins
+    """, (amount, user_id, amount))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+        if cursor.fetchone() is None:
+            raise WriteRejected("Пользователь не найден", 404)
+        raise WriteRejected(message)
+    _record_coin_transaction(cursor, user_id, -amount, row[0], reason, ref_id)
+    return row[0]
+
+def credit_coins(cursor, user_id, amount, reason, ref_id=None):
+    """Начисляет amount монет и возвращает новый баланс (None, если пользователя нет)."""
+    cursor.execute("""
+        UPDATE users SET coins = COALESCE(coins, 0) + ? WHERE id = ? RETURNING coins
+    """, (amount, user_id))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    _record_coin_transaction(cursor, user_id, amount, row[0], reason, ref_id)
+    return row[0]
+
+# --- 2.8. ВЫПУСК NFT (mint) ---
+# Порядковые номера выдает счетчик gift_serial_counters: одна строка на базовый
+# подарок увеличивается атомарно, без подсчета уже выпущенных токенов.
+
+NFT_BATCH_MINT_MAX = 1000
+
+def allocate_serials(cursor, gift_id, count=1):
+    """Резервирует count подряд идущих номеров подарка и возвращает первый из них."""
+    cursor.execute("""
+        INSERT INTO gift_serial_counters (gift_id, last_serial) VALUES (?, ?)
+        ON CONFLICT(gift_id) DO UPDATE SET last_serial = last_serial + excluded.last_serial
+        RETURNING last_serial
+    """, (gift_id, count))
+    return cursor.fetchone()[0] - count + 1
+
+def take_from_inventory(cursor, user_id, gift_id):
+    """Списывает 1 подарок из инвентаря, если он есть; False, если списывать нечего."""
+    cursor.execute("""
+        UPDATE user_inventory SET quantity = quantity - 1
+        WHERE user_id = ? AND gift_id = ? AND quantity > 0
+        RETURNING quantity
+    """, (user_id, gift_id))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    if row[0] <= 0:
+        cursor.execute("DELETE FROM user_inventory WHERE user_id = ? AND gift_id = ?", (user_id, gift_id))
+    return True
+
+def mint_nfts(cursor, gift_id, owner_ids, creator_id, price):
+    """
+    Выпускает по одному NFT базового подарка каждому владельцу из owner_ids
+    (в одной транзакции, коммит делает вызывающий код). Возвращает список
+    словарей token_id/owner_id/serial_number в порядке owner_ids.
+    """
+    first_serial = allocate_serials(cursor, gift_id, len(owner_ids))
+    created_at = datetime.now().isoformat(timespec='seconds')
+    tokens = [{"token_id": f"nft_{uuid.uuid4().hex}", "owner_id": owner_id, "serial_number": first_serial + i}
+              for i, owner_id in enumerate(owner_ids)]
+    cursor.executemany("""
+        INSERT INTO nft_items (
+            token_id, base_gift_id, owner_id, creator_admin_id,
+            original_sender_id, serial_number, bg_variant,
+            price, is_listed, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+    """, [(token["token_id"], gift_id, token["owner_id"], creator_id,
+           creator_id, token["serial_number"], random.randint(1, 5),
+           price, created_at) for token in tokens])
+    return tokens
+
+# --- 2.9. ИСТОРИЯ СДЕЛОК NFT (trades) ---
+# Каждая сделка пишется в nft_trades, а итоги по подарку (nft_gift_stats) и свеча
+# текущего часа (nft_price_buckets) обновляются в той же транзакции — статистика
+# читается готовой, без пересчета по истории.
+
+NFT_STATS_BUCKET_SECONDS = 3600
+NFT_STATS_WINDOW_SECONDS = 24 * 3600
+
+def record_nft_trade(cursor, base_gift_id, token_id, seller_id, buyer_id, price, kind="sale"):
+    """Записывает сделку; продажи (kind='sale') учитываются в итогах и свечах подарка."""
+    now = time.time()
+    created_at = datetime.fromtimestamp(now).isoformat(timespec='seconds')
+    cursor.execute("""
+        INSERT INTO nft_trades (token_id, base_gift_id, seller_id, buyer_id, price, kind, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (token_id, base_gift_id, seller_id, buyer_id, price, kind, created_at))
+    if kind != "sale":
+        return
+    cursor.execute("""
+        INSERT INTO nft_gift_stats
+            (base_gift_id, last_price, last_trade_at, trade_count, volume_total, high_price, low_price)
+        VALUES (?1, ?2, ?3, 1, ?2, ?2, ?2)
+        ON CONFLICT(base_gift_id) DO UPDATE SET
+            last_price = excluded.last_price,
+            last_trade_at = excluded.last_trade_at,
+            trade_count = trade_count + 1,
+            volume_total = volume_total + excluded.last_price,
+            high_price = MAX(high_price, excluded.last_price),
+            low_price = MIN(low_price, excluded.last_price)
+    """, (base_gift_id, price, created_at))
+    cursor.execute("""
+        INSERT INTO nft_price_buckets
+            (base_gift_id, bucket_start, open_price, high_price, low_price, close_price, volume, trades)
+        VALUES (?1, ?2, ?3, ?3, ?3, ?3, ?3, 1)
+        ON CONFLICT(base_gift_id, bucket_start) DO UPDATE SET
+            high_price = MAX(high_price, excluded.close_price),
+            low_price = MIN(low_price, excluded.close_price),
+            close_price = excluded.close_price,
+            volume = volume + excluded.volume,
+            trades = trades + 1
+    """, (base_gift_id, int(now) // NFT_STATS_BUCKET_SECONDS * NFT_STATS_BUCKET_SECONDS, price))
+
+# --- 2.10. ПРИСУТСТВИЕ (presence) ---
+# Кто онлайн, хранится в памяти процесса: heartbeat (вход, /api/sync, открытый
+# SSE-поток) только обновляет словарь и колесо таймеров, без обращения к базе.
+# Колесо — кольцо из PRESENCE_TIMEOUT_SECONDS / PRESENCE_TICK_SECONDS слотов; heartbeat
+# переносит пользователя в слот, который наступит через таймаут, а поток раз в тик
+# забирает очередной слот целиком — все, кто в нем остался, ушли в офлайн.
+# last_seen копится в памяти и раз в PRESENCE_FLUSH_SECONDS пишется в users одним
+# executemany; он нужен для офлайн-статуса и другим процессам. При остановке процесса
+# теряется не больше одного интервала записи.
+
+PRESENCE_TIMEOUT_SECONDS = 60
+PRESENCE_TICK_SECONDS = 1
+PRESENCE_FLUSH_SECONDS = 10
+PRESENCE_BULK_MAX = 200
+# События presence (онлайн/офлайн) в SSE-поток тем, кто следит за пользователем
+PRESENCE_PUSH_ENABLED = os.environ.get('VAULT_PRESENCE_PUSH', '1') == '1'
+
+def presence_from_last_seen(last_seen):
+    """online — если пользователь был активен последние PRESENCE_TIMEOUT_SECONDS."""
+    online = False
+    if last_seen:
+        try:
+            dt = datetime.fromisoformat(last_seen)
+            diff = datetime.now() - dt
+            online = diff.total_seconds() <= PRESENCE_TIMEOUT_SECONDS
+        except Exception:
+            online = False
+    return {"online": online, "last_seen": last_seen}
+
+def _format_last_seen(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+def _load_stored_last_seen(user_ids):
+    placeholders = ",".join("?" * len(user_ids))
+    with db_connection() as conn:
+        rows = conn.execute(f"SELECT id, last_seen FROM users WHERE id IN ({placeholders})",
+                            user_ids).fetchall()
+    # Обертка, чтобы кэшировался и last_seen = NULL (пользователь ни разу не входил)
+    return {row["id"]: {"last_seen": row["last_seen"]} for row in rows}
+
+class PresenceService:
+    """Heartbeat-ы в памяти, истечение по колесу таймеров и пакетная запись last_seen."""
+
+    def __init__(self, timeout, tick, flush_every, on_change=None):
+        self._tick_seconds = tick
+        self._timeout_ticks = max(1, round(timeout / tick))
+        self._flush_ticks = max(1, round(flush_every / tick))
+        # На слот больше таймаута: слот, который сейчас разбирается, heartbeat не заполняет
+        self._wheel = [set() for _ in range(self._timeout_ticks + 1)]
+        self._tick = 0
+        self._online = {}  # user_id -> (время последнего heartbeat, слот колеса)
+        self._dirty = {}   # user_id -> last_seen, еще не записанный в базу
+        self._lock = threading.Lock()
+        self._pid = None
+        self._on_change = on_change
+        # last_seen офлайн-пользователей из базы; TTL — интервал записи, чтобы видеть другие процессы
+        self._stored = ReadThroughCache("presence_last_seen", USER_CACHE_SIZE, flush_every)
+        self.heartbeats = 0
+        self.expired = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def heartbeat(self, user_id):
+        now = time.time()
+        with self._lock:
+            # Поток не переживает fork, поэтому в новом процессе запускаем свой
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True, name="presence").start()
+            previous = self._online.get(user_id)
+            if previous is not None:
+                self._wheel[previous[1]].discard(user_id)
+            slot = (self._tick + self._timeout_ticks) % len(self._wheel)
+            self._wheel[slot].add(user_id)
+            self._online[user_id] = (now, slot)
+            self._dirty[user_id] = now
+            self.heartbeats += 1
+        if previous is None and self._on_change is not None:
+            self._on_change(user_id, True, now)
+
+    def bulk(self, user_ids):
+        """{user_id: {online, last_seen}}; несуществующих пользователей в ответе нет."""
+        result = {}
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._online.get(user_id)
+                if entry is not None:
+                    result[user_id] = {"online": True, "last_seen": _format_last_seen(entry[0])}
+        missing = [user_id for user_id in user_ids if user_id not in result]
+        if missing:
+            for user_id, row in self._stored.get_many(missing, _load_stored_last_seen).items():
+                result[user_id] = presence_from_last_seen(row["last_seen"])
+        return result
+
+    def flush(self):
+        """Пишет накопленные last_seen одним executemany; возвращает число строк."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        rows = [(_format_last_seen(timestamp), user_id) for user_id, timestamp in dirty.items()]
+        try:
+            run_write(lambda cursor: cursor.executemany(
+                "UPDATE users SET last_seen = ? WHERE id = ?", rows))
+        except Exception:
+            # Вернем в очередь; более свежий heartbeat, пришедший за это время, не затираем
+            with self._lock:
+                for user_id, timestamp in dirty.items():
+                    self._dirty.setdefault(user_id, timestamp)
+            raise
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        return len(rows)
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self._tick_seconds
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            with self._lock:
+                self._tick += 1
+                slot = self._wheel[self._tick % len(self._wheel)]
+                expired = [(user_id, self._online.pop(user_id)[0]) for user_id in slot]
+                slot.clear()
+                self.expired += len(expired)
+                flush_due = self._tick % self._flush_ticks == 0
+            try:
+                if expired:
+                    # Последний heartbeat уже записан в базу: интервал записи меньше таймаута
+                    self._stored.invalidate(*(user_id for user_id, _ in expired))
+                    if self._on_change is not None:
+                        for user_id, last_seen in expired:
+                            self._on_change(user_id, False, last_seen)
+                if flush_due:
+                    self.flush()
+            except Exception as e:
+                print(f"Ошибка присутствия: {e}")
+
+    def metrics(self):
+        with self._lock:
+            metrics = {"online": len(self._online), "pending_flush": len(self._dirty),
+                       "heartbeats": self.heartbeats, "expired": self.expired,
+                       "flushes": self.flushes, "flushed_rows": self.flushed_rows}
+        metrics["push"] = PRESENCE_PUSH_ENABLED
+        metrics["stored_cache"] = self._stored.stats()
+        return metrics
+
+def publish_presence(user_id, online, timestamp):
+    """Переход онлайн/офлайн — подписчикам топика presence:<user_id>."""
+    message_bus.publish(f"presence:{user_id}", {
+        "type": "presence",
+        "user_id": user_id,
+        "online": online,
+        "last_seen": _format_last_seen(timestamp)
+    })
+
+presence = PresenceService(PRESENCE_TIMEOUT_SECONDS, PRESENCE_TICK_SECONDS, PRESENCE_FLUSH_SECONDS,
+                           on_change=publish_presence if PRESENCE_PUSH_ENABLED else None)
+
+# --- 2.11. ОТМЕТКИ ПРОЧТЕНИЯ (read receipts) ---
+# Прочтение — отметка "чат прочитан до seq N" на пару (пользователь, чат) в chat_reads.
+# История чата только читает базу: если отметка продвинулась, она копится в памяти
+# (по паре хранится наибольший seq) и раз в READ_RECEIPT_FLUSH_SECONDS записывается
+# пачкой одной транзакцией вместе с пересчетом непрочитанных. В каналах прочтение
+# по-прежнему считается по числу постов (room_members.read_count).
+
+READ_RECEIPT_FLUSH_SECONDS = 1.0
+# Столько отметок в очереди — записываем, не дожидаясь интервала
+READ_RECEIPT_BATCH_MAX = 500
+
+class ReadReceipts:
+    """Очередь продвинувшихся отметок прочтения и поток, который пишет их пачками."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pid = None
+        # user_id -> {partner_id: (chat_id, read_seq)}; _inflight — пачка, которая сейчас пишется
+        self._pending = {}
+        self._inflight = {}
+        self._pending_count = 0
+        self.receipts = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def mark_read(self, user_id, partner_id, chat_id, read_seq):
+        """Отмечает чат прочитанным до read_seq; повторные отметки до записи сливаются в одну."""
+        with self._cond:
+            # Поток не переживает fork, поэтому в новом процессе запускаем свой
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True, name="read-receipts").start()
+            chats = self._pending.setdefault(user_id, {})
+            previous = chats.get(partner_id)
+            if previous is not None and previous[1] >= read_seq:
+                return
+            if previous is None:
+                self._pending_count += 1
+            chats[partner_id] = (chat_id, read_seq)
+            self.receipts += 1
+            if self._pending_count == 1 or self._pending_count >= READ_RECEIPT_BATCH_MAX:
+                self._cond.notify()
+
+    def pending_seq(self, user_id, partner_id):
+        """Отметка, еще не записанная в базу (0, если ее нет)."""
+        with self._cond:
+            seqs = [chats[partner_id][1] for chats in (self._pending.get(user_id), self._inflight.get(user_id))
+                    if chats and partner_id in chats]
+        return max(seqs, default=0)
+
+    def pending_for(self, user_id):
+        """{partner_id: read_seq} незаписанных отметок пользователя — для списка чатов."""
+        with self._cond:
+            result = {partner_id: seq for partner_id, (_, seq) in self._inflight.get(user_id, {}).items()}
+            for partner_id, (_, seq) in self._pending.get(user_id, {}).items():
+                result[partner_id] = max(seq, result.get(partner_id, 0))
+        return result
+
+    def flush(self):
+        """Записывает накопленные отметки одной транзакцией; возвращает их число."""
+        with self._cond:
+            batch, self._pending = self._pending, {}
+            self._pending_count = 0
+            self._inflight = batch
+        rows = [(user_id, partner_id, chat_id, read_seq)
+                for user_id, chats in batch.items()
+                for partner_id, (chat_id, read_seq) in chats.items()]
+        if not rows:
+            return 0
+        try:
+            unread = count_unread_after_reads(rows) if message_shards.count else None
+            run_write(lambda cursor: apply_read_receipts(cursor, rows, unread))
+        except Exception:
+            with self._cond:
+                for user_id, partner_id, chat_id, read_seq in rows:
+                    chats = self._pending.setdefault(user_id, {})
+                    if partner_id not in chats:
+                        self._pending_count += 1
+                        chats[partner_id] = (chat_id, read_seq)
+            raise
+        finally:
+            with self._cond:
+                self._inflight = {}
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        # Отправителю — до какого seq его сообщения прочитаны
+        for user_id, partner_id, chat_id, read_seq in rows:
+            if not chat_id.startswith("channel_"):
+                message_bus.publish(f"user:{partner_id}", {
+                    "type": "messages_read", "chat_id": chat_id, "reader_id": user_id, "read_seq": read_seq
+                })
+        return len(rows)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Копим пачку, пока не истечет интервал или очередь не заполнится
+                if self._pending_count < READ_RECEIPT_BATCH_MAX:
+                    self._cond.wait(READ_RECEIPT_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Ошибка записи отметок прочтения: {e}")
+                time.sleep(READ_RECEIPT_FLUSH_SECONDS)
+
+    def metrics(self):
+        with self._cond:
+            return {"pending": self._pending_count, "receipts": self.receipts,
+                    "flushes": self.flushes, "flushed_rows": self.flushed_rows}
+
+def count_unread_after_reads(rows):
+    """
+    С шардами непрочитанные после отметок считаются в шарде чата заранее:
+    {(user_id, chat_id): (unread, last_seq)}. Считаются входящие до last_seq сводки —
+    более новые сообщения прибавит к счетчику запись их сводки.
+    """
+    marks = {}
+    with db_connection() as conn:
+        for user_id, _, chat_id, read_seq in rows:
+            if chat_id.startswith("channel_"):
+                continue
+            row = conn.execute("""
+                SELECT s.last_seq, COALESCE(r.read_seq, 0) FROM chat_summaries s
+                LEFT JOIN chat_reads r ON r.user_id = s.user_id AND r.chat_id = s.chat_id
+                WHERE s.user_id = ? AND s.chat_id = ? AND s.unread_count > 0
+            """, (user_id, chat_id)).fetchone()
+            if row:
+                marks[(user_id, chat_id)] = (max(read_seq, row[1]), row[0])
+    by_shard = {}
+    for (user_id, chat_id), mark in marks.items():
+        by_shard.setdefault(message_shards.for_chat(chat_id), []).append((user_id, chat_id, mark))
+    counts = {}
+    for shard, chats in by_shard.items():
+        with shard.connection() as conn:
+            for user_id, chat_id, (read_seq, last_seq) in chats:
+                counts[(user_id, chat_id)] = (conn.execute("""
+                    SELECT COUNT(*) FROM messages
+                    WHERE chat_id = ? AND sender_id != ? AND seq > ? AND seq <= ?
+                """, (chat_id, user_id, read_seq, last_seq)).fetchone()[0], last_seq)
+    return counts
+
+def apply_read_receipts(cursor, rows, unread=None):
+    """
+    rows — (user_id, partner_id, chat_id, read_seq). Отметка только растет.
+    unread — непрочитанные из count_unread_after_reads (с шардами), иначе считаются здесь.
+    """
+    channel_rows = [row for row in rows if row[2].startswith("channel_")]
+    chat_rows = [row for row in rows if not row[2].startswith("channel_")]
+    for user_id, room_id, _, _ in channel_rows:
+        mark_channel_read(cursor, room_id, user_id)
+    cursor.executemany("""
+        INSERT INTO chat_reads (user_id, chat_id, read_seq) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET read_seq = excluded.read_seq
+        WHERE excluded.read_seq > chat_reads.read_seq
+    """, [(user_id, chat_id, read_seq) for user_id, _, chat_id, read_seq in chat_rows])
+    if unread is not None:
+        # Сводка, которую за это время обновило новое сообщение, не трогаем: счетчик
+        # поправит следующая отметка прочтения
+        cursor.executemany("""
+            UPDATE chat_summaries SET unread_count = ?
+            WHERE user_id = ? AND chat_id = ? AND last_seq = ?
+        """, [(count, user_id, chat_id, last_seq) for (user_id, chat_id), (count, last_seq) in unread.items()])
+        return
+    # Непрочитанные — входящие после отметки (обычно 0, если пришло новое — столько, сколько пришло)
+    cursor.executemany("""
+        UPDATE chat_summaries SET unread_count = (
+            SELECT COUNT(*) FROM messages
+            WHERE chat_id = :chat_id AND sender_id != :user_id
+              AND seq > (SELECT read_seq FROM chat_reads WHERE user_id = :user_id AND chat_id = :chat_id)
+        )
+        WHERE user_id = :user_id AND chat_id = :chat_id AND unread_count > 0
+    """, [{"user_id": user_id, "chat_id": chat_id} for user_id, _, chat_id, _ in chat_rows])
+
+read_receipts = ReadReceipts()
+
+# --- 2.12. ХРАНЕНИЕ И АРХИВ СООБЩЕНИЙ (retention) ---
+# Старые сообщения переносятся из messages в файлы архива ARCHIVE_DIR/messages-ГГГГ-ММ.db
+# (по месяцу последнего сообщения блока) блоками по ARCHIVE_BLOCK_MESSAGES сообщений
+# одного чата, сжатыми zlib. Каталог блоков (message_archive) лежит в основной базе,
+# и история чата догружает из архива то, чего уже нет в messages. Сроки задаются на чат
+# или канал (retention_policies), по умолчанию архивируется все старше
+# MESSAGE_ARCHIVE_AFTER_DAYS. Блоки старше delete_after_days удаляются, а файл месяца,
+# в котором не осталось блоков, — целиком. Освободившиеся страницы основной базы
+# возвращаются PRAGMA incremental_vacuum короткими транзакциями. Все это делает
+# периодическая фоновая задача retention. Архивные сообщения не участвуют
+# в полнотекстовом поиске. Удалить одно архивное сообщение можно по uuid: блок
+# находится через таблицу message_uuids файла месяца, delete_archived_message сначала
+# правит каталог в основной базе и отмечает сообщение в archive_deletions, а блок
+# переписывается после коммита (при сбое — следующим запуском retention).
+
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('VAULT_ARCHIVE_AFTER_DAYS', 90))
+RETENTION_INTERVAL_SECONDS = 3600
+# Первый запуск после старта процесса — не сразу, чтобы не мешать прогреву
+RETENTION_FIRST_RUN_DELAY_SECONDS = 60
+ARCHIVE_BLOCK_MESSAGES = 256
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_COLUMNS = ("uuid", "seq", "sender_id", "text", "timestamp", "created_at", "gift_id")
+# Incremental vacuum: страниц за транзакцию, пауза между транзакциями
+# и число свободных страниц, ниже которого базу не сжимаем
+VACUUM_STEP_PAGES = 1000
+VACUUM_STEP_PAUSE_SECONDS = 0.05
+VACUUM_MIN_FREE_PAGES = 256
+
+class MessageArchive:
+    """
+    Файлы архива по месяцам, в каждом — таблица blocks (chat_id, first_seq, last_seq, data)
+    и message_uuids (uuid -> блок) для удаления архивного сообщения по uuid.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._conns = {}
+        self._pid = None
+
+    def path(self, partition):
+        return os.path.join(self.directory, f"messages-{partition}.db")
+
+    def _connection(self, partition):
+        # Вызывается под self._lock; подключения родителя после fork не используем
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conns = {}
+        conn = self._conns.get(partition)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.path(partition), timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                                   check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blocks (
+                    chat_id TEXT NOT NULL,
+                    first_seq INTEGER NOT NULL,
+                    last_seq INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (chat_id, first_seq)
+                )
+            """)
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_uuids'").fetchone():
+                conn.execute("""
+                    CREATE TABLE message_uuids (
+                        uuid TEXT PRIMARY KEY,
+                        chat_id TEXT NOT NULL,
+                        first_seq INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX idx_message_uuids_block ON message_uuids(chat_id, first_seq)")
+                # Файл, записанный до появления индекса, — заполняем из блоков
+                for chat_id, first_seq, data in conn.execute("SELECT chat_id, first_seq, data FROM blocks"):
+                    conn.executemany("INSERT OR REPLACE INTO message_uuids (uuid, chat_id, first_seq) VALUES (?, ?, ?)",
+                                     [(message["uuid"], chat_id, first_seq) for message in unpack_archive_block(data)])
+            conn.commit()
+            self._conns[partition] = conn
+        return conn
+
+    def write_block(self, partition, chat_id, first_seq, last_seq, data, uuids):
+        with self._lock:
+            conn = self._connection(partition)
+            conn.execute("""
+                INSERT OR REPLACE INTO blocks (chat_id, first_seq, last_seq, data) VALUES (?, ?, ?, ?)
+            """, (chat_id, first_seq, last_seq, data))
+            # Блок мог перезаписываться после сбоя — состав сообщений берем новый
+            conn.execute("DELETE FROM message_uuids WHERE chat_id = ? AND first_seq = ?", (chat_id, first_seq))
+            conn.executemany("INSERT OR REPLACE INTO message_uuids (uuid, chat_id, first_seq) VALUES (?, ?, ?)",
+                             [(uuid, chat_id, first_seq) for uuid in uuids])
+            conn.commit()
+
+    def read_block(self, partition, chat_id, first_seq):
+        with self._lock:
+            row = self._connection(partition).execute(
+                "SELECT data FROM blocks WHERE chat_id = ? AND first_seq = ?", (chat_id, first_seq)).fetchone()
+        return row[0] if row else None
+
+    def delete_blocks(self, partition, chat_id, first_seqs):
+        with self._lock:
+            conn = self._connection(partition)
+            conn.executemany("DELETE FROM blocks WHERE chat_id = ? AND first_seq = ?",
+                             [(chat_id, first_seq) for first_seq in first_seqs])
+            conn.executemany("DELETE FROM message_uuids WHERE chat_id = ? AND first_seq = ?",
+                             [(chat_id, first_seq) for first_seq in first_seqs])
+            conn.commit()
+
+    def find_message(self, uuid):
+        """(месяц, chat_id, first_seq) блока с сообщением uuid или None."""
+        for partition in self.partitions():
+            with self._lock:
+                row = self._connection(partition).execute(
+                    "SELECT chat_id, first_seq FROM message_uuids WHERE uuid = ?", (uuid,)).fetchone()
+            if row:
+                return partition, row[0], row[1]
+        return None
+
+    def remove_message(self, partition, chat_id, first_seq, uuid):
+        """
+        Переписывает блок без сообщения uuid; возвращает число оставшихся в блоке сообщений.
+        Повторный вызов ничего не меняет, поэтому его можно повторять после сбоя.
+        """
+        with self._lock:
+            conn = self._connection(partition)
+            row = conn.execute("SELECT last_seq, data FROM blocks WHERE chat_id = ? AND first_seq = ?",
+                               (chat_id, first_seq)).fetchone()
+            block = unpack_archive_block(row[1]) if row else []
+            rest = [message for message in block if message["uuid"] != uuid]
+            if len(rest) == len(block):
+                pass  # сообщения в блоке уже нет (повтор после сбоя)
+            elif rest:
+                # Ключ блока (first_seq) не меняется: на него ссылается каталог message_archive
+                conn.execute("UPDATE blocks SET data = ? WHERE chat_id = ? AND first_seq = ?",
+                             (pack_archive_block([[message[column] for column in ARCHIVE_COLUMNS]
+                                                  for message in rest]), chat_id, first_seq))
+            else:
+                conn.execute("DELETE FROM blocks WHERE chat_id = ? AND first_seq = ?", (chat_id, first_seq))
+            conn.execute("DELETE FROM message_uuids WHERE uuid = ?", (uuid,))
+            conn.commit()
+        return len(rest)
+
+    def drop(self, partition):
+        """Удаляет файл месяца целиком."""
+        with self._lock:
+            conn = self._conns.pop(partition, None)
+            if conn is not None:
+                conn.close()
+            for path in (self.path(partition), self.path(partition) + "-journal"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def partitions(self):
+        """{месяц: размер файла в байтах}."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return {}
+        return {name[len("messages-"):-len(".db")]: os.path.getsize(os.path.join(self.directory, name))
+                for name in sorted(names) if name.startswith("messages-") and name.endswith(".db")}
+
+message_archive = MessageArchive(ARCHIVE_DIR)
+
+def pack_archive_block(rows):
+    """Сжатый блок архива: JSON-список строк со столбцами ARCHIVE_COLUMNS."""
+    return zlib.compress(json.dumps([list(row) for row in rows], ensure_ascii=False).encode("utf-8"),
+                         ARCHIVE_COMPRESSION_LEVEL)
+
+def unpack_archive_block(data):
+    return [dict(zip(ARCHIVE_COLUMNS, values)) for values in json.loads(zlib.decompress(data))]
+
+def archive_partition(created_at):
+    """Файл архива для блока: месяц его последнего сообщения (legacy — сообщения без даты)."""
+    return created_at[:7] if created_at else "legacy"
+
+def load_archive_block(partition, chat_id, first_seq):
+    """Сообщения блока по возрастанию seq (общие словари из кэша — не изменять)."""
+    def load():
+        data = message_archive.read_block(partition, chat_id, first_seq)
+        if data is None:
+            return None
+        return unpack_archive_block(data)
+    return archive_block_cache.get((partition, chat_id, first_seq), load) or []
+
+def load_archived_messages(cursor, chat_id, limit, after_seq=None, before_seq=None):
+    """
+    Сообщения чата из архива для истории: с after_seq — новее курсора по возрастанию seq,
+    иначе — старше before_seq (без него — самые новые в архиве) по убыванию. Не больше limit.
+    """
+    if limit <= 0:
+        return []
+    # Удаленные, но еще не вычеркнутые из блоков сообщения (обычно таких нет)
+    cursor.execute("SELECT uuid FROM archive_deletions WHERE chat_id = ?", (chat_id,))
+    deleted = {row["uuid"] for row in cursor.fetchall()}
+    if after_seq is not None:
+        cursor.execute("""
+            SELECT first_seq, partition FROM message_archive
+            WHERE chat_id = ? AND last_seq > ? ORDER BY last_seq
+        """, (chat_id, after_seq))
+        pick = lambda block: [message for message in block if message["seq"] > after_seq]
+    else:
+        cursor.execute("""
+            SELECT first_seq, partition FROM message_archive
+            WHERE chat_id = ? AND first_seq < ? ORDER BY first_seq DESC
+        """, (chat_id, before_seq if before_seq is not None else sys.maxsize))
+        pick = lambda block: [message for message in reversed(block)
+                              if before_seq is None or message["seq"] < before_seq]
+    messages = []
+    for row in cursor.fetchall():
+        messages.extend(message for message in pick(load_archive_block(row["partition"], chat_id, row["first_seq"]))
+                        if message["uuid"] not in deleted)
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+def retention_policy(policies, chat_id):
+    """(archive_after_days, delete_after_days) чата с учетом срока по умолчанию."""
+    archive_days, delete_days = policies.get(chat_id, (None, None))
+    if archive_days is None:
+        archive_days = MESSAGE_ARCHIVE_AFTER_DAYS
+    # Удаляются только блоки архива, поэтому к сроку удаления сообщения уже должны быть в архиве
+    if delete_days and (not archive_days or delete_days < archive_days):
+        archive_days = delete_days
+    return archive_days, delete_days
+
+def days_ago(days):
+    return datetime.fromtimestamp(time.time() - days * 86400).isoformat(timespec='seconds')
+
+def archive_cutoff_seq(cursor, cutoff):
+    """
+    Наибольший seq сообщения старше cutoff (0, если таких нет). seq растет вместе
+    со временем, поэтому это двоичный поиск по idx_messages_seq без просмотра таблицы.
+    """
+    cursor.execute("SELECT MIN(seq), MAX(seq) FROM messages")
+    low, high = cursor.fetchone()
+    if low is None:
+        return 0
+    low -= 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        cursor.execute("SELECT seq, created_at FROM messages WHERE seq >= ? ORDER BY seq LIMIT 1", (middle,))
+        row = cursor.fetchone()
+        # Даты нет только у сообщений, которые не прошли миграцию 15, — их не считаем старыми
+        if row["created_at"] is not None and row["created_at"] < cutoff:
+            low = row["seq"]
+        else:
+            high = middle - 1
+    return max(low, 0)
+
+def archive_chat(chat_id, cutoff_seq):
+    """Переносит сообщения чата с seq <= cutoff_seq в архив; возвращает их число."""
+    shard = message_shards.for_chat(chat_id)
+    moved = 0
+    while True:
+        with shard.connection() as conn:
+            rows = conn.execute(f"""
+                SELECT {', '.join(ARCHIVE_COLUMNS)} FROM messages
+                WHERE chat_id = ? AND seq <= ? ORDER BY seq LIMIT ?
+            """, (chat_id, cutoff_seq, ARCHIVE_BLOCK_MESSAGES)).fetchall()
+        if not rows:
+            return moved
+        first, last = rows[0], rows[-1]
+        partition = archive_partition(last["created_at"])
+        # Сначала блок в файле архива: если процесс упадет до коммита ниже,
+        # сообщения останутся в messages, а блок перезапишется при следующем запуске
+        message_archive.write_block(partition, chat_id, first["seq"], last["seq"], pack_archive_block(rows),
+                                    [row["uuid"] for row in rows])
+
+        def delete_messages(cursor):
+            cursor.execute("DELETE FROM messages WHERE chat_id = ? AND seq BETWEEN ? AND ?",
+                           (chat_id, first["seq"], last["seq"]))
+            if cursor.rowcount != len(rows):
+                raise WriteRejected("Сообщения чата изменились во время архивации", 409)
+
+        def add_to_catalog(cursor):
+            cursor.execute("""
+                INSERT OR REPLACE INTO message_archive
+                    (chat_id, first_seq, last_seq, first_at, last_at, message_count, partition)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (chat_id, first["seq"], last["seq"], first["created_at"], last["created_at"],
+                  len(rows), partition))
+
+        def remove_from_catalog(cursor):
+            cursor.execute("DELETE FROM message_archive WHERE chat_id = ? AND first_seq = ?",
+                           (chat_id, first["seq"]))
+
+        try:
+            if shard.is_main:
+                run_write(lambda cursor: (delete_messages(cursor), add_to_catalog(cursor)))
+            else:
+                # Каталог и сообщения в разных файлах: сначала каталог — при сбое между коммитами
+                # сообщения останутся и в шарде, и в архиве, а следующий запуск перезапишет блок
+                run_write(add_to_catalog)
+                try:
+                    shard.run_write(delete_messages)
+                except WriteRejected:
+                    run_write(remove_from_catalog)
+                    raise
+        except WriteRejected:
+            # Сообщение удалили, пока писался блок, — перечитываем и пишем блок заново
+            continue
+        moved += len(rows)
+
+def expire_archive(chat_id, cutoff):
+    """Удаляет блоки чата, последнее сообщение которых старше cutoff; возвращает (сообщений, файлы)."""
+    def delete_catalog(cursor):
+        cursor.execute("""
+            DELETE FROM message_archive WHERE chat_id = ? AND last_at IS NOT NULL AND last_at < ?
+            RETURNING first_seq, partition, message_count
+        """, (chat_id, cutoff))
+        return cursor.fetchall()
+
+    # Сначала каталог: история больше не ссылается на блоки, которые сейчас удалятся
+    rows = run_write(delete_catalog)
+    by_partition = {}
+    for row in rows:
+        by_partition.setdefault(row["partition"], []).append(row["first_seq"])
+    for partition, first_seqs in by_partition.items():
+        message_archive.delete_blocks(partition, chat_id, first_seqs)
+    if rows:
+        archive_block_cache.clear()
+    return sum(row["message_count"] for row in rows), set(by_partition)
+
+def incremental_vacuum(pool=None):
+    """Возвращает свободные страницы базы порциями по VACUUM_STEP_PAGES; возвращает их число."""
+    with db_connection(pool) as conn:
+        # В основной базе режим включается задачей vacuum (после миграции 14), шарды создаются с ним
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        start = free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free >= VACUUM_MIN_FREE_PAGES:
+            # Из Python каждый вызов PRAGMA incremental_vacuum освобождает одну страницу
+            # (модуль sqlite3 делает один шаг запроса без строк), поэтому шаг — цикл в одной транзакции
+            conn.execute("BEGIN IMMEDIATE")
+            for _ in range(min(free, VACUUM_STEP_PAGES)):
+                conn.execute("PRAGMA incremental_vacuum(1)")
+            conn.commit()
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(VACUUM_STEP_PAUSE_SECONDS)
+        return start - free
+
+def run_retention(progress=None):
+    """Архивирует старые сообщения, удаляет просроченный архив и сжимает базу."""
+    stats = {"chats": 0, "archived": 0, "expired": 0, "dropped_partitions": [], "vacuumed_pages": 0}
+    # Сначала доделываем удаления архивных сообщений, блоки которых не удалось переписать
+    stats["archive_deletions"] = apply_archive_deletions()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chat_id, archive_after_days, delete_after_days FROM retention_policies")
+        policies = {row["chat_id"]: (row["archive_after_days"], row["delete_after_days"])
+                    for row in cursor.fetchall()}
+        cursor.execute("SELECT chat_id FROM chat_summaries UNION SELECT 'channel_' || room_id FROM channel_state")
+        chat_ids = [row["chat_id"] for row in cursor.fetchall()]
+        # seq растет со временем в пределах шарда, поэтому граница своя у каждого шарда
+        cutoffs = {}
+        work = []
+        for chat_id in chat_ids:
+            archive_days, _ = retention_policy(policies, chat_id)
+            if not archive_days:
+                continue
+            shard = message_shards.for_chat(chat_id)
+            with shard.connection(conn) as shard_conn:
+                shard_cursor = shard_conn.cursor()
+                if (shard, archive_days) not in cutoffs:
+                    cutoffs[(shard, archive_days)] = archive_cutoff_seq(shard_cursor, days_ago(archive_days))
+                shard_cursor.execute("SELECT MIN(seq) FROM messages WHERE chat_id = ?", (chat_id,))
+                oldest = shard_cursor.fetchone()[0]
+            if oldest is not None and oldest <= cutoffs[(shard, archive_days)]:
+                work.append((chat_id, cutoffs[(shard, archive_days)]))
+
+    for chat_id, cutoff_seq in work:
+        stats["archived"] += archive_chat(chat_id, cutoff_seq)
+        stats["chats"] += 1
+        if progress is not None:
+            progress(stats)
+
+    touched = set()
+    for chat_id, (_, delete_days) in policies.items():
+        if delete_days:
+            expired, partitions = expire_archive(chat_id, days_ago(delete_days))
+            stats["expired"] += expired
+            touched |= partitions
+    if touched:
+        with db_connection() as conn:
+            placeholders = ",".join("?" * len(touched))
+            used = {row[0] for row in conn.execute(
+                f"SELECT DISTINCT partition FROM message_archive WHERE partition IN ({placeholders})",
+                list(touched))}
+        for partition in sorted(touched - used):
+            message_archive.drop(partition)
+            stats["dropped_partitions"].append(partition)
+
+    stats["vacuumed_pages"] = sum(incremental_vacuum(pool) for pool in [db_pool] + [
+        shard.pool for shard in message_shards if not shard.is_main])
+    return stats
+
+def schedule_retention(exclude_job_id=None, delay=RETENTION_INTERVAL_SECONDS):
+    """Ставит периодическую задачу retention, если другой такой еще нет в очереди."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Несколько процессов стартуют одновременно — проверка и вставка под блокировкой записи
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("""
+            SELECT 1 FROM jobs
+            WHERE kind = 'retention' AND status IN ('queued', 'running')
+              AND json_extract(payload, '$.scheduled') = 1 AND id != ?
+        """, (exclude_job_id or "",))
+        if cursor.fetchone() is None:
+            job_queue.enqueue("retention", {"scheduled": True}, cursor, delay=delay)
+        conn.commit()
+
+@job_handler("retention")
+def run_retention_job(job_id, payload):
+    """Обслуживание архива; задача по расписанию после успешного запуска ставит следующую."""
+    result = run_retention(progress=lambda stats: job_queue.progress(job_id, stats))
+    if payload.get("scheduled"):
+        schedule_retention(exclude_job_id=job_id)
+    return result
+
+def retention_storage_stats():
+    """Размер живой таблицы, свободные страницы и объем архива — для админки."""
+    shards = []
+    for shard in message_shards:
+        if shard.is_main:
+            continue
+        with shard.connection() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            shards.append({
+                "shard": shard.index,
+                "messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+                "db_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+                "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+            })
+    with db_connection() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        stats = {
+            "live_messages": (sum(shard["messages"] for shard in shards) if shards else
+                              conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]),
+            "message_shards": shards,
+            "db_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+            "cache_bytes": DB_CACHE_SIZE_KB * 1024,
+            "incremental_vacuum": conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+        }
+        row = conn.execute("SELECT COUNT(*), COALESCE(SUM(message_count), 0) FROM message_archive").fetchone()
+    stats["archive_blocks"], stats["archived_messages"] = row[0], row[1]
+    stats["archive_partitions"] = message_archive.partitions()
+    return stats
+
+# --- 3. МАРШРУТЫ АУТЕНТИФИКАЦИИ И ПРОФИЛЯ ---
+
+@app.route('/')
+def index():
+    """Главная страница, загружает HTML-клиент."""
+    return render_template('index.html')
+
+@app.route('/api/register', methods=['POST'])
+def register():
+    """API для регистрации нового пользователя."""
+    try:
+        data = request.json
+        username = data.get('username')
+        password = data.get('password')
+        displayName = data.get('displayName')
+
+        if not username or not password or not displayName:
+            return jsonify({"status": "error", "message": "Заполните все поля"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE id = ?", (username,))
+            if cursor.fetchone():
+                return jsonify({"status": "error", "message": "Пользователь с таким ID уже есть"}), 409
+
+            email_hash = hashlib.md5(username.encode('utf-8')).hexdigest() 
+        
+            cursor.execute("""
+                INSERT INTO users (id, password, displayName, bio, avatarBase64, emailHash, role, is_banned, coins)
+                VALUES (?, ?, ?, ?, ?, ?, 'user', 0, 15)
+            """, (username, password, displayName, "", "", email_hash))
+        
+            conn.commit()
+            typeahead_index.put("user", username, displayName, "", email_hash)
+            return jsonify({"status": "success", "message": "Регистрация успешна", "user_id": username})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка регистрации: {e}"}), 500
+
+@app.route('/api/login', methods=['POST'])
+def login():
+    """API для входа пользователя."""
+    try:
+        data = request.json
+        username = data.get('username')
+        password = data.get('password')
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE id = ? AND password = ?", (username, password))
+            user_row = cursor.fetchone()
+        
+            if user_row:
+                user = dict(user_row)
+            
+                # ПРОВЕРКА НА БАН
+                if user.get('is_banned') == 1:
+                    return jsonify({"status": "error", "message": "Аккаунт заблокирован администратором"}), 403
+            
+                # Онлайн-статус в памяти; last_seen попадет в базу при очередной записи
+                presence.heartbeat(username)
+                
+                return jsonify({"status": "success", "user": {
+                    "id": user["id"], 
+                    "displayName": user["displayName"], 
+                    "avatarBase64": avatar_url(user.get("avatarBase64", ""), 128), 
+                    "emailHash": user.get("emailHash", ""),
+                    "role": user.get("role", "user"),
+                    "coins": user.get("coins", 15)
+                }})
+            else:
+                return jsonify({"status": "error", "message": "Неверный ID или пароль"}), 401
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка входа: {e}"}), 500
+
+@app.route('/api/profile/<user_id>', methods=['GET', 'POST'])
+def profile(user_id):
+    """API для просмотра и редактирования профиля."""
+    try:
+        if request.method == 'GET':
+            # GET-запрос: возвращаем текущий профиль (из кэша пользователей)
+            user = get_cached_user(user_id)
+            if not user:
+                return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+            return jsonify({"status": "success", "profile": with_avatar_size([user], 512)[0]})
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            user_row = cursor.fetchone()
+        
+            if not user_row:
+                return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+
+            user = dict(user_row)
+
+            data = request.json
+        
+            display_name = data.get("displayName", user["displayName"])
+            bio = data.get("bio", user["bio"])
+            avatar_data = data.get("avatarBase64")
+        
+            update_query = "UPDATE users SET displayName = ?, bio = ?"
+            update_params = [display_name, bio]
+        
+            if avatar_data is not None:
+                avatar_data = store_data_url(cursor, avatar_data)
+                update_query += ", avatarBase64 = ?"
+                update_params.append(avatar_data)
+        
+            update_query += " WHERE id = ?"
+            update_params.append(user_id)
+        
+            cursor.execute(update_query, tuple(update_params))
+            conn.commit()
+            invalidate_user_cache(user_id)
+        
+            # Получаем обновленные данные
+            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            updated_user = dict(cursor.fetchone())
+            schedule_renditions(avatar_data)
+            typeahead_index.put("user", user_id, updated_user["displayName"], updated_user["avatarBase64"])
+        
+            return jsonify({"status": "success", "profile": with_avatar_size([updated_user], 512)[0]})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка работы с профилем: {e}"}), 500
+
+# --- 4. МАРШРУТЫ ДЛЯ ВАЛЮТЫ И ПОДАРКОВ ---
+
+def load_gift_catalog():
+    """Тело ответа /api/gifts и его ETag."""
+    with db_connection() as conn:
+        # Добавлено условие AND quantity != 0, чтобы скрывать закончившиеся товары
+        rows = conn.execute("SELECT * FROM gifts WHERE is_active = TRUE AND quantity != 0 ORDER BY price").fetchall()
+    body = app.json.dumps({"status": "success", "gifts": [dict(row) for row in rows]})
+    return body, hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+@app.route('/api/gifts', methods=['GET'])
+def get_gifts():
+    """
+    API для получения списка доступных подарков.
+    Ответ кэшируется целиком и отдается с ETag: клиент с актуальной копией получает 304.
+    """
+    try:
+        body, etag = gift_catalog_cache.get("active", load_gift_catalog)
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        # Браузер хранит копию, но каждый раз сверяет ETag
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки подарков: {e}"}), 500
+
+
+@app.route('/api/admin/my_gifts', methods=['POST'])
+def admin_my_gifts():
+    """Список подарков, созданных конкретным администратором."""
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+
+        if not admin_id:
+            return jsonify({"status": "error", "message": "Не указан администратор"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Проверяем, что это администратор
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Нет прав"}), 403
+
+            cursor.execute("""
+                SELECT * FROM gifts
+                WHERE created_by = ?
+                ORDER BY created_by DESC, price ASC
+            """, (admin_id,))
+            gifts = [dict(r) for r in cursor.fetchall()]
+            return jsonify({"status": "success", "gifts": gifts})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки подарков администратора: {e}"}), 500
+
+def load_inventory(cursor, user_id):
+    cursor.execute("""
+        SELECT ui.*, g.name, g.image_url, g.is_rare, g.price, g.upgradeable 
+        FROM user_inventory ui 
+        JOIN gifts g ON ui.gift_id = g.id 
+        WHERE ui.user_id = ? AND ui.quantity > 0
+    """, (user_id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+@app.route('/api/inventory/<user_id>', methods=['GET'])
+def get_inventory(user_id):
+    """API для получения инвентаря пользователя."""
+    try:
+        with db_connection() as conn:
+            inventory = load_inventory(conn.cursor(), user_id)
+            return jsonify({"status": "success", "inventory": inventory})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки инвентаря: {e}"}), 500
+
+@app.route('/api/coins/<user_id>/transactions', methods=['GET'])
+def coin_transactions(user_id):
+    """История монет пользователя из журнала, новые сверху (before_id — для следующей страницы)."""
+    try:
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        before_id = request.args.get('before_id', type=int)
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, amount, balance_after, reason, ref_id, created_at
+                FROM coin_transactions
+                WHERE user_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+            transactions = [dict(row) for row in cursor.fetchall()]
+            return jsonify({"status": "success", "transactions": transactions})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки истории монет: {e}"}), 500
+
+@app.route('/api/sell_gift', methods=['POST'])
+def sell_gift():
+    """API для продажи подарка из инвентаря."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        gift_id = data.get('gift_id')
+        quantity = data.get('quantity', 1)
+        
+        if not user_id or not gift_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+        
+        if not isinstance(quantity, int) or quantity < 1:
+            return jsonify({"status": "error", "message": "Некорректное количество"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Получаем информацию о подарке
+            cursor.execute("SELECT price, is_rare FROM gifts WHERE id = ?", (gift_id,))
+            gift = cursor.fetchone()
+            if not gift:
+                return jsonify({"status": "error", "message": "Подарок не найден"}), 404
+        
+            gift_price = gift['price']
+            # Редкие подарки продаются дороже (80% от стоимости)
+            sell_price = int(gift_price * 0.8) if gift['is_rare'] else int(gift_price * 0.5)
+            total_sell_price = sell_price * quantity
+        
+            # Уменьшаем количество в инвентаре, только если подарков хватает (проверка и запись атомарны)
+            cursor.execute("""
+                UPDATE user_inventory 
+                SET quantity = quantity - ? 
+                WHERE user_id = ? AND gift_id = ? AND quantity >= ?
+                RETURNING quantity
+            """, (quantity, user_id, gift_id, quantity))
+            remaining = cursor.fetchone()
+            if remaining is None:
+                return jsonify({"status": "error", "message": "Недостаточно подарков для продажи"}), 400
+        
+            # Удаляем запись если количество стало 0
+            if remaining['quantity'] <= 0:
+                cursor.execute("DELETE FROM user_inventory WHERE user_id = ? AND gift_id = ?", (user_id, gift_id))
+        
+            # Начисляем монеты
+            new_balance = credit_coins(cursor, user_id, total_sell_price, "gift_sell", gift_id)
+            if new_balance is None:
+                return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+        
+            conn.commit()
+            invalidate_user_cache(user_id)
+        
+            return jsonify({
+                "status": "success", 
+                "message": f"Подарки проданы за {total_sell_price} монет",
+                "new_balance": new_balance,
+                "sold_quantity": quantity
+            })
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка продажи: {e}"}), 500
+
+@app.route('/api/toggle_profile_display', methods=['POST'])
+def toggle_profile_display():
+    """API для добавления/удаления подарка из профиля."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        gift_id = data.get('gift_id')
+        
+        if not user_id or not gift_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Проверяем наличие подарка в инвентаре
+            cursor.execute("SELECT displayed_in_profile FROM user_inventory WHERE user_id = ? AND gift_id = ?", (user_id, gift_id))
+            inventory_item = cursor.fetchone()
+        
+            if not inventory_item:
+                return jsonify({"status": "error", "message": "Подарок не найден в инвентаре"}), 404
+        
+            new_display_state = not inventory_item['displayed_in_profile']
+        
+            cursor.execute("""
+                UPDATE user_inventory 
+                SET displayed_in_profile = ? 
+                WHERE user_id = ? AND gift_id = ?
+            """, (new_display_state, user_id, gift_id))
+        
+            conn.commit()
+            invalidate_user_cache(user_id)
+        
+            action = "добавлен в" if new_display_state else "удален из"
+            return jsonify({
+                "status": "success", 
+                "message": f"Подарок {action} профиля",
+                "displayed_in_profile": new_display_state
+            })
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
+
+
+@app.route('/api/toggle_nft_profile_display', methods=['POST'])
+def toggle_nft_profile_display():
+    """Добавление/удаление NFT подарка из профиля пользователя."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        token_id = data.get('token_id')
+
+        if not user_id or not token_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT owner_id, displayed_in_profile FROM nft_items WHERE token_id = ?", (token_id,))
+            row = cursor.fetchone()
+            if not row:
+                return jsonify({"status": "error", "message": "NFT не найден"}), 404
+            if row["owner_id"] != user_id:
+                return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
+
+            new_state = 0 if row["displayed_in_profile"] else 1
+            cursor.execute("UPDATE nft_items SET displayed_in_profile = ? WHERE token_id = ?", (new_state, token_id))
+            conn.commit()
+            invalidate_user_cache(user_id)
+
+            return jsonify({
+                "status": "success",
+                "message": "NFT " + ("добавлен в профиль" if new_state else "убран из профиля"),
+                "displayed_in_profile": bool(new_state)
+            })
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
+
+@app.route('/api/send_gift', methods=['POST'])
+def send_gift():
+    """API для отправки подарка пользователю."""
+    try:
+        data = request.json
+        sender_id = data.get('sender_id')
+        receiver_id = data.get('receiver_id')
+        gift_id = data.get('gift_id')
+        
+        if not sender_id or not receiver_id or not gift_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        # Закончившийся лимитированный подарок отклоняем, не обращаясь к базе
+        if sold_out_gifts.check(gift_id):
+            return jsonify({"status": "error", "message": "Этот подарок закончился и исчез из продажи"}), 400
+        
+        def purchase(cursor):
+            # Получаем информацию о подарке
+            cursor.execute("SELECT * FROM gifts WHERE id = ? AND is_active = TRUE", (gift_id,))
+            gift = cursor.fetchone()
+            if not gift:
+                raise WriteRejected("Подарок не найден", 404)
+        
+            gift = dict(gift)
+            gift_price = gift['price']
+        
+            # Проверяем, есть ли подарок в наличии (если не -1)
+            if gift['quantity'] == 0:
+                raise GiftSoldOut()
+            
+            # Если количество > 0, значит это лимитированный товар: резервируем его первым,
+            # при отказе ниже (нехватка монет) резерв откатывается вместе со всей операцией
+            remaining = reserve_gift(cursor, gift_id) if gift['quantity'] > 0 else None
+        
+            # Списание монет у отправителя: условный UPDATE, без отдельной проверки баланса
+            new_balance = debit_coins(cursor, sender_id, gift_price, "gift_send", gift_id)
+        
+            # Добавляем подарок в инвентарь получателя
+            cursor.execute("""
+                INSERT OR REPLACE INTO user_inventory (user_id, gift_id, quantity)
+                VALUES (?, ?, COALESCE((SELECT quantity FROM user_inventory WHERE user_id = ? AND gift_id = ?), 0) + 1)
+            """, (receiver_id, gift_id, receiver_id, gift_id))
+
+            # В тексте сообщения оставляем только имя подарка, без base64/URL картинки
+            return f"Подарок: {gift['name']}", gift_id, (new_balance, remaining)
+
+        # Связь чата и сводки пишет run_message_write (finish_message)
+        chat_id = get_chat_id(sender_id, receiver_id)
+        message_data, (new_balance, remaining) = run_message_write(
+            chat_id, sender_id, receiver_id, prepare=purchase,
+            run=lambda operation: run_purchase(gift_id, operation))
+        invalidate_user_cache(sender_id, receiver_id)
+        if remaining is not None:
+            invalidate_gift_catalog()
+            if remaining == 0:
+                sold_out_gifts.mark(gift_id)
+
+        # Подарок оплачен; 202 — сообщение о нем еще доставляется (message.pending)
+        return jsonify({
+            "status": "success", 
+            "message": message_data,
+            "new_balance": new_balance
+        }), 202 if message_data.get("pending") else 200
+        
+    except GiftSoldOut as e:
+        sold_out_gifts.mark(gift_id)
+        invalidate_gift_catalog()
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except WriteRejected as e:
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка отправки подарка: {e}"}), 500
+
+@app.route('/api/admin/create_gift', methods=['POST'])
+def admin_create_gift():
+    """API для создания нового подарка администратором."""
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        name = data.get('name')
+        price = data.get('price')
+        image_url = data.get('image_url')
+        is_rare = data.get('is_rare', False)
+        quantity = data.get('quantity', -1)
+        upgradeable = data.get('upgradeable', False)
+        
+        if not admin_id or not name or not price or not image_url:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Проверяем права администратора
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
+        
+            # Создаем уникальный ID для подарка
+            gift_id = f"gift_{int(datetime.now().timestamp())}"
+            image_url = store_data_url(cursor, image_url)
+        
+            cursor.execute("""
+                INSERT INTO gifts (id, name, price, image_url, is_rare, created_by, quantity, is_active, upgradeable)
+                VALUES (?, ?, ?, ?, ?, ?, ?, TRUE, ?)
+            """, (gift_id, name, price, image_url, is_rare, admin_id, quantity, upgradeable))
+        
+            conn.commit()
+            invalidate_gift_catalog()
+        
+            return jsonify({
+                "status": "success", 
+                "message": "Подарок успешно создан",
+                "gift_id": gift_id
+            })
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка создания подарка: {e}"}), 500
+
+@app.route('/api/admin/delete_gift', methods=['POST'])
+def admin_delete_gift():
+    """API для удаления подарка (скрытия из магазина)."""
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        gift_id = data.get('gift_id')
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Проверка прав админа
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Нет прав"}), 403
+
+            # Скрываем подарок
+            cursor.execute("UPDATE gifts SET is_active = FALSE WHERE id = ?", (gift_id,))
+            conn.commit()
+            invalidate_gift_catalog()
+        
+            return jsonify({"status": "success", "message": "Подарок удален из магазина"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/admin/toggle_gift_upgradeable', methods=['POST'])
+def admin_toggle_gift_upgradeable():
+    """Админ включает/выключает возможность апгрейда подарка в NFT."""
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        gift_id = data.get('gift_id')
+        enable = data.get('enable')
+
+        if admin_id is None or gift_id is None or enable is None:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Нет прав"}), 403
+
+            cursor.execute("UPDATE gifts SET upgradeable = ? WHERE id = ?", (1 if enable else 0, gift_id))
+            conn.commit()
+            invalidate_gift_catalog()
+
+            return jsonify({"status": "success", "message": "Настройка апгрейда обновлена", "upgradeable": bool(enable)})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка: {e}"}), 500
+
+def load_profile_gifts(user_id):
+    """Подарки и NFT, которые пользователь показывает в профиле."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Подарки в профиле пользователя (обычные)
+        cursor.execute("""
+            SELECT g.id, g.name, g.image_url, g.is_rare
+            FROM user_inventory ui
+            JOIN gifts g ON ui.gift_id = g.id
+            WHERE ui.user_id = ? AND ui.displayed_in_profile = TRUE AND ui.quantity > 0
+        """, (user_id,))
+        profile_gifts = [dict(row) for row in cursor.fetchall()]
+
+        # NFT подарки, отмеченные для профиля
+        cursor.execute("""
+            SELECT ni.token_id, g.id, g.name, g.image_url, g.is_rare,
+                   ni.serial_number, ni.price, ni.bg_variant
+            FROM nft_items ni
+            JOIN gifts g ON ni.base_gift_id = g.id
+            WHERE ni.owner_id = ? AND ni.displayed_in_profile = 1
+        """, (user_id,))
+        profile_nft = [dict(row) for row in cursor.fetchall()]
+    return profile_gifts, profile_nft
+
+@app.route('/api/user/<user_id>', methods=['GET'])
+def get_user(user_id):
+    """API для получения информации о пользователе с его инвентарем."""
+    try:
+        # Основная информация о пользователе
+        user_row = get_cached_user(user_id)
+    
+        if not user_row:
+            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+    
+        user = {key: user_row[key] for key in ("id", "displayName", "bio", "avatarBase64", "emailHash", "coins")}
+        user = with_avatar_size([user], 128)[0]
+        user['profile_gifts'], user['profile_nft_gifts'] = profile_gifts_cache.get(
+            user_id, lambda: load_profile_gifts(user_id))
+        return jsonify({"status": "success", "user": user})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки пользователя: {e}"}), 500
+
+# --- 5. АДМИНИСТРАТИВНЫЕ МАРШРУТЫ ---
+
+def admin_user_updates(data):
+    """Проверенные поля пользователя из запроса админа (колонка -> значение)."""
+    updates = {}
+    if data.get('displayName') is not None:
+        updates["displayName"] = data['displayName']
+    new_password = data.get('password')
+    if new_password is not None and new_password.strip():
+        updates["password"] = new_password
+    if data.get('is_banned') in [0, 1]:
+        updates["is_banned"] = data['is_banned']
+    new_coins = data.get('coins')
+    if new_coins is not None and new_coins >= 0:
+        updates["coins"] = new_coins
+    return updates
+
+@app.route('/api/admin/users', methods=['POST'])
+def admin_manage_users():
+    """API для администрирования пользователей."""
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        action = data.get('action')
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Проверка, является ли пользователь администратором
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
+
+            if action == 'list':
+                # Вернуть список всех пользователей, кроме самого администратора
+                cursor.execute("SELECT id, displayName, role, is_banned, bio, coins FROM users WHERE id != ?", (admin_id,))
+                users_list = [dict(row) for row in cursor.fetchall()]
+                return jsonify({"status": "success", "users": users_list})
+
+            elif action == 'edit':
+                target_id = data.get('target_id')
+            
+                if not target_id:
+                    return jsonify({"status": "error", "message": "Не указан целевой пользователь"}), 400
+            
+                updates = admin_user_updates(data)
+                if not updates:
+                    return jsonify({"status": "success", "message": "Нет данных для обновления"})
+            
+                query = "UPDATE users SET " + ", ".join(f"{column} = ?" for column in updates) + " WHERE id = ?"
+                cursor.execute(query, (*updates.values(), target_id))
+                conn.commit()
+                invalidate_user_cache(target_id)
+                if "displayName" in updates:
+                    typeahead_index.put("user", target_id, updates["displayName"])
+                return jsonify({"status": "success", "message": f"Профиль пользователя {target_id} обновлен."})
+
+            elif action == 'bulk_edit':
+                # Массовая правка идет фоновой задачей: ответ сразу, прогресс — в /api/jobs/<id>
+                target_ids = data.get('target_ids')
+                if not target_ids or not isinstance(target_ids, list):
+                    return jsonify({"status": "error", "message": "Не указаны целевые пользователи"}), 400
+
+                updates = admin_user_updates(data)
+                # Один пароль на много пользователей не задаем
+                updates.pop("password", None)
+                if not updates:
+                    return jsonify({"status": "success", "message": "Нет данных для обновления"})
+
+                job_id = job_queue.enqueue("admin_bulk_edit_users",
+                                           {"target_ids": target_ids, "updates": updates}, cursor)
+                conn.commit()
+                job_queue.wake()
+                return jsonify({"status": "success", "job_id": job_id}), 202
+
+            return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
+    except JobQueueFullError:
+        return jsonify({"status": "error", "message": "Очередь задач переполнена, попробуйте позже"}), 503
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка администрирования: {e}"}), 500
+
+@job_handler("admin_bulk_edit_users")
+def run_admin_bulk_edit_job(job_id, payload):
+    """
+    Массовая правка пользователей пачками по JOB_BATCH_SIZE: каждая пачка — своя короткая
+    транзакция, чтобы запросы пользователей не ждали блокировку записи все время задачи.
+    Повтор после сбоя безопасен: правка просто записывает те же значения.
+    """
+    updates = payload["updates"]
+    target_ids = payload["target_ids"]
+    set_clause = ", ".join(f"{column} = ?" for column in updates)
+    processed = 0
+    for start in range(0, len(target_ids), JOB_BATCH_SIZE):
+        batch = target_ids[start:start + JOB_BATCH_SIZE]
+        with db_connection() as conn:
+            conn.execute(f"UPDATE users SET {set_clause} WHERE id IN ({', '.join('?' * len(batch))})",
+                         (*updates.values(), *batch))
+            conn.commit()
+        invalidate_user_cache(*batch)
+        if "displayName" in updates:
+            for target_id in batch:
+                typeahead_index.put("user", target_id, updates["displayName"])
+        processed += len(batch)
+        job_queue.progress(job_id, {"processed": processed, "total": len(target_ids)})
+    return {"processed": processed, "total": len(target_ids)}
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус фоновой задачи: queued/running/done/failed, попытки, результат или ошибка."""
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "Задача не найдена"}), 404
+        return jsonify({"status": "success", "job": job})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка получения задачи: {e}"}), 500
+
+def retention_chat_id(data):
+    """chat_id политики хранения: канал (room_id), личный чат (user_a + user_b) или chat_id."""
+    if data.get('room_id'):
+        return f"channel_{data['room_id']}"
+    if data.get('user_a') and data.get('user_b'):
+        return get_chat_id(data['user_a'], data['user_b'])
+    return data.get('chat_id')
+
+@app.route('/api/admin/retention', methods=['POST'])
+def admin_retention():
+    """
+    Сроки хранения сообщений и архив.
+    actions: get — политики и размеры хранилища; set — archive_after_days / delete_after_days
+    для чата или канала; reset — вернуть срок по умолчанию; run — запустить обслуживание сейчас.
+    """
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        action = data.get('action')
+
+        if get_user_role(admin_id) != 'admin':
+            return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
+
+        if action == 'get':
+            with db_connection() as conn:
+                policies = [dict(row) for row in conn.execute(
+                    "SELECT * FROM retention_policies ORDER BY updated_at DESC").fetchall()]
+            return jsonify({"status": "success", "policies": policies,
+                            "default_archive_after_days": MESSAGE_ARCHIVE_AFTER_DAYS,
+                            "storage": retention_storage_stats()})
+
+        if action == 'run':
+            job_id = job_queue.enqueue("retention", {})
+            return jsonify({"status": "success", "job_id": job_id}), 202
+
+        chat_id = retention_chat_id(data)
+        if not chat_id:
+            return jsonify({"status": "error", "message": "Не указан чат или канал"}), 400
+
+        if action == 'set':
+            archive_days = data.get('archive_after_days')
+            delete_days = data.get('delete_after_days')
+            for value, minimum in ((archive_days, 0), (delete_days, 1)):
+                if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < minimum):
+                    return jsonify({"status": "error", "message": "Неверный срок хранения"}), 400
+            with db_connection() as conn:
+                conn.execute("""
+                    INSERT INTO retention_policies
+                        (chat_id, archive_after_days, delete_after_days, updated_by, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                        archive_after_days = excluded.archive_after_days,
+                        delete_after_days = excluded.delete_after_days,
+                        updated_by = excluded.updated_by,
+                        updated_at = excluded.updated_at
+                """, (chat_id, archive_days, delete_days, admin_id, datetime.now().isoformat(timespec='seconds')))
+                conn.commit()
+            return jsonify({"status": "success", "chat_id": chat_id})
+
+        if action == 'reset':
+            with db_connection() as conn:
+                conn.execute("DELETE FROM retention_policies WHERE chat_id = ?", (chat_id,))
+                conn.commit()
+            return jsonify({"status": "success", "chat_id": chat_id})
+
+        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
+    except JobQueueFullError:
+        return jsonify({"status": "error", "message": "Очередь задач переполнена, попробуйте позже"}), 503
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка настройки хранения: {e}"}), 500
+
+@app.route('/api/metrics/writes', methods=['GET'])
+def write_metrics():
+    """Метрики группового коммита (размеры групп, время коммита), распродажи, отметок прочтения и шардов."""
+    metrics = write_batcher.metrics() if write_batcher is not None else {"enabled": False}
+    metrics["flash_sale"] = {"enabled": FLASH_SALE_ENABLED, **sold_out_gifts.metrics()}
+    metrics["read_receipts"] = read_receipts.metrics()
+    metrics["message_shards"] = message_shards.metrics()
+    if flash_sale_writer is not None and flash_sale_writer is not write_batcher:
+        metrics["flash_sale"]["writer"] = flash_sale_writer.metrics()
+    return jsonify({"status": "success", "metrics": metrics})
+
+@app.route('/api/metrics/presence', methods=['GET'])
+def presence_metrics():
+    """Онлайн-пользователи, heartbeat-ы и пакетная запись last_seen."""
+    return jsonify({"status": "success", "metrics": presence.metrics()})
+
+@app.route('/api/metrics/cache', methods=['GET'])
+def cache_metrics():
+    """Попадания и промахи кэшей чтения."""
+    return jsonify({"status": "success", "caches": [cache.stats() for cache in READ_CACHES]})
+
+
+# --- 6.1. NFT ПОДАРКИ И МАРКЕТ ---
+
+@app.route('/api/nft/upgrade', methods=['POST'])
+def nft_upgrade_from_inventory():
+    """
+    Юзер сам апгрейдит обычный подарок из инвентаря в NFT.
+    Требует, чтобы подарок был помечен как upgradeable.
+    """
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        gift_id = data.get('gift_id')
+        price = data.get('price')
+
+        if not user_id or not gift_id or not price:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        price = int(price)
+        if price <= 0:
+            return jsonify({"status": "error", "message": "Некорректная цена"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Проверяем подарок и то, что он апгрейдится
+            cursor.execute("SELECT id, upgradeable FROM gifts WHERE id = ?", (gift_id,))
+            gift_row = cursor.fetchone()
+            if not gift_row:
+                return jsonify({"status": "error", "message": "Подарок не найден"}), 404
+            if not gift_row["upgradeable"]:
+                return jsonify({"status": "error", "message": "Этот подарок нельзя апгрейдить в NFT"}), 400
+
+            # Списываем 1 из инвентаря (проверка наличия — в самом UPDATE)
+            if not take_from_inventory(cursor, user_id, gift_id):
+                return jsonify({"status": "error", "message": "У вас нет такого подарка для апгрейда"}), 400
+
+            token_id = mint_nfts(cursor, gift_id, [user_id], user_id, price)[0]["token_id"]
+
+            conn.commit()
+            invalidate_user_cache(user_id)
+
+            cursor.execute("""
+                SELECT ni.*, g.name, g.image_url
+                FROM nft_items ni
+                JOIN gifts g ON ni.base_gift_id = g.id
+                WHERE ni.token_id = ?
+            """, (token_id,))
+            nft_row = dict(cursor.fetchone())
+
+            return jsonify({"status": "success", "nft": nft_row})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка апгрейда подарка в NFT: {e}"}), 500
+
+
+@app.route('/api/status/<user_id>', methods=['GET'])
+def user_status(user_id):
+    """Статус онлайн / last_seen пользователя."""
+    try:
+        status = presence.bulk([user_id]).get(user_id)
+        if status is None:
+            return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+        return jsonify({"status": "success", **status})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка статуса: {e}"}), 500
+
+@app.route('/api/presence', methods=['POST'])
+def bulk_presence():
+    """Статусы сразу нескольких пользователей. Тело: user_ids (до PRESENCE_BULK_MAX)."""
+    try:
+        data = request.json
+        user_ids = data.get('user_ids')
+        if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+            return jsonify({"status": "error", "message": "user_ids должен быть списком ID"}), 400
+        user_ids = list(dict.fromkeys(user_ids))
+        if len(user_ids) > PRESENCE_BULK_MAX:
+            return jsonify({"status": "error",
+                            "message": f"Не больше {PRESENCE_BULK_MAX} пользователей за запрос"}), 400
+        return jsonify({"status": "success", "presence": presence.bulk(user_ids) if user_ids else {}})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка статуса: {e}"}), 500
+
+
+@app.route('/api/rooms', methods=['POST'])
+def rooms_api():
+    """
+    Простое API для групп и каналов.
+    actions:
+      - create: {owner_id, name, type}
+      - list: {user_id}
+      - join: {room_id, user_id}
+      - leave: {room_id, user_id}
+    """
+    try:
+        data = request.json
+        action = data.get("action")
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            if action == "create":
+                owner_id = data.get("owner_id")
+                name = data.get("name")
+                # поддерживаем только каналы для публичного поиска
+                room_type = "channel"
+                avatar_base64 = data.get("avatarBase64")
+                about = data.get("about", "")
+                if not owner_id or not name:
+                    return jsonify({"status": "error", "message": "Неполные данные"}), 400
+                avatar_base64 = store_data_url(cursor, avatar_base64)
+
+                room_id = f"{room_type}_{uuid.uuid4().hex[:8]}"
+                cursor.execute("""
+                    INSERT INTO rooms (id, name, type, owner_id, avatarBase64, about)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (room_id, name, room_type, owner_id, avatar_base64, about))
+                cursor.execute("""
+                    INSERT INTO room_members (room_id, user_id, role)
+                    VALUES (?, ?, 'owner')
+                """, (room_id, owner_id))
+                # Пустой канал в списке чатов сортируется по времени создания
+                cursor.execute("""
+                    INSERT INTO channel_state (room_id, last_at) VALUES (?, ?)
+                """, (room_id, datetime.now().isoformat(timespec='seconds')))
+            
+                conn.commit()
+                schedule_renditions(avatar_base64)
+                typeahead_index.put("channel", room_id, name, avatar_base64)
+                message_bus.add_topic(owner_id, f"room:{room_id}")
+                return jsonify({"status": "success", "room": {"id": room_id, "name": name, "type": room_type}})
+
+            elif action == "list":
+                user_id = data.get("user_id")
+                if not user_id:
+                    return jsonify({"status": "error", "message": "Не указан пользователь"}), 400
+                cursor.execute("""
+                    SELECT r.id, r.name, r.type, r.owner_id, r.avatarBase64, r.about, rm.role
+                    FROM room_members rm
+                    JOIN rooms r ON rm.room_id = r.id
+                    WHERE rm.user_id = ?
+                """, (user_id,))
+                rooms = with_avatar_size([dict(row) for row in cursor.fetchall()], 48)
+                return jsonify({"status": "success", "rooms": rooms})
+
+            elif action == "join":
+                room_id = data.get("room_id")
+                user_id = data.get("user_id")
+                if not room_id or not user_id:
+                    return jsonify({"status": "error", "message": "Неполные данные"}), 400
+            
+                # Проверяем, что это канал
+                cursor.execute("SELECT type FROM rooms WHERE id = ?", (room_id,))
+                room = cursor.fetchone()
+                if not room:
+                    return jsonify({"status": "error", "message": "Канал не найден"}), 404
+                if room["type"] != "channel":
+                    return jsonify({"status": "error", "message": "Это не канал"}), 400
+            
+                cursor.execute("""
+                    INSERT OR IGNORE INTO room_members (room_id, user_id, role)
+                    VALUES (?, ?, 'member')
+                """, (room_id, user_id))
+                # Старые посты нового подписчика непрочитанными не считаются
+                if cursor.rowcount:
+                    mark_channel_read(cursor, room_id, user_id)
+            
+                conn.commit()
+                message_bus.add_topic(user_id, f"room:{room_id}")
+                return jsonify({"status": "success"})
+
+            elif action == "leave":
+                room_id = data.get("room_id")
+                user_id = data.get("user_id")
+                if not room_id or not user_id:
+                    return jsonify({"status": "error", "message": "Неполные данные"}), 400
+                cursor.execute("""
+                    DELETE FROM room_members WHERE room_id = ? AND user_id = ?
+                """, (room_id, user_id))
+                conn.commit()
+                message_bus.remove_topic(user_id, f"room:{room_id}")
+                return jsonify({"status": "success"})
+
+            elif action == "update":
+                room_id = data.get("room_id")
+                owner_id = data.get("owner_id")
+                new_name = data.get("name")
+                new_about = data.get("about")
+                new_avatar = data.get("avatarBase64")
+
+                if not room_id or not owner_id:
+                    return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+                cursor.execute("SELECT owner_id FROM rooms WHERE id = ?", (room_id,))
+                room = cursor.fetchone()
+                if not room:
+                    return jsonify({"status": "error", "message": "Группа не найдена"}), 404
+                if room["owner_id"] != owner_id:
+                    return jsonify({"status": "error", "message": "Только владелец может изменять группу"}), 403
+
+                fields = []
+                params = []
+                if new_name is not None:
+                    fields.append("name = ?")
+                    params.append(new_name)
+                if new_about is not None:
+                    fields.append("about = ?")
+                    params.append(new_about)
+                if new_avatar is not None:
+                    new_avatar = store_data_url(cursor, new_avatar)
+                    fields.append("avatarBase64 = ?")
+                    params.append(new_avatar)
+                if fields:
+                    params.append(room_id)
+                    cursor.execute("UPDATE rooms SET " + ", ".join(fields) + " WHERE id = ?", tuple(params))
+                    conn.commit()
+                    schedule_renditions(new_avatar)
+                    typeahead_index.put("channel", room_id, new_name, new_avatar)
+                return jsonify({"status": "success", "message": "Группа обновлена"})
+
+            return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка групп: {e}"}), 500
+
+
+@app.route('/api/room_broadcast', methods=['POST'])
+def room_broadcast():
+    """
+    Отправка одного и того же сообщения всем участникам группы/канала.
+    Сообщение хранится один раз; подписчики видят его через room_members и channel_state,
+    поэтому стоимость поста не зависит от числа подписчиков.
+    """
+    try:
+        data = request.json
+        sender_id = data.get('sender_id')
+        room_id = data.get('room_id')
+        text = data.get('text')
+
+        if not sender_id or not room_id or not text:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        def check_room(cursor):
+            # Проверяем, что комната существует и что это канал
+            cursor.execute("SELECT id, name, type FROM rooms WHERE id = ?", (room_id,))
+            room = cursor.fetchone()
+            if not room:
+                raise WriteRejected("Группа не найдена", 404)
+            if room["type"] != "channel":
+                raise WriteRejected("Только каналы поддерживают рассылку")
+
+            # Роль отправителя — поиском по первичному ключу, без чтения всех участников
+            cursor.execute("""
+                SELECT role FROM room_members
+                WHERE room_id = ? AND user_id = ?
+            """, (room_id, sender_id))
+            member = cursor.fetchone()
+
+            if not member:
+                raise WriteRejected("Вы не состоите в этой группе", 403)
+
+            # проверяем роль отправителя: только owner или admin канала могут писать
+            if member["role"] not in ("owner", "admin"):
+                raise WriteRejected("Только владелец или админ канала может писать в канал", 403)
+
+            return text, None, None
+
+        # Для каналов используем специальный chat_id вида "channel_{room_id}";
+        # сообщение хранится одно на канал (все участники видят одно и то же)
+        channel_chat_id = f"channel_{room_id}"
+        message, _ = run_message_write(channel_chat_id, sender_id, room_id, prepare=check_room)
+        return jsonify({"status": "success", "message": "Сообщение отправлено в канал"}), \
+            202 if message.get("pending") else 200
+    except WriteRejected as e:
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка рассылки по группе: {e}"}), 500
+
+@app.route('/api/admin/upgrade_to_nft', methods=['POST'])
+def admin_upgrade_to_nft():
+    """
+    Админ создает/апгрейдит NFT-подарок для пользователя.
+    Из инвентаря пользователя списывается 1 обычный подарок (если он есть),
+    и создается уникальный NFT-токен с порядковым номером и ценой.
+    """
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        owner_id = data.get('owner_id')
+        base_gift_id = data.get('gift_id')
+        price = data.get('price')
+
+        if not admin_id or not owner_id or not base_gift_id or not price:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Проверяем права администратора
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Нет прав"}), 403
+
+            # Проверяем, что базовый подарок существует
+            cursor.execute("SELECT id FROM gifts WHERE id = ?", (base_gift_id,))
+            base_gift = cursor.fetchone()
+            if not base_gift:
+                return jsonify({"status": "error", "message": "Такого подарка не существует"}), 404
+
+            # Списываем 1 подарок из инвентаря пользователя (если есть)
+            take_from_inventory(cursor, owner_id, base_gift_id)
+
+            token_id = mint_nfts(cursor, base_gift_id, [owner_id], admin_id, int(price))[0]["token_id"]
+
+            conn.commit()
+            invalidate_user_cache(owner_id)
+
+            cursor.execute("""
+                SELECT ni.*, g.name, g.image_url
+                FROM nft_items ni
+                JOIN gifts g ON ni.base_gift_id = g.id
+                WHERE ni.token_id = ?
+            """, (token_id,))
+            token_row = dict(cursor.fetchone())
+
+            return jsonify({"status": "success", "nft": token_row})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка апгрейда в NFT: {e}"}), 500
+
+
+@app.route('/api/admin/batch_mint', methods=['POST'])
+def admin_batch_mint():
+    """
+    Админ выпускает N NFT базового подарка для N владельцев одной транзакцией.
+    Как и при одиночном апгрейде, у владельца списывается 1 обычный подарок (если есть).
+    """
+    try:
+        data = request.json
+        admin_id = data.get('admin_id')
+        owner_ids = data.get('owner_ids')
+        base_gift_id = data.get('gift_id')
+        price = data.get('price')
+
+        if not admin_id or not owner_ids or not isinstance(owner_ids, list) or not base_gift_id or not price:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+        if len(owner_ids) > NFT_BATCH_MINT_MAX:
+            return jsonify({"status": "error", "message": f"Не больше {NFT_BATCH_MINT_MAX} NFT за раз"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Проверяем права администратора
+            if get_user_role(admin_id) != 'admin':
+                return jsonify({"status": "error", "message": "Нет прав"}), 403
+
+            cursor.execute("SELECT id FROM gifts WHERE id = ?", (base_gift_id,))
+            if not cursor.fetchone():
+                return jsonify({"status": "error", "message": "Такого подарка не существует"}), 404
+
+            unique_owners = list(set(owner_ids))
+            placeholders = ",".join("?" * len(unique_owners))
+            cursor.execute(f"SELECT COUNT(*) FROM users WHERE id IN ({placeholders})", unique_owners)
+            if cursor.fetchone()[0] != len(unique_owners):
+                return jsonify({"status": "error", "message": "Не все владельцы найдены"}), 404
+
+            for owner_id in owner_ids:
+                take_from_inventory(cursor, owner_id, base_gift_id)
+            tokens = mint_nfts(cursor, base_gift_id, owner_ids, admin_id, int(price))
+
+            conn.commit()
+            invalidate_user_cache(*owner_ids)
+
+            return jsonify({"status": "success", "minted": len(tokens), "tokens": tokens})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка выпуска NFT: {e}"}), 500
+
+
+NFT_MARKET_PAGE_SIZE = 50
+NFT_MARKET_MAX_PAGE_SIZE = 200
+# Сортировки маркета: колонка и направление; второй ключ — token_id в том же направлении
+NFT_MARKET_SORTS = {
+    "newest": ("created_at", "DESC"),
+    "price_asc": ("price", "ASC"),
+    "price_desc": ("price", "DESC"),
+    "serial_asc": ("serial_number", "ASC"),
+}
+# Фильтры маркета: параметр запроса, тип и условие
+NFT_MARKET_FILTERS = (
+    ("gift_id", str, "ni.base_gift_id = ?"),
+    ("min_price", int, "ni.price >= ?"),
+    ("max_price", int, "ni.price <= ?"),
+    ("bg_variant", int, "ni.bg_variant = ?"),
+    ("min_serial", int, "ni.serial_number >= ?"),
+    ("max_serial", int, "ni.serial_number <= ?"),
+)
+
+def encode_market_cursor(value, token_id):
+    return base64.urlsafe_b64encode(json.dumps([value, token_id]).encode()).decode().rstrip("=")
+
+def decode_market_cursor(value):
+    """Ключ сортировки и token_id последнего NFT страницы; ValueError, если курсор испорчен."""
+    try:
+        sort_value, token_id = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Некорректный курсор")
+    return sort_value, token_id
+
+def query_nft_market(cursor, args):
+    """
+    Страница маркета по параметрам запроса (фильтры, sort, limit, cursor).
+    Keyset-пагинация: следующая страница начинается строго после (ключ, token_id)
+    последнего NFT, поэтому каждая страница — проход по индексу без OFFSET.
+    Возвращает (items, next_cursor); next_cursor = None на последней странице.
+    """
+    sort = args.get('sort', 'newest')
+    if sort not in NFT_MARKET_SORTS:
+        raise ValueError("Неизвестная сортировка")
+    column, direction = NFT_MARKET_SORTS[sort]
+    limit = max(1, min(args.get('limit', NFT_MARKET_PAGE_SIZE, type=int), NFT_MARKET_MAX_PAGE_SIZE))
+
+    conditions = ["ni.is_listed = 1"]
+    params = []
+    for name, kind, condition in NFT_MARKET_FILTERS:
+        value = args.get(name, type=kind)
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    if args.get('cursor'):
+        sort_value, token_id = decode_market_cursor(args['cursor'])
+        conditions.append(f"(ni.{column}, ni.token_id) {'<' if direction == 'DESC' else '>'} (?, ?)")
+        params += [sort_value, token_id]
+
+    cursor.execute(f"""
+        SELECT ni.*, g.name, g.image_url
+        FROM nft_items ni
+        JOIN gifts g ON ni.base_gift_id = g.id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY ni.{column} {direction}, ni.token_id {direction}
+        LIMIT ?
+    """, (*params, limit + 1))
+    items = [dict(row) for row in cursor.fetchall()]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_market_cursor(items[-1][column], items[-1]["token_id"])
+    return items, next_cursor
+
+@app.route('/api/nft/market', methods=['GET'])
+def nft_market_list():
+    """
+    NFT, выставленные на продажу, по страницам.
+    Фильтры: gift_id, min_price/max_price, bg_variant, min_serial/max_serial;
+    sort: newest, price_asc, price_desc, serial_asc; limit и cursor из next_cursor.
+    """
+    try:
+        with db_connection() as conn:
+            items, next_cursor = query_nft_market(conn.cursor(), request.args)
+            return jsonify({"status": "success", "items": items, "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки маркета: {e}"}), 500
+
+def load_market_floor(gift_id):
+    with db_connection() as conn:
+        # Отдельные подзапросы: MIN берется одним шагом по idx_nft_market_gift_price
+        row = conn.execute("""
+            SELECT
+                (SELECT MIN(price) FROM nft_items WHERE base_gift_id = ?1 AND is_listed = 1) AS floor_price,
+                (SELECT COUNT(*) FROM nft_items WHERE base_gift_id = ?1 AND is_listed = 1) AS listed_count
+        """, (gift_id,)).fetchone()
+    return dict(row)
+
+@app.route('/api/nft/market/floors', methods=['GET'])
+def nft_market_floors():
+    """Минимальная цена (floor) и число NFT на продаже по каждому базовому подарку."""
+    try:
+        with db_connection() as conn:
+            gifts = conn.execute("SELECT id, name, image_url FROM gifts ORDER BY name").fetchall()
+        floors = []
+        for gift in gifts:
+            floor = market_floor_cache.get(gift["id"], lambda: load_market_floor(gift["id"]))
+            if floor["listed_count"]:
+                floors.append({"base_gift_id": gift["id"], "name": gift["name"],
+                               "image_url": gift["image_url"], **floor})
+        return jsonify({"status": "success", "floors": floors})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки маркета: {e}"}), 500
+
+
+NFT_STATS_MAX_CANDLES = 24 * 30
+NFT_ORDER_BOOK_DEPTH = 20
+
+def load_nft_gift_stats(cursor, gift_id, candles=0, depth=0):
+    """
+    Статистика базового подарка: floor, последняя сделка, объем за 24 часа
+    (по часовым свечам), при запросе — свечи OHLC и стакан (цены и число NFT на продаже).
+    """
+    stats = {"base_gift_id": gift_id, **market_floor_cache.get(gift_id, lambda: load_market_floor(gift_id))}
+    cursor.execute("""
+        SELECT last_price, last_trade_at, trade_count, volume_total, high_price, low_price
+        FROM nft_gift_stats WHERE base_gift_id = ?
+    """, (gift_id,))
+    row = cursor.fetchone()
+    stats.update(dict(row) if row else {"last_price": None, "last_trade_at": None, "trade_count": 0,
+                                        "volume_total": 0, "high_price": None, "low_price": None})
+    # Окно 24 часа — последние NFT_STATS_WINDOW_SECONDS / NFT_STATS_BUCKET_SECONDS свечей, включая текущую
+    window_start = (int(time.time()) // NFT_STATS_BUCKET_SECONDS + 1) * NFT_STATS_BUCKET_SECONDS - NFT_STATS_WINDOW_SECONDS
+    cursor.execute("""
+        SELECT COALESCE(SUM(volume), 0) AS volume_24h, COALESCE(SUM(trades), 0) AS trades_24h,
+               MAX(high_price) AS high_24h, MIN(low_price) AS low_24h
+        FROM nft_price_buckets WHERE base_gift_id = ? AND bucket_start >= ?
+    """, (gift_id, window_start))
+    stats.update(dict(cursor.fetchone()))
+    if candles:
+        cursor.execute("""
+            SELECT bucket_start, open_price, high_price, low_price, close_price, volume, trades
+            FROM nft_price_buckets WHERE base_gift_id = ?
+            ORDER BY bucket_start DESC LIMIT ?
+        """, (gift_id, candles))
+        stats["candles"] = [dict(row) for row in reversed(cursor.fetchall())]
+    if depth:
+        # Идет по idx_nft_market_gift_price и останавливается после depth уровней цены
+        cursor.execute("""
+            SELECT price, COUNT(*) AS count FROM nft_items
+            WHERE base_gift_id = ? AND is_listed = 1
+            GROUP BY price ORDER BY price LIMIT ?
+        """, (gift_id, depth))
+        stats["asks"] = [dict(row) for row in cursor.fetchall()]
+    return stats
+
+@app.route('/api/nft/stats', methods=['GET'])
+def nft_stats():
+    """
+    Статистика маркета NFT из готовых итогов. С gift_id — один подарок, свечи
+    (candles — сколько последних часов) и стакан (depth уровней цены);
+    без gift_id — итоги по всем подаркам, у которых были продажи.
+    """
+    try:
+        gift_id = request.args.get('gift_id')
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if gift_id:
+                candles = max(0, min(request.args.get('candles', 24, type=int), NFT_STATS_MAX_CANDLES))
+                depth = max(0, min(request.args.get('depth', NFT_ORDER_BOOK_DEPTH, type=int), NFT_ORDER_BOOK_DEPTH))
+                return jsonify({"status": "success", "stats": load_nft_gift_stats(cursor, gift_id, candles, depth)})
+            cursor.execute("SELECT base_gift_id FROM nft_gift_stats ORDER BY volume_total DESC")
+            traded_gift_ids = [row[0] for row in cursor.fetchall()]
+            return jsonify({"status": "success",
+                            "stats": [load_nft_gift_stats(cursor, traded_id) for traded_id in traded_gift_ids]})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки статистики маркета: {e}"}), 500
+
+
+def load_user_nfts(cursor, user_id):
+    cursor.execute("""
+        SELECT ni.*, g.name, g.image_url
+        FROM nft_items ni
+        JOIN gifts g ON ni.base_gift_id = g.id
+        WHERE ni.owner_id = ?
+        ORDER BY ni.created_at DESC
+    """, (user_id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+@app.route('/api/nft/my/<user_id>', methods=['GET'])
+def nft_my_items(user_id):
+    """NFT подарки конкретного пользователя."""
+    try:
+        with db_connection() as conn:
+            items = load_user_nfts(conn.cursor(), user_id)
+            return jsonify({"status": "success", "items": items})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка загрузки NFT пользователя: {e}"}), 500
+
+
+@app.route('/api/nft/list', methods=['POST'])
+def nft_list_item():
+    """Выставить или снять NFT с маркета."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        token_id = data.get('token_id')
+        price = data.get('price')
+        is_listed = data.get('is_listed', True)
+
+        if not user_id or not token_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT owner_id, base_gift_id FROM nft_items WHERE token_id = ?", (token_id,))
+            row = cursor.fetchone()
+            if not row:
+                return jsonify({"status": "error", "message": "NFT не найден"}), 404
+            if row['owner_id'] != user_id:
+                return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
+
+            if is_listed:
+                if not price or int(price) <= 0:
+                    return jsonify({"status": "error", "message": "Некорректная цена"}), 400
+                cursor.execute("""
+                    UPDATE nft_items
+                    SET is_listed = 1, price = ?
+                    WHERE token_id = ?
+                """, (int(price), token_id))
+            else:
+                cursor.execute("""
+                    UPDATE nft_items
+                    SET is_listed = 0
+                    WHERE token_id = ?
+                """, (token_id,))
+
+            conn.commit()
+            invalidate_user_cache(user_id)
+            invalidate_market_floor(row['base_gift_id'])
+            return jsonify({"status": "success", "message": "Статус NFT обновлен"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка выставления NFT: {e}"}), 500
+
+
+@app.route('/api/nft/buy', methods=['POST'])
+def nft_buy_item():
+    """Покупка NFT с маркета за монеты."""
+    try:
+        data = request.json
+        buyer_id = data.get('buyer_id')
+        token_id = data.get('token_id')
+
+        if not buyer_id or not token_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT * FROM nft_items WHERE token_id = ?", (token_id,))
+            token = cursor.fetchone()
+            if not token:
+                return jsonify({"status": "error", "message": "NFT не найден"}), 404
+            token = dict(token)
+
+            if token['is_listed'] != 1:
+                return jsonify({"status": "error", "message": "NFT не выставлен на продажу"}), 400
+
+            if token['owner_id'] == buyer_id:
+                return jsonify({"status": "error", "message": "Вы уже владелец этого NFT"}), 400
+
+            price = int(token['price'])
+            seller_id = token['owner_id']
+
+            # Меняем владельца NFT, только если его еще не купили (условие в самом UPDATE)
+            cursor.execute("""
+                UPDATE nft_items
+                SET owner_id = ?, is_listed = 0
+                WHERE token_id = ? AND owner_id = ? AND is_listed = 1 AND price = ?
+            """, (buyer_id, token_id, seller_id, token['price']))
+            if cursor.rowcount == 0:
+                return jsonify({"status": "error", "message": "NFT уже продан или снят с продажи"}), 409
+
+            # Переводим монеты продавцу (при нехватке транзакция откатывается при возврате подключения)
+            new_balance = debit_coins(cursor, buyer_id, price, "nft_buy", token_id)
+            # Продавца нет (аккаунт удален) — отказ, чтобы списание не ушло в никуда
+            if credit_coins(cursor, seller_id, price, "nft_sale", token_id) is None:
+                raise WriteRejected("Продавец не найден", 409)
+            record_nft_trade(cursor, token['base_gift_id'], token_id, seller_id, buyer_id, price)
+
+            conn.commit()
+            invalidate_user_cache(buyer_id, seller_id)
+            invalidate_market_floor(token['base_gift_id'])
+
+            return jsonify({"status": "success", "new_balance": new_balance})
+    except WriteRejected as e:
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка покупки NFT: {e}"}), 500
+
+
+@app.route('/api/nft/regift', methods=['POST'])
+def nft_regift():
+    """
+    Передаривание NFT-подарка за 25 звезд (используем 25 монет как стоимость операции).
+    """
+    try:
+        data = request.json
+        from_user = data.get('from_user')
+        to_user = data.get('to_user')
+        token_id = data.get('token_id')
+
+        if not from_user or not to_user or not token_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+        COST = 25  # 25 "звезд" = 25 монет
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT * FROM nft_items WHERE token_id = ?", (token_id,))
+            token = cursor.fetchone()
+            if not token:
+                return jsonify({"status": "error", "message": "NFT не найден"}), 404
+
+            if token['owner_id'] != from_user:
+                return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
+
+            # Передаем NFT, только если from_user все еще владелец (условие в самом UPDATE)
+            cursor.execute("""
+                UPDATE nft_items
+                SET owner_id = ?, is_listed = 0
+                WHERE token_id = ? AND owner_id = ?
+            """, (to_user, token_id, from_user))
+            if cursor.rowcount == 0:
+                return jsonify({"status": "error", "message": "Вы не владелец этого NFT"}), 403
+
+            new_balance = debit_coins(cursor, from_user, COST, "nft_regift", token_id,
+                                      "Недостаточно звезд (монет) для передаривания")
+            record_nft_trade(cursor, token['base_gift_id'], token_id, from_user, to_user, 0, "regift")
+
+            conn.commit()
+            invalidate_user_cache(from_user, to_user)
+            invalidate_market_floor(token['base_gift_id'])
+
+            return jsonify({"status": "success", "new_balance": new_balance})
+    except WriteRejected as e:
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка передаривания NFT: {e}"}), 500
+
+# --- 6. УДАЛЕНИЕ СООБЩЕНИЙ ---
+
+def find_message(conn, message_id):
+    """Сообщение по uuid: по uuid не видно чата, поэтому ищем во всех шардах."""
+    for shard in message_shards:
+        with shard.connection(conn) as shard_conn:
+            message = shard_conn.execute("SELECT * FROM messages WHERE uuid = ?", (message_id,)).fetchone()
+        if message:
+            return message
+    return None
+
+def find_archived_message(cursor, message_id):
+    """Сообщение из архива по uuid (словарь с chat_id) и его блок, или (None, None)."""
+    cursor.execute("SELECT 1 FROM archive_deletions WHERE uuid = ?", (message_id,))
+    if cursor.fetchone():
+        return None, None  # уже удалено, блок еще не переписан
+    block = message_archive.find_message(message_id)
+    if block is None:
+        return None, None
+    partition, chat_id, first_seq = block
+    for message in load_archive_block(partition, chat_id, first_seq):
+        if message["uuid"] == message_id:
+            return {**message, "chat_id": chat_id}, block
+    return None, None
+
+def delete_archived_message(cursor, message, block):
+    """
+    Удаление архивного сообщения в основной базе (cursor, коммит за вызывающим): каталог
+    и отметка в archive_deletions. С ней сообщение сразу пропадает из истории и поиска
+    по uuid, а сам блок переписывает apply_archive_deletions после коммита.
+    """
+    partition, chat_id, first_seq = block
+    cursor.execute("""
+        INSERT OR IGNORE INTO archive_deletions (uuid, chat_id, partition, first_seq) VALUES (?, ?, ?, ?)
+    """, (message["uuid"], chat_id, partition, first_seq))
+    cursor.execute("""
+        UPDATE message_archive SET message_count = message_count - 1 WHERE chat_id = ? AND first_seq = ?
+    """, (chat_id, first_seq))
+    cursor.execute("""
+        DELETE FROM message_archive WHERE chat_id = ? AND first_seq = ? AND message_count <= 0
+    """, (chat_id, first_seq))
+
+def apply_archive_deletions(uuids=None):
+    """
+    Вычеркивает из блоков архива сообщения из archive_deletions (только uuids или все).
+    Переписывание блока идемпотентно: после сбоя отметка остается, и следующий вызов
+    (из run_retention) доделает работу. Возвращает число обработанных отметок.
+    """
+    with db_connection() as conn:
+        if uuids is None:
+            rows = conn.execute("SELECT * FROM archive_deletions").fetchall()
+        else:
+            rows = conn.execute(f"""
+                SELECT * FROM archive_deletions WHERE uuid IN ({', '.join('?' * len(uuids))})
+            """, uuids).fetchall()
+    for row in rows:
+        message_archive.remove_message(row["partition"], row["chat_id"], row["first_seq"], row["uuid"])
+        archive_block_cache.invalidate((row["partition"], row["chat_id"], row["first_seq"]))
+        run_write(lambda cursor: cursor.execute("DELETE FROM archive_deletions WHERE uuid = ?", (row["uuid"],)))
+    return len(rows)
+
+@app.route('/api/delete_message', methods=['POST'])
+def delete_message():
+    """API для удаления сообщения."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        message_id = data.get('message_id')
+        chat_partner_id = data.get('chat_partner_id')
+        
+        if not user_id or not message_id:
+            return jsonify({"status": "error", "message": "Неполные данные"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Проверяем роль пользователя
+            user_role = get_user_role(user_id)
+        
+            if not user_role:
+                return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+        
+            # Проверяем существование сообщения: в живых, затем в архиве
+            message = find_message(conn, message_id)
+            block = None
+            if not message:
+                message, block = find_archived_message(cursor, message_id)
+        
+            if not message:
+                return jsonify({"status": "error", "message": "Сообщение не найдено"}), 404
+        
+            # Проверяем права: либо пользователь - отправитель, либо админ
+            if user_role != 'admin' and message['sender_id'] != user_id:
+                return jsonify({"status": "error", "message": "Нет прав для удаления этого сообщения"}), 403
+        
+            # Если это подарок – полностью запрещаем удаление
+            if message['gift_id']:
+                return jsonify({
+                    "status": "error",
+                    "message": "Подарочные сообщения нельзя удалить"
+                }), 400
+        
+            # Удаляем сообщение (с шардами — коммитом шарда до обновления сводок)
+            if block:
+                delete_archived_message(cursor, message, block)
+            with message_shards.for_chat(message['chat_id']).connection(conn) as shard_conn:
+                if not block:
+                    shard_conn.execute("DELETE FROM messages WHERE uuid = ?", (message_id,))
+                last = last_chat_message(shard_conn.cursor(), message['chat_id'])
+                if shard_conn is not conn:
+                    shard_conn.commit()
+            if last is None:
+                # Живых сообщений не осталось — превью из самого нового сообщения архива
+                last = next(iter(load_archived_messages(cursor, message['chat_id'], 1)), None)
+            refresh_chat_summaries_after_delete(cursor, message, last)
+        
+            conn.commit()
+            if block:
+                # Основная база уже закоммичена; при сбое блок перепишет retention
+                try:
+                    apply_archive_deletions([message_id])
+                except Exception as e:
+                    print(f"Ошибка удаления сообщения {message_id} из блока архива: {e}")
+
+            # Сообщаем открытым клиентам, чтобы они убрали сообщение без перезагрузки истории
+            event = {"type": "message_deleted", "chat_id": message['chat_id'], "uuid": message_id}
+            if message['chat_id'].startswith("channel_"):
+                message_bus.publish(f"room:{message['chat_id'][len('channel_'):]}", event)
+            else:
+                for member_id in {user_id, message['sender_id'], chat_partner_id}:
+                    if member_id:
+                        message_bus.publish(f"user:{member_id}", event)
+        
+            return jsonify({
+                "status": "success", 
+                "message": "Сообщение удалено"
+            })
+        
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка удаления сообщения: {e}"}), 500
+
+# --- 7. МАРШРУТЫ ЧАТА И ПОИСКА ---
+
+@app.route('/api/search', methods=['POST'])
+def search():
+    """API для поиска пользователей и каналов (action=names) и текста сообщений (action=messages)."""
+    try:
+        data = request.json
+        current_user_id = data.get('current_user_id')
+        term = data.get('term', '').strip().lower()
+        # names — пользователи и каналы (по умолчанию), messages — текст сообщений
+        action = data.get('action', 'names')
+        
+        if not current_user_id:
+            return jsonify({"status": "error", "message": "Не указан текущий пользователь"}), 400
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            match = fts_prefix_query(term)
+            if action == 'messages':
+                return search_messages(cursor, current_user_id, match, data)
+            if not match:
+                return jsonify({"status": "success", "results": []})
+
+            # Пользователи
+            cursor.execute("""
+                SELECT u.id, u.displayName, u.avatarBase64, u.emailHash
+                FROM names_fts f
+                JOIN search_names s ON s.id = f.rowid AND s.kind = 'user'
+                JOIN users u ON u.id = s.ref_id
+                WHERE names_fts MATCH ? AND u.id != ?
+                ORDER BY f.rank
+                LIMIT ?
+            """, (match, current_user_id, SEARCH_NAMES_LIMIT))
+            user_results = with_avatar_size([dict(row) for row in cursor.fetchall()], 48)
+            for u in user_results:
+                u["kind"] = "user"
+
+            # Каналы (rooms.type = 'channel')
+            cursor.execute("""
+                SELECT r.id, r.name, r.avatarBase64, r.about, r.owner_id
+                FROM names_fts f
+                JOIN search_names s ON s.id = f.rowid AND s.kind = 'channel'
+                JOIN rooms r ON r.id = s.ref_id
+                WHERE names_fts MATCH ?
+                ORDER BY f.rank
+                LIMIT ?
+            """, (match, SEARCH_NAMES_LIMIT))
+            channel_results = []
+            for row in cursor.fetchall():
+                d = dict(row)
+                d["kind"] = "channel"
+                channel_results.append(d)
+            with_avatar_size(channel_results, 48)
+
+            all_results = user_results + channel_results
+            return jsonify({"status": "success", "results": all_results})
+        
+    except Exception as e:
+        print(f"Search error: {e}")
+        return jsonify({"status": "error", "message": f"Ошибка поиска: {e}"}), 500
+
+def search_messages(cursor, user_id, match, data):
+    """
+    Поиск по тексту сообщений в чатах пользователя (личные чаты и подписки на каналы).
+    Результаты отсортированы по релевантности (bm25), совпадения выделены <mark>.
+    """
+    limit = min(int(data.get('limit') or SEARCH_MESSAGES_PAGE_SIZE), SEARCH_MESSAGES_MAX_PAGE_SIZE)
+    offset = max(int(data.get('offset') or 0), 0)
+    if not match:
+        return jsonify({"status": "success", "results": [], "has_more": False, "offset": offset})
+
+    # Чаты пользователя — из основной базы, совпадения — из FTS шардов этих чатов
+    cursor.execute("""
+        SELECT chat_id, partner_id FROM chat_partners
+        WHERE user_id = :user_id AND chat_id NOT LIKE 'channel_%'
+        UNION ALL
+        SELECT 'channel_' || rm.room_id, rm.room_id
+        FROM room_members rm
+        JOIN rooms r ON r.id = rm.room_id AND r.type = 'channel'
+        WHERE rm.user_id = :user_id
+    """, {"user_id": user_id})
+    partners = {row["chat_id"]: row["partner_id"] for row in cursor.fetchall()}
+    by_shard = {}
+    for chat_id in partners:
+        by_shard.setdefault(message_shards.for_chat(chat_id), []).append(chat_id)
+    found = []
+    for shard, chat_ids in by_shard.items():
+        with shard.connection(cursor.connection) as conn:
+            found.extend(conn.execute(f"""
+                SELECT
+                    m.uuid,
+                    m.seq,
+                    m.chat_id,
+                    m.sender_id AS sender,
+                    m.timestamp,
+                    m.created_at,
+                    snippet(messages_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet,
+                    messages_fts.rank AS rank
+                FROM messages_fts
+                JOIN messages m ON m.seq = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND m.chat_id IN ({",".join("?" * len(chat_ids))})
+                ORDER BY messages_fts.rank
+                LIMIT ?
+            """, [match, *chat_ids, offset + limit + 1]).fetchall())
+    # bm25 каждого шарда считается по его документам; для порядка выдачи этого достаточно
+    found.sort(key=lambda row: row["rank"])
+    rows = found[offset:offset + limit + 1]
+
+    # Имена и аватары собеседников и каналов — поиском по первичным ключам
+    partner_ids = sorted({partners[row["chat_id"]] for row in rows[:limit]})
+    placeholders = ",".join("?" * len(partner_ids))
+    cursor.execute(f"SELECT id, name, avatarBase64 FROM rooms WHERE id IN ({placeholders})", partner_ids)
+    rooms = {row["id"]: row for row in cursor.fetchall()}
+    cursor.execute(f"SELECT id, displayName, avatarBase64, emailHash FROM users WHERE id IN ({placeholders})",
+                   partner_ids)
+    users = {row["id"]: row for row in cursor.fetchall()}
+    results = []
+    for row in rows[:limit]:
+        partner_id = partners[row["chat_id"]]
+        room = rooms.get(partner_id) if row["chat_id"].startswith("channel_") else None
+        user = users.get(partner_id) if room is None else None
+        result = {key: row[key] for key in row.keys() if key != "rank"}
+        result.update({
+            "partner_id": partner_id,
+            "chat_type": "user" if room is None else "channel",
+            "displayName": room["name"] if room else (user["displayName"] if user else None),
+            "avatarBase64": room["avatarBase64"] if room else (user["avatarBase64"] if user else None),
+            "emailHash": "" if room else (user["emailHash"] if user else None),
+        })
+        results.append(result)
+    results = with_avatar_size(results, 48)
+    return jsonify({
+        "status": "success",
+        "results": results,
+        "has_more": len(rows) > limit,
+        "offset": offset
+    })
+
+@app.route('/api/typeahead', methods=['GET'])
+def typeahead():
+    """Подсказки при вводе в поиске: пользователи и каналы по префиксу ID или имени."""
+    try:
+        query = request.args.get('q', '')
+        limit = min(int(request.args.get('limit') or TYPEAHEAD_MAX_RESULTS), TYPEAHEAD_MAX_RESULTS)
+        results = typeahead_index.lookup(query, limit, exclude=request.args.get('exclude'))
+        return jsonify({"status": "success", "results": results})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка поиска: {e}"}), 500
+
+def load_chat_list(cursor, user_id):
+    """Список чатов пользователя (личные и каналы), новые сверху."""
+    # Личные чаты — по индексу сводок, каналы — из подписок и channel_state;
+    # имена и аватары — поиском по первичным ключам
+    cursor.execute("""
+        SELECT
+            cs.partner_id AS id,
+            u.displayName,
+            u.avatarBase64,
+            u.emailHash,
+            'user' AS chat_type,
+            NULL AS owner_id,
+            NULL AS role,
+            cs.last_seq,
+            cs.last_preview,
+            cs.last_sender_id,
+            cs.last_at,
+            cs.unread_count
+        FROM chat_summaries cs
+        JOIN users u ON u.id = cs.partner_id
+        WHERE cs.user_id = :user_id
+        UNION ALL
+        SELECT
+            r.id,
+            r.name,
+            r.avatarBase64,
+            '',
+            'channel',
+            r.owner_id,
+            rm.role,
+            st.last_seq,
+            st.last_preview,
+            st.last_sender_id,
+            st.last_at,
+            MAX(st.post_count - rm.read_count, 0)
+        FROM room_members rm
+        JOIN rooms r ON r.id = rm.room_id AND r.type = 'channel'
+        JOIN channel_state st ON st.room_id = rm.room_id
+        WHERE rm.user_id = :user_id
+        ORDER BY last_at DESC, last_seq DESC
+    """, {"user_id": user_id})
+    chats = [dict(row) for row in cursor.fetchall()]
+    # Прочтения, которые еще не записаны в базу, уже обнулили счетчик
+    pending = read_receipts.pending_for(user_id)
+    for chat in chats:
+        if chat["unread_count"] and chat["id"] in pending and pending[chat["id"]] >= chat["last_seq"]:
+            chat["unread_count"] = 0
+    return with_avatar_size(chats, 48)
+
+def chat_list_version(cursor, user_id):
+    """
+    Дешевая версия списка чатов по сводкам: меняется при новом сообщении, прочтении
+    и удалении. Смена имени или аватара собеседника ее не меняет. Сумма, а не максимум
+    last_seq: с шардами новое сообщение может получить seq меньше, чем у другого чата.
+    """
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(last_seq), 0), COALESCE(SUM(unread), 0) FROM (
+            SELECT last_seq, unread_count AS unread FROM chat_summaries WHERE user_id = :user_id
+            UNION ALL
+            SELECT st.last_seq, MAX(st.post_count - rm.read_count, 0)
+            FROM room_members rm
+            JOIN channel_state st ON st.room_id = rm.room_id
+            WHERE rm.user_id = :user_id
+        )
+    """, {"user_id": user_id})
+    return ":".join(str(value) for value in cursor.fetchone())
+
+@app.route('/api/messages', methods=['POST'])
+def handle_messages():
+    """API для отправки сообщений и получения истории чата."""
+    try:
+        data = request.json
+        action = data.get('action')
+        
+        if action == 'send':
+            sender_id = data.get('sender_id')
+            receiver_id = data.get('receiver_id')
+            text = data.get('text')
+            
+            if not sender_id or not receiver_id or not text:
+                return jsonify({"status": "error", "message": "Неполные данные"}), 400
+
+            # Проверяем, является ли receiver_id каналом (проверяем в таблице rooms)
+            with db_connection() as conn:
+                room = conn.execute("SELECT id, name, type FROM rooms WHERE id = ?", (receiver_id,)).fetchone()
+
+            if room and room["type"] == "channel":
+                # Это канал - используем room_broadcast логику
+                def check_role(cursor):
+                    # Проверяем роль отправителя
+                    cursor.execute("""
+                        SELECT role FROM room_members
+                        WHERE room_id = ? AND user_id = ?
+                    """, (receiver_id, sender_id))
+                    member = cursor.fetchone()
+                    if not member:
+                        raise WriteRejected("Вы не подписаны на этот канал", 403)
+                    if member["role"] not in ("owner", "admin"):
+                        raise WriteRejected("Только владелец или админ канала может писать", 403)
+                    return text, None, None
+
+                chat_id = f"channel_{receiver_id}"
+                message, _ = run_message_write(chat_id, sender_id, receiver_id, prepare=check_role)
+                return jsonify({"status": "success", "message": message}), 202 if message.get("pending") else 200
+
+            # Обычный чат между пользователями: связь чата и сводки пишет finish_message
+            chat_id = get_chat_id(sender_id, receiver_id)
+            message, _ = run_message_write(chat_id, sender_id, receiver_id, text=text)
+            return jsonify({"status": "success", "message": message})
+
+        elif action == 'history':
+            user_a = data.get('user_a')
+            user_b = data.get('user_b')
+            
+            if not user_a or not user_b:
+                return jsonify({"status": "error", "message": "Необходимо два ID"}), 400
+
+            # Курсоры: after_seq (или since_uuid) — сообщения новее курсора, для polling'а;
+            # before_seq — страница более старых сообщений, для прокрутки вверх.
+            # Без курсора возвращается последняя страница.
+            try:
+                limit = max(1, min(int(data.get('limit') or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+                after_seq = None if data.get('after_seq') is None else int(data['after_seq'])
+                before_seq = None if data.get('before_seq') is None else int(data['before_seq'])
+            except (TypeError, ValueError):
+                return jsonify({"status": "error", "message": "limit, after_seq и before_seq должны быть целыми числами"}), 400
+            since_uuid = data.get('since_uuid')
+
+            with db_connection() as conn:
+                cursor = conn.cursor()
+            
+                # Проверяем, является ли user_b каналом (проверяем в таблице rooms)
+                cursor.execute("SELECT id, type FROM rooms WHERE id = ?", (user_b,))
+                room = cursor.fetchone()
+                if room and room["type"] == "channel":
+                    # Это канал - используем специальный chat_id
+                    chat_id = f"channel_{user_b}"
+                else:
+                    # Обычный чат между пользователями
+                    chat_id = get_chat_id(user_a, user_b)
+
+                # Сообщения — из шарда чата, все остальное — из основной базы
+                with message_shards.for_chat(chat_id).connection(conn) as shard_conn:
+                    shard_cursor = shard_conn.cursor()
+                    if after_seq is None and since_uuid:
+                        shard_cursor.execute("SELECT seq FROM messages WHERE uuid = ? AND chat_id = ?",
+                                             (since_uuid, chat_id))
+                        since_row = shard_cursor.fetchone()
+                        if since_row:
+                            after_seq = since_row["seq"]
+
+                    columns = "uuid, seq, sender_id, text, timestamp, created_at, gift_id"
+                    if after_seq is not None:
+                        shard_cursor.execute(f"""
+                            SELECT {columns} FROM messages
+                            WHERE chat_id = ? AND seq > ?
+                            ORDER BY seq ASC
+                            LIMIT ?
+                        """, (chat_id, after_seq, limit + 1))
+                    elif before_seq is not None:
+                        shard_cursor.execute(f"""
+                            SELECT {columns} FROM messages
+                            WHERE chat_id = ? AND seq < ?
+                            ORDER BY seq DESC
+                            LIMIT ?
+                        """, (chat_id, before_seq, limit + 1))
+                    else:
+                        shard_cursor.execute(f"""
+                            SELECT {columns} FROM messages
+                            WHERE chat_id = ?
+                            ORDER BY seq DESC
+                            LIMIT ?
+                        """, (chat_id, limit + 1))
+                    rows = shard_cursor.fetchall()
+
+                if after_seq is not None:
+                    # Курсор старше живой части чата — начало берем из архива
+                    archived = load_archived_messages(cursor, chat_id, limit + 1, after_seq=after_seq)
+                    if archived:
+                        rows = (archived + rows)[:limit + 1]
+
+                if after_seq is None and len(rows) <= limit:
+                    # Живая часть чата кончилась — более старые сообщения догружаем из архива
+                    oldest_seq = rows[-1]["seq"] if rows else before_seq
+                    rows = list(rows) + load_archived_messages(cursor, chat_id, limit + 1 - len(rows),
+                                                               before_seq=oldest_seq)
+
+                # has_more: для after_seq — есть еще более новые сообщения, иначе — более старые
+                has_more = len(rows) > limit
+                rows = rows[:limit]
+                if after_seq is None:
+                    rows.reverse()
+                is_channel = bool(room and room["type"] == "channel")
+
+                # Отметки прочтения: моя — для входящих, собеседника — для моих сообщений
+                # (в каналах отметок "прочитано" нет)
+                read_seqs = {}
+                if not is_channel:
+                    cursor.execute("""
+                        SELECT user_id, read_seq FROM chat_reads WHERE chat_id = ? AND user_id IN (?, ?)
+                    """, (chat_id, user_a, user_b))
+                    read_seqs = {row["user_id"]: row["read_seq"] for row in cursor.fetchall()}
+                my_read_seq = max(read_seqs.get(user_a, 0), read_receipts.pending_seq(user_a, user_b))
+                peer_read_seq = max(read_seqs.get(user_b, 0), read_receipts.pending_seq(user_b, user_a))
+                history = [message_row_to_dict({
+                    **dict(row),
+                    "is_read": row["seq"] <= (peer_read_seq if row["sender_id"] == user_a else my_read_seq)
+                }) for row in rows]
+
+                # Чат прочитан до последнего отданного сообщения. Запись — только если отметка
+                # продвинулась, и не здесь, а пачкой (read_receipts)
+                seen_seq = max((row["seq"] for row in rows), default=0)
+                if is_channel:
+                    cursor.execute("""
+                        SELECT rm.read_count < st.post_count FROM room_members rm
+                        JOIN channel_state st ON st.room_id = rm.room_id
+                        WHERE rm.room_id = ? AND rm.user_id = ?
+                    """, (user_b, user_a))
+                    behind = cursor.fetchone()
+                    if behind and behind[0]:
+                        read_receipts.mark_read(user_a, user_b, chat_id, seen_seq)
+                elif seen_seq > my_read_seq:
+                    read_receipts.mark_read(user_a, user_b, chat_id, seen_seq)
+                return jsonify({
+                    "status": "success",
+                    "messages": history,
+                    "has_more": has_more,
+                    "first_seq": history[0]["seq"] if history else None,
+                    "last_seq": history[-1]["seq"] if history else None,
+                    "peer_read_seq": peer_read_seq
+                })
+
+        elif action == 'chats':
+            user_id = data.get('user_id')
+            if not user_id:
+                return jsonify({"status": "error", "message": "Не указан ID пользователя"}), 400
+                
+            with db_connection() as conn:
+                cursor = conn.cursor()
+            
+                all_chats = load_chat_list(cursor, user_id)
+
+                return jsonify({"status": "success", "chats": all_chats})
+
+        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
+    except WriteRejected as e:
+        return jsonify({"status": "error", "message": e.message}), e.status
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка работы с сообщениями: {e}"}), 500
+
+@app.route('/api/stream/<user_id>', methods=['GET'])
+def message_stream(user_id):
+    """
+    SSE-поток новых сообщений во всех чатах пользователя.
+    Клиент использует его вместо постоянного polling'а истории;
+    polling остается только как запасной вариант, если поток недоступен.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT room_id FROM room_members WHERE user_id = ?", (user_id,))
+        topics = [f"user:{user_id}"] + [f"room:{row['room_id']}" for row in cursor.fetchall()]
+
+    sub = message_bus.subscribe(user_id, topics)
+    presence.heartbeat(user_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while not sub.overflowed:
+                try:
+                    event = sub.queue.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Открытый поток держит пользователя онлайн
+                    presence.heartbeat(user_id)
+                    yield ": keepalive\n\n"
+                    continue
+                data = json.dumps(event, ensure_ascii=False)
+                yield f"event: {event['type']}\ndata: {data}\n\n"
+        finally:
+            message_bus.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+# --- 7.1. СИНХРОНИЗАЦИЯ СОСТОЯНИЯ (sync) ---
+# Клиент присылает версии ресурсов, которые у него уже есть, и одним запросом получает
+# только изменившиеся. Ресурсы читаются на одном подключении в одной транзакции чтения
+# (один снимок базы), пользователь проверяется один раз. Статусы онлайн берутся из
+# памяти (presence) после транзакции.
+
+SYNC_RESOURCES = ("balance", "chats", "gifts", "inventory", "nfts", "presence")
+SYNC_MAX_PRESENCE_IDS = 50
+
+def content_version(value):
+    """Версия ресурса без отдельного счетчика — хэш его содержимого."""
+    data = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+@app.route('/api/sync', methods=['POST'])
+def sync_state():
+    """
+    Тело: user_id, versions — {ресурс: версия у клиента}, resources — нужные ресурсы
+    (по умолчанию все из SYNC_RESOURCES), presence_ids — чьи статусы онлайн вернуть.
+    Ответ: versions — текущие версии запрошенных ресурсов, changes — данные только
+    тех ресурсов, версия которых отличается от присланной.
+    """
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        if not user_id:
+            return jsonify({"status": "error", "message": "Не указан ID пользователя"}), 400
+
+        known = data.get('versions') or {}
+        resources = [name for name in (data.get('resources') or SYNC_RESOURCES) if name in SYNC_RESOURCES]
+        presence_ids = list(dict.fromkeys(data.get('presence_ids') or []))[:SYNC_MAX_PRESENCE_IDS]
+        versions = {}
+        changes = {}
+
+        def offer(resource, version, load):
+            versions[resource] = version
+            if known.get(resource) != version:
+                changes[resource] = load()
+
+        if "gifts" in resources:
+            # Каталог общий для всех и уже кэширован вместе с ETag
+            body, etag = gift_catalog_cache.get("active", load_gift_catalog)
+            offer("gifts", etag, lambda: json.loads(body)["gifts"])
+
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            # Все чтения ниже видят один снимок базы
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT coins, is_banned FROM users WHERE id = ?", (user_id,))
+            user = cursor.fetchone()
+            if not user:
+                return jsonify({"status": "error", "message": "Пользователь не найден"}), 404
+            if user["is_banned"] == 1:
+                return jsonify({"status": "error", "message": "Аккаунт заблокирован администратором"}), 403
+
+            if "balance" in resources:
+                offer("balance", str(user["coins"]), lambda: user["coins"])
+            if "chats" in resources:
+                offer("chats", chat_list_version(cursor, user_id), lambda: load_chat_list(cursor, user_id))
+            for resource, loader in (("inventory", load_inventory), ("nfts", load_user_nfts)):
+                if resource in resources:
+                    items = loader(cursor, user_id)
+                    offer(resource, content_version(items), lambda: items)
+            conn.rollback()
+
+        # Запрос синхронизации — признак активности клиента
+        presence.heartbeat(user_id)
+        if "presence" in resources:
+            if PRESENCE_PUSH_ENABLED:
+                # Переходы онлайн/офлайн тех, за кем следит клиент, придут в SSE-поток
+                message_bus.replace_topics(user_id, "presence:",
+                                           [f"presence:{presence_id}" for presence_id in presence_ids])
+            if presence_ids:
+                statuses = presence.bulk(presence_ids)
+                offer("presence", content_version(statuses), lambda: statuses)
+
+        return jsonify({"status": "success", "versions": versions, "changes": changes})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка синхронизации: {e}"}), 500
+
+# --- CALLS API (WebRTC Signaling) ---
+# Сигналинг звонков: состояние звонков и очереди событий по пользователям.
+# offer/answer/ICE доставляются адресату событием — через SSE-поток (/api/stream)
+# или long-poll (action=poll) — вместо опроса check_incoming/get_call каждые 1-2 секунды.
+# Истечение звонков и очередей обслуживает один поток-планировщик.
+
+CALL_RING_TTL_SECONDS = 60
+CALL_ACTIVE_TTL_SECONDS = 4 * 3600
+CALL_ENDED_TTL_SECONDS = 30
+# Сколько хранится очередь событий пользователя после последнего события
+CALL_EVENTS_TTL_SECONDS = 120
+CALL_EVENTS_MAX = 500
+CALL_POLL_MAX_SECONDS = 25
+# Хранилище сигналинга: memory (один процесс), sqlite (несколько процессов на хосте),
+# redis (несколько хостов; подойдет и любой сервер с протоколом RESP)
+CALL_SIGNALING_BACKEND = os.environ.get('VAULT_SIGNALING_BACKEND', 'memory')
+CALL_SIGNALING_DB = os.environ.get('VAULT_SIGNALING_DB', 'signaling.db')
+CALL_REDIS_URL = os.environ.get('VAULT_REDIS_URL', 'redis://127.0.0.1:6379/0')
+# Как часто long-poll перечитывает общее хранилище (события из других процессов)
+CALL_STORE_POLL_SECONDS = 0.05
+# Как часто искать звонки с истекшим сроком, созданные другими процессами
+CALL_SWEEP_SECONDS = 30
+
+class ExpiryScheduler:
+    """Один фоновый поток, который вызывает callback(key) в момент истечения срока."""
+
+    def __init__(self, callback, name):
+        self._callback = callback
+        self._name = name
+        self._heap = []
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def schedule(self, at, key):
+        """at — время по time.monotonic(). Повторный вызов для ключа просто добавляет новый срок."""
+        with self._cond:
+            # Поток не переживает fork, поэтому в новом процессе запускаем свой
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True, name=self._name).start()
+            heapq.heappush(self._heap, (at, key))
+            if self._heap[0][1] == key:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, key = heapq.heappop(self._heap)
+            try:
+                self._callback(key)
+            except Exception as e:
+                print(f"Ошибка планировщика {self._name}: {e}")
+
+class CallNotFoundError(Exception):
+    """Звонка нет: его не было или он уже удален по истечении срока."""
+
+# Хранилища состояния звонков. Общий интерфейс:
+#   put_offer / set_answer / end_call / append_ice / get_call / incoming — звонки;
+#   push_event / fetch_events — очередь событий пользователя с курсором seq;
+#   expire_call / expire_events / sweep — истечение сроков.
+# shared = True означает, что состояние видят все процессы (несколько воркеров gunicorn).
+
+class MemorySignalingStore:
+    """Состояние в памяти процесса. Подходит только для одного воркера."""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._incoming = {}
+        self._events = {}
+
+    def _get(self, call_id):
+        call = self._calls.get(call_id)
+        if call is None:
+            raise CallNotFoundError(call_id)
+        return call
+
+    def put_offer(self, call_id, call, ttl):
+        with self._lock:
+            self._calls[call_id] = dict(call, caller_ice=[], callee_ice=[], expires_at=time.time() + ttl)
+            self._incoming.setdefault(call["callee_id"], set()).add(call_id)
+
+    def set_answer(self, call_id, answer, ttl):
+        """Отвечает на звонок; завершенный звонок не возобновляется (CallNotFoundError)."""
+        with self._lock:
+            call = self._get(call_id)
+            if call["status"] == "ended":
+                raise CallNotFoundError(call_id)
+            call.update(answer=answer, status="answered", expires_at=time.time() + ttl)
+            self._incoming.get(call["callee_id"], set()).discard(call_id)
+            return dict(call)
+
+    def end_call(self, call_id, ttl):
+        """Помечает звонок завершенным; None, если его нет или он уже завершен."""
+        with self._lock:
+            call = self._calls.get(call_id)
+            if call is None or call["status"] == "ended":
+                return None
+            call.update(status="ended", expires_at=time.time() + ttl)
+            self._incoming.get(call["callee_id"], set()).discard(call_id)
+            return dict(call)
+
+    def append_ice(self, call_id, user_id, candidate):
+        """Добавляет ICE candidate участника и возвращает ID собеседника."""
+        with self._lock:
+            call = self._get(call_id)
+            if user_id == call["caller_id"]:
+                call["caller_ice"].append(candidate)
+                return call["callee_id"]
+            if user_id == call["callee_id"]:
+                call["callee_ice"].append(candidate)
+                return call["caller_id"]
+            raise PermissionError(user_id)
+
+    def get_call(self, call_id):
+        with self._lock:
+            call = self._get(call_id)
+            return dict(call, caller_ice=list(call["caller_ice"]), callee_ice=list(call["callee_ice"]))
+
+    def incoming(self, user_id):
+        with self._lock:
+            return [{"call_id": call_id,
+                     "caller_id": self._calls[call_id]["caller_id"],
+                     "offer": self._calls[call_id]["offer"]}
+                    for call_id in self._incoming.get(user_id, ())]
+
+    def push_event(self, user_id, event, ttl):
+        """Кладет событие в очередь пользователя и возвращает его с присвоенным seq."""
+        with self._lock:
+            state = self._events.get(user_id)
+            if state is None:
+                state = self._events[user_id] = {"seq": 0, "events": deque(maxlen=CALL_EVENTS_MAX)}
+            state["seq"] += 1
+            state["expires_at"] = time.time() + ttl
+            event = dict(event, seq=state["seq"])
+            state["events"].append(event)
+            return event
+
+    def fetch_events(self, user_id, cursor):
+        """События с seq > cursor и последний выданный seq."""
+        with self._lock:
+            state = self._events.get(user_id)
+            if state is None:
+                return [], 0
+            return [event for event in state["events"] if event["seq"] > cursor], state["seq"]
+
+    def expire_call(self, call_id):
+        """
+        Срок звонка истек: завершенный удаляется, а незавершенный возвращается,
+        чтобы хаб завершил его и разослал call_ended.
+        """
+        with self._lock:
+            call = self._calls.get(call_id)
+            if call is None or call["expires_at"] > time.time():
+                return None
+            if call["status"] != "ended":
+                return dict(call)
+            del self._calls[call_id]
+            callee_calls = self._incoming.get(call["callee_id"])
+            if callee_calls is not None:
+                callee_calls.discard(call_id)
+                if not callee_calls:
+                    del self._incoming[call["callee_id"]]
+            return None
+
+    def expire_events(self, user_id):
+        with self._lock:
+            state = self._events.get(user_id)
+            if state is not None and state["expires_at"] <= time.time():
+                del self._events[user_id]
+
+    def sweep(self):
+        # Сроки в памяти процесса обслуживает планировщик хаба по ключам
+        return []
+
+class SQLiteSignalingStore:
+    """
+    Общее состояние для нескольких процессов на одном хосте: отдельный файл SQLite
+    в режиме WAL (сигналинг не раздувает WAL основной базы).
+    """
+
+    shared = True
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self._pool = ConnectionPool(path, pool_size)
+        with db_connection(self._pool) as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS calls (
+                    call_id TEXT PRIMARY KEY,
+                    caller_id TEXT NOT NULL,
+                    callee_id TEXT NOT NULL,
+                    offer TEXT NOT NULL,
+                    answer TEXT,
+                    status TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_calls_ringing ON calls(callee_id) WHERE status = 'ringing';
+                CREATE INDEX IF NOT EXISTS idx_calls_expires ON calls(expires_at);
+                CREATE TABLE IF NOT EXISTS call_ice (
+                    id INTEGER PRIMARY KEY,
+                    call_id TEXT NOT NULL,
+                    side TEXT NOT NULL,
+                    candidate TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_call_ice_call ON call_ice(call_id, side, id);
+                CREATE TABLE IF NOT EXISTS call_event_queues (
+                    user_id TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_call_event_queues_expires ON call_event_queues(expires_at);
+                CREATE TABLE IF NOT EXISTS call_events (
+                    user_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    PRIMARY KEY (user_id, seq)
+                ) WITHOUT ROWID;
+            """)
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE: блокировка записи берется сразу, а не при первом UPDATE,
+        # иначе параллельный writer из другого процесса дает SQLITE_BUSY без ожидания
+        with db_connection(self._pool) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.commit()
+
+    @staticmethod
+    def _call_row(row):
+        call = dict(row)
+        call["offer"] = json.loads(call["offer"])
+        call["answer"] = json.loads(call["answer"]) if call["answer"] else None
+        return call
+
+    def put_offer(self, call_id, call, ttl):
+        with self._write() as conn:
+            conn.execute("DELETE FROM call_ice WHERE call_id = ?", (call_id,))
+            conn.execute("""
+                INSERT OR REPLACE INTO calls
+                    (call_id, caller_id, callee_id, offer, answer, status, created_at, expires_at)
+                VALUES (?, ?, ?, ?, NULL, ?, ?, ?)
+            """, (call_id, call["caller_id"], call["callee_id"], json.dumps(call["offer"]),
+                  call["status"], call["created_at"], time.time() + ttl))
+
+    def set_answer(self, call_id, answer, ttl):
+        with self._write() as conn:
+            row = conn.execute("""
+                UPDATE calls SET answer = ?, status = 'answered', expires_at = ?
+                WHERE call_id = ? AND status != 'ended' RETURNING *
+            """, (json.dumps(answer), time.time() + ttl, call_id)).fetchone()
+        if row is None:
+            raise CallNotFoundError(call_id)
+        return self._call_row(row)
+
+    def end_call(self, call_id, ttl):
+        with self._write() as conn:
+            row = conn.execute("""
+                UPDATE calls SET status = 'ended', expires_at = ?
+                WHERE call_id = ? AND status != 'ended' RETURNING *
+            """, (time.time() + ttl, call_id)).fetchone()
+        return self._call_row(row) if row else None
+
+    def append_ice(self, call_id, user_id, candidate):
+        with self._write() as conn:
+            row = conn.execute("SELECT caller_id, callee_id FROM calls WHERE call_id = ?",
+                               (call_id,)).fetchone()
+            if row is None:
+                raise CallNotFoundError(call_id)
+            if user_id == row["caller_id"]:
+                side, peer_id = "caller", row["callee_id"]
+            elif user_id == row["callee_id"]:
+                side, peer_id = "callee", row["caller_id"]
+            else:
+                raise PermissionError(user_id)
+            conn.execute("INSERT INTO call_ice (call_id, side, candidate) VALUES (?, ?, ?)",
+                         (call_id, side, json.dumps(candidate)))
+        return peer_id
+
+    def get_call(self, call_id):
+        with db_connection(self._pool) as conn:
+            row = conn.execute("SELECT * FROM calls WHERE call_id = ?", (call_id,)).fetchone()
+            if row is None:
+                raise CallNotFoundError(call_id)
+            call = self._call_row(row)
+            call["caller_ice"], call["callee_ice"] = [], []
+            for ice in conn.execute("SELECT side, candidate FROM call_ice WHERE call_id = ? ORDER BY id",
+                                    (call_id,)):
+                call[f"{ice['side']}_ice"].append(json.loads(ice["candidate"]))
+        return call
+
+    def incoming(self, user_id):
+        with db_connection(self._pool) as conn:
+            rows = conn.execute("""
+                SELECT call_id, caller_id, offer FROM calls
+                WHERE callee_id = ? AND status = 'ringing'
+            """, (user_id,)).fetchall()
+        return [{"call_id": row["call_id"], "caller_id": row["caller_id"],
+                 "offer": json.loads(row["offer"])} for row in rows]
+
+    def push_event(self, user_id, event, ttl):
+        with self._write() as conn:
+            seq = conn.execute("""
+                INSERT INTO call_event_queues (user_id, seq, expires_at) VALUES (?, 1, ?)
+                ON CONFLICT (user_id) DO UPDATE SET seq = seq + 1, expires_at = excluded.expires_at
+                RETURNING seq
+            """, (user_id, time.time() + ttl)).fetchone()[0]
+            event = dict(event, seq=seq)
+            conn.execute("INSERT INTO call_events (user_id, seq, event) VALUES (?, ?, ?)",
+                         (user_id, seq, json.dumps(event)))
+            conn.execute("DELETE FROM call_events WHERE user_id = ? AND seq <= ?",
+                         (user_id, seq - CALL_EVENTS_MAX))
+        return event
+
+    def fetch_events(self, user_id, cursor):
+        with db_connection(self._pool) as conn:
+            row = conn.execute("SELECT seq FROM call_event_queues WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return [], 0
+            last_seq = row["seq"]
+            rows = conn.execute("""
+                SELECT event FROM call_events
+                WHERE user_id = ? AND seq > ? AND seq <= ?
+                ORDER BY seq
+            """, (user_id, cursor, last_seq)).fetchall()
+        return [json.loads(r["event"]) for r in rows], last_seq
+
+    def expire_call(self, call_id):
+        with self._write() as conn:
+            row = conn.execute("SELECT * FROM calls WHERE call_id = ? AND expires_at <= ?",
+                               (call_id, time.time())).fetchone()
+            if row is None:
+                return None
+            if row["status"] != "ended":
+                return self._call_row(row)
+            conn.execute("DELETE FROM calls WHERE call_id = ?", (call_id,))
+            conn.execute("DELETE FROM call_ice WHERE call_id = ?", (call_id,))
+        return None
+
+    def expire_events(self, user_id):
+        with self._write() as conn:
+            expired = conn.execute("""
+                DELETE FROM call_event_queues WHERE user_id = ? AND expires_at <= ? RETURNING user_id
+            """, (user_id, time.time())).fetchone()
+            if expired:
+                conn.execute("DELETE FROM call_events WHERE user_id = ?", (user_id,))
+
+    def sweep(self):
+        """Удаляет просроченные очереди и возвращает звонки с истекшим сроком (в т.ч. чужих процессов)."""
+        now = time.time()
+        with self._write() as conn:
+            conn.execute("""
+                DELETE FROM call_events WHERE user_id IN (
+                    SELECT user_id FROM call_event_queues WHERE expires_at <= ?
+                )
+            """, (now,))
+            conn.execute("DELETE FROM call_event_queues WHERE expires_at <= ?", (now,))
+            rows = conn.execute("SELECT call_id FROM calls WHERE expires_at <= ?", (now,)).fetchall()
+        return [row["call_id"] for row in rows]
+
+class RespError(Exception):
+    """Ошибка, которую вернул Redis-совместимый сервер."""
+
+class RespClient:
+    """
+    Минимальный клиент протокола RESP (Redis) на сокетах: команды и MULTI/EXEC.
+    У каждого потока свое подключение; после fork подключения создаются заново.
+    """
+
+    def __init__(self, url, timeout=5):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and conn[0] == os.getpid():
+            return conn
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = self._local.conn = (os.getpid(), sock, sock.makefile("rb"))
+        try:
+            # Отказ AUTH/SELECT — исключение здесь, а не NOAUTH на следующих командах
+            if self.password:
+                self.execute("AUTH", self.password)
+            if self.db:
+                self.execute("SELECT", self.db)
+        except Exception:
+            self._local.conn = None
+            sock.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _encode(command):
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            return RespError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            return None if length < 0 else reader.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [self._read(reader) for _ in range(length)]
+        raise RespError(f"Неизвестный ответ: {line!r}")
+
+    def _call(self, commands):
+        _, sock, reader = self._connection()
+        try:
+            sock.sendall(b"".join(self._encode(command) for command in commands))
+            replies = [self._read(reader) for _ in commands]
+        except OSError:
+            # Сломанное подключение не переиспользуем
+            self._local.conn = None
+            sock.close()
+            raise
+        return replies
+
+    def execute(self, *command):
+        reply = self._call([command])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def transaction(self, *commands):
+        """
+        Выполняет команды атомарно (MULTI/EXEC) за один сетевой обмен и возвращает их ответы;
+        None, если после WATCH ключ изменил другой клиент (EXEC отменен).
+        """
+        replies = self._call([("MULTI",)] + list(commands) + [("EXEC",)])
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies[-1]
+
+class RedisSignalingStore:
+    """
+    Общее состояние в Redis (или совместимом сервере) для нескольких процессов и хостов.
+    Очередь событий — список; seq событий вычисляется из счетчика и позиции в списке,
+    которые меняются вместе в одной транзакции MULTI/EXEC.
+    """
+
+    shared = True
+    # Страховочный срок ключей звонка: логическим истечением управляет хаб
+    KEY_TTL_SECONDS = CALL_ACTIVE_TTL_SECONDS + 3600
+
+    def __init__(self, url, prefix="vault:"):
+        self._redis = RespClient(url)
+        self._prefix = prefix
+        self._redis.execute("PING")
+
+    def _key(self, *parts):
+        return self._prefix + ":".join(parts)
+
+    def _load(self, call_id):
+        raw = self._redis.execute("GET", self._key("call", call_id))
+        return json.loads(raw) if raw else None
+
+    def _update(self, call_id, change):
+        """
+        Меняет звонок: change(call) правит его на месте или возвращает False (не менять).
+        Чтение и запись — под WATCH, и если звонок между ними изменил другой процесс
+        (ответ и завершение одновременно), EXEC отменяется и change повторяется на свежем
+        состоянии. Возвращает измененный звонок, None (звонка нет) или False.
+        """
+        key = self._key("call", call_id)
+        while True:
+            self._redis.execute("WATCH", key)
+            try:
+                raw = self._redis.execute("GET", key)
+                call = json.loads(raw) if raw else None
+                if call is None or change(call) is False:
+                    self._redis.execute("UNWATCH")
+                    return call and False
+                replies = self._redis.transaction(
+                    ("SET", key, json.dumps(call), "EX", self.KEY_TTL_SECONDS),
+                    ("ZADD", self._key("calls", "expiry"), call["expires_at"], call_id),
+                    ("SREM", self._key("incoming", call["callee_id"]), call_id))
+            except RespError:
+                self._redis.execute("UNWATCH")
+                raise
+            if replies is not None:
+                return call
+
+    def put_offer(self, call_id, call, ttl):
+        call = dict(call, expires_at=time.time() + ttl)
+        self._redis.transaction(
+            ("DEL", self._key("call", call_id, "ice", "caller"), self._key("call", call_id, "ice", "callee")),
+            ("SET", self._key("call", call_id), json.dumps(call), "EX", self.KEY_TTL_SECONDS),
+            ("ZADD", self._key("calls", "expiry"), call["expires_at"], call_id),
+            ("SADD", self._key("incoming", call["callee_id"]), call_id),
+            ("EXPIRE", self._key("incoming", call["callee_id"]), self.KEY_TTL_SECONDS))
+
+    def set_answer(self, call_id, answer, ttl):
+        def change(call):
+            if call["status"] == "ended":
+                return False
+            call.update(answer=answer, status="answered", expires_at=time.time() + ttl)
+
+        call = self._update(call_id, change)
+        if not call:
+            raise CallNotFoundError(call_id)
+        return call
+
+    def end_call(self, call_id, ttl):
+        def change(call):
+            if call["status"] == "ended":
+                return False
+            call.update(status="ended", expires_at=time.time() + ttl)
+
+        return self._update(call_id, change) or None
+
+    def append_ice(self, call_id, user_id, candidate):
+        call = self._load(call_id)
+        if call is None:
+            raise CallNotFoundError(call_id)
+        if user_id == call["caller_id"]:
+            side, peer_id = "caller", call["callee_id"]
+        elif user_id == call["callee_id"]:
+            side, peer_id = "callee", call["caller_id"]
+        else:
+            raise PermissionError(user_id)
+        key = self._key("call", call_id, "ice", side)
+        self._redis.transaction(("RPUSH", key, json.dumps(candidate)),
+                                ("EXPIRE", key, self.KEY_TTL_SECONDS))
+        return peer_id
+
+    def get_call(self, call_id):
+        raw, caller_ice, callee_ice = self._redis.transaction(
+            ("GET", self._key("call", call_id)),
+            ("LRANGE", self._key("call", call_id, "ice", "caller"), 0, -1),
+            ("LRANGE", self._key("call", call_id, "ice", "callee"), 0, -1))
+        if not raw:
+            raise CallNotFoundError(call_id)
+        return dict(json.loads(raw),
+                    caller_ice=[json.loads(c) for c in caller_ice],
+                    callee_ice=[json.loads(c) for c in callee_ice])
+
+    def incoming(self, user_id):
+        call_ids = self._redis.execute("SMEMBERS", self._key("incoming", user_id))
+        if not call_ids:
+            return []
+        raws = self._redis.transaction(*[("GET", self._key("call", call_id)) for call_id in call_ids])
+        calls = []
+        for call_id, raw in zip(call_ids, raws):
+            call = json.loads(raw) if raw else None
+            if call and call["status"] == "ringing":
+                calls.append({"call_id": call_id, "caller_id": call["caller_id"], "offer": call["offer"]})
+        return calls
+
+    def push_event(self, user_id, event, ttl):
+        seq_key, list_key = self._key("events", user_id, "seq"), self._key("events", user_id)
+        seq = self._redis.transaction(
+            ("INCR", seq_key),
+            ("RPUSH", list_key, json.dumps(event)),
+            ("LTRIM", list_key, -CALL_EVENTS_MAX, -1),
+            ("EXPIRE", seq_key, ttl),
+            ("EXPIRE", list_key, ttl))[0]
+        return dict(event, seq=seq)
+
+    def fetch_events(self, user_id, cursor):
+        last_seq, raws = self._redis.transaction(
+            ("GET", self._key("events", user_id, "seq")),
+            ("LRANGE", self._key("events", user_id), 0, -1))
+        last_seq = int(last_seq or 0)
+        first_seq = last_seq - len(raws) + 1
+        events = []
+        for offset, raw in enumerate(raws):
+            if first_seq + offset > cursor:
+                events.append(dict(json.loads(raw), seq=first_seq + offset))
+        return events, last_seq
+
+    def expire_call(self, call_id):
+        call = self._load(call_id)
+        if call is None:
+            self._redis.execute("ZREM", self._key("calls", "expiry"), call_id)
+            return None
+        if call["expires_at"] > time.time():
+            return None
+        if call["status"] != "ended":
+            return call
+        self._redis.transaction(
+            ("DEL", self._key("call", call_id), self._key("call", call_id, "ice", "caller"),
+             self._key("call", call_id, "ice", "callee")),
+            ("ZREM", self._key("calls", "expiry"), call_id),
+            ("SREM", self._key("incoming", call["callee_id"]), call_id))
+        return None
+
+    def expire_events(self, user_id):
+        # Очереди событий удаляет сам Redis (EXPIRE)
+        pass
+
+    def sweep(self):
+        return self._redis.execute("ZRANGEBYSCORE", self._key("calls", "expiry"), "-inf", time.time())
+
+def create_signaling_store(backend):
+    """Хранилище сигналинга по имени из VAULT_SIGNALING_BACKEND."""
+    if backend == "memory":
+        return MemorySignalingStore()
+    if backend == "sqlite":
+        return SQLiteSignalingStore(CALL_SIGNALING_DB)
+    if backend == "redis":
+        return RedisSignalingStore(CALL_REDIS_URL)
+    raise ValueError(f"Неизвестное хранилище сигналинга: {backend}")
+
+class CallSignalingHub:
+    """
+    Сигналинг звонков поверх хранилища: каждое действие кладет событие в очередь адресата,
+    публикует его в SSE-поток и будит long-poll этого пользователя в текущем процессе.
+    Долгие запросы в общем хранилище дополнительно перечитывают его каждые CALL_STORE_POLL_SECONDS,
+    чтобы увидеть события из других процессов.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._expiry = ExpiryScheduler(self._expire, "call-expiry")
+        if store.shared:
+            self._schedule(("sweep", ""), CALL_SWEEP_SECONDS)
+
+    def _schedule(self, key, ttl):
+        self._expiry.schedule(time.monotonic() + ttl, key)
+
+    def _emit(self, user_id, event):
+        event = self.store.push_event(user_id, event, CALL_EVENTS_TTL_SECONDS)
+        self._schedule(("user", user_id), CALL_EVENTS_TTL_SECONDS)
+        message_bus.publish(f"user:{user_id}", event)
+        with self._lock:
+            waiter = self._waiters.get(user_id)
+        if waiter is not None:
+            with waiter["cond"]:
+                waiter["cond"].notify_all()
+
+    def offer(self, caller_id, callee_id, offer):
+        call_id = f"{caller_id}_{callee_id}"
+        self.store.put_offer(call_id, {
+            "caller_id": caller_id,
+            "callee_id": callee_id,
+            "offer": offer,
+            "answer": None,
+            "status": "ringing",
+            "created_at": datetime.now().isoformat()
+        }, CALL_RING_TTL_SECONDS)
+        self._schedule(("call", call_id), CALL_RING_TTL_SECONDS)
+        self._emit(callee_id, {"type": "call_offer", "call_id": call_id,
+                               "caller_id": caller_id, "offer": offer})
+        return call_id
+
+    def answer(self, call_id, answer):
+        call = self.store.set_answer(call_id, answer, CALL_ACTIVE_TTL_SECONDS)
+        self._schedule(("call", call_id), CALL_ACTIVE_TTL_SECONDS)
+        self._emit(call["caller_id"], {"type": "call_answer", "call_id": call_id, "answer": answer})
+
+    def add_ice(self, call_id, user_id, candidate):
+        peer_id = self.store.append_ice(call_id, user_id, candidate)
+        self._emit(peer_id, {"type": "call_ice", "call_id": call_id, "candidate": candidate})
+
+    def end(self, call_id):
+        call = self.store.end_call(call_id, CALL_ENDED_TTL_SECONDS)
+        if call is None:
+            return
+        self._schedule(("call", call_id), CALL_ENDED_TTL_SECONDS)
+        for user_id in (call["caller_id"], call["callee_id"]):
+            self._emit(user_id, {"type": "call_ended", "call_id": call_id})
+
+    def get_call(self, call_id, user_id, ice_since=0):
+        """Снимок звонка для участника: ICE собеседника начиная с индекса ice_since."""
+        call = self.store.get_call(call_id)
+        data = {
+            "status": call["status"],
+            "caller_id": call["caller_id"],
+            "callee_id": call["callee_id"]
+        }
+        if user_id == call["caller_id"]:
+            if call["answer"]:
+                data["answer"] = call["answer"]
+            candidates = call["callee_ice"]
+        elif user_id == call["callee_id"]:
+            data["offer"] = call["offer"]
+            candidates = call["caller_ice"]
+        else:
+            raise PermissionError(user_id)
+        data["ice_candidates"] = candidates[ice_since:]
+        data["ice_cursor"] = len(candidates)
+        return data
+
+    def incoming(self, user_id):
+        return self.store.incoming(user_id)
+
+    def poll(self, user_id, cursor=None, timeout=0):
+        """
+        События пользователя с seq > cursor; ждет до timeout секунд, если их пока нет.
+        Без курсора возвращает текущие входящие звонки и курсор, с которого продолжать.
+        """
+        if cursor is None:
+            _, last_seq = self.store.fetch_events(user_id, sys.maxsize)
+            return [dict(call, type="call_offer", seq=last_seq)
+                    for call in self.store.incoming(user_id)], last_seq
+        events, last_seq = self.store.fetch_events(user_id, cursor)
+        # Курсор из будущего — очередь началась заново (перезапуск или истечение срока)
+        if cursor > last_seq:
+            cursor = 0
+            events, last_seq = self.store.fetch_events(user_id, cursor)
+        if events or timeout <= 0:
+            return events, last_seq
+
+        deadline = time.monotonic() + min(timeout, CALL_POLL_MAX_SECONDS)
+        with self._lock:
+            waiter = self._waiters.setdefault(user_id, {"cond": threading.Condition(), "count": 0})
+            waiter["count"] += 1
+        try:
+            with waiter["cond"]:
+                while True:
+                    # Проверка и ожидание под условием: _emit не успеет разбудить раньше времени
+                    events, last_seq = self.store.fetch_events(user_id, cursor)
+                    remaining = deadline - time.monotonic()
+                    if events or remaining <= 0:
+                        break
+                    waiter["cond"].wait(min(remaining, CALL_STORE_POLL_SECONDS)
+                                        if self.store.shared else remaining)
+        finally:
+            with self._lock:
+                waiter["count"] -= 1
+                if not waiter["count"]:
+                    del self._waiters[user_id]
+        return events, last_seq
+
+    def _expire(self, key):
+        kind, key_id = key
+        if kind == "sweep":
+            for call_id in self.store.sweep():
+                self._expire(("call", call_id))
+            self._schedule(key, CALL_SWEEP_SECONDS)
+        elif kind == "call":
+            # Никто не ответил или участники пропали — завершаем звонок
+            if self.store.expire_call(key_id):
+                self.end(key_id)
+        else:
+            with self._lock:
+                waiting = key_id in self._waiters
+            if waiting:
+                self._schedule(key, CALL_EVENTS_TTL_SECONDS)
+            else:
+                self.store.expire_events(key_id)
+
+call_hub = CallSignalingHub(create_signaling_store(CALL_SIGNALING_BACKEND))
+
+@app.route('/api/calls', methods=['POST'])
+def handle_calls():
+    """API для сигналинга WebRTC звонков."""
+    try:
+        data = request.json
+        action = data.get('action')
+        
+        if action == 'offer':
+            # Инициатор звонка отправляет offer
+            caller_id = data.get('caller_id')
+            callee_id = data.get('callee_id')
+            offer = data.get('offer')
+            
+            if not caller_id or not callee_id or not offer:
+                return jsonify({"status": "error", "message": "Неполные данные"}), 400
+            
+            call_id = call_hub.offer(caller_id, callee_id, offer)
+            return jsonify({"status": "success", "call_id": call_id})
+        
+        elif action == 'answer':
+            # Получатель звонка отправляет answer
+            call_id = data.get('call_id')
+            answer = data.get('answer')
+            
+            if not call_id or not answer:
+                return jsonify({"status": "error", "message": "Неполные данные"}), 400
+            
+            call_hub.answer(call_id, answer)
+            return jsonify({"status": "success"})
+        
+        elif action == 'ice_candidate':
+            # Отправка ICE candidate
+            call_id = data.get('call_id')
+            candidate = data.get('candidate')
+            user_id = data.get('user_id')
+            
+            if not call_id or not candidate or not user_id:
+                return jsonify({"status": "error", "message": "Неполные данные"}), 400
+            
+            call_hub.add_ice(call_id, user_id, candidate)
+            return jsonify({"status": "success"})
+        
+        elif action == 'get_call':
+            # Снимок звонка; ice_since — сколько ICE candidates клиент уже получил
+            call_id = data.get('call_id')
+            user_id = data.get('user_id')
+            
+            if not call_id or not user_id:
+                return jsonify({"status": "error", "message": "Неполные данные"}), 400
+            
+            call_data = call_hub.get_call(call_id, user_id, int(data.get('ice_since') or 0))
+            return jsonify({"status": "success", "call": call_data})
+        
+        elif action == 'end_call':
+            # Завершение звонка (данные удалит планировщик через CALL_ENDED_TTL_SECONDS)
+            call_id = data.get('call_id')
+            if call_id:
+                call_hub.end(call_id)
+            return jsonify({"status": "success"})
+        
+        elif action == 'check_incoming':
+            # Проверка входящих звонков (для старых клиентов; новые получают call_offer событием)
+            user_id = data.get('user_id')
+            
+            if not user_id:
+                return jsonify({"status": "error", "message": "Не указан пользователь"}), 400
+            
+            return jsonify({"status": "success", "calls": call_hub.incoming(user_id)})
+        
+        elif action == 'poll':
+            # Long-poll событий сигналинга: ждет новые события после cursor до timeout секунд
+            user_id = data.get('user_id')
+            
+            if not user_id:
+                return jsonify({"status": "error", "message": "Не указан пользователь"}), 400
+            
+            cursor = data.get('cursor')
+            events, cursor = call_hub.poll(user_id, None if cursor is None else int(cursor),
+                                           float(data.get('timeout') or 0))
+            # push = False: события из других процессов не придут в SSE-поток этого процесса,
+            # клиент должен продолжать long-poll
+            return jsonify({"status": "success", "events": events, "cursor": cursor,
+                            "push": not call_hub.store.shared})
+        
+        return jsonify({"status": "error", "message": "Неизвестное действие"}), 400
+    except CallNotFoundError:
+        return jsonify({"status": "error", "message": "Звонок не найден"}), 404
+    except PermissionError:
+        return jsonify({"status": "error", "message": "Неверный пользователь"}), 403
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Ошибка звонка: {e}"}), 500
+
+# Вызываем инициализацию базы данных при запуске приложения
+# (в конце модуля, когда уже объявлены все функции, которые используют миграции)
+init_db()
+schedule_missing_renditions()
+schedule_retention(delay=RETENTION_FIRST_RUN_DELAY_SECONDS)
+# Подхватываем задачи, оставшиеся в базе после перезапуска
+job_queue.start()
+
+if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
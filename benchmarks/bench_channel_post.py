@@ -0,0 +1,95 @@
+"""
+Бенчмарк поста в канал в зависимости от числа подписчиков.
+
+Для каналов разного размера замеряет среднее время поста через /api/room_broadcast
+(одна запись в channel_state) и, для сравнения, прежнюю рассылку — запись
+chat_partners и сводки chat_summaries для каждого подписчика. Также замеряет
+список чатов подписчика (room_members + channel_state).
+
+Запуск:  python benchmarks/bench_channel_post.py [--sizes 100,10000,200000] [--posts 50]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def legacy_fanout(cursor, room_id, message, members):
+    """Прежняя стоимость поста: строка chat_partners и сводка на каждого подписчика."""
+    chat_id = f"channel_{room_id}"
+    cursor.executemany("""
+        INSERT OR REPLACE INTO chat_partners (user_id, partner_id, chat_id) VALUES (?, ?, ?)
+    """, [(member_id, room_id, chat_id) for member_id in members])
+    app.update_chat_summaries(cursor, chat_id, message, [(member_id, room_id) for member_id in members])
+
+
+def create_channel(client, size):
+    room_id = client.post("/api/rooms", json={
+        "action": "create", "owner_id": "owner", "name": f"Канал {size}"
+    }).get_json()["room"]["id"]
+    with app.db_connection() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO room_members (room_id, user_id, role) VALUES (?, ?, 'member')",
+            ((room_id, f"sub{i}") for i in range(size)))
+        conn.commit()
+    return room_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,10000,200000")
+    parser.add_argument("--posts", type=int, default=50)
+    parser.add_argument("--legacy-posts", type=int, default=3)
+    args = parser.parse_args()
+    client = app.app.test_client()
+
+    print(f"posts={args.posts} legacy_posts={args.legacy_posts}\n")
+    print(f"{'подписчиков':>12} {'пост, мс':>10} {'рассылка, мс':>14} {'список чатов, мс':>18}")
+    for size in [int(value) for value in args.sizes.split(",")]:
+        room_id = create_channel(client, size)
+
+        started = time.perf_counter()
+        for i in range(args.posts):
+            reply = client.post("/api/room_broadcast", json={
+                "sender_id": "owner", "room_id": room_id, "text": f"пост {i}"
+            })
+            assert reply.status_code == 200, reply.get_json()
+        post_ms = (time.perf_counter() - started) * 1000 / args.posts
+
+        with app.db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM room_members WHERE room_id = ?", (room_id,))
+            members = [row["user_id"] for row in cursor.fetchall()]
+            started = time.perf_counter()
+            for i in range(args.legacy_posts):
+                message = app.store_message(cursor, f"channel_{room_id}", "owner", f"старый пост {i}")
+                legacy_fanout(cursor, room_id, message, members)
+                conn.commit()
+            legacy_ms = (time.perf_counter() - started) * 1000 / args.legacy_posts
+            # Чтобы список чатов ниже мерил только новую схему
+            cursor.execute("DELETE FROM chat_summaries WHERE chat_id LIKE 'channel_%'")
+            cursor.execute("DELETE FROM chat_partners WHERE chat_id LIKE 'channel_%'")
+            conn.commit()
+
+        started = time.perf_counter()
+        for _ in range(args.posts):
+            client.post("/api/messages", json={"action": "chats", "user_id": "sub7"})
+        chats_ms = (time.perf_counter() - started) * 1000 / args.posts
+
+        print(f"{size:>12} {post_ms:>10.3f} {legacy_ms:>14.3f} {chats_ms:>18.3f}")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Стресс-тест списания монет при параллельных покупках.
+
+Несколько потоков одновременно отправляют подарки от одного покупателя через
+/api/send_gift, пока у него не кончатся монеты. Проверяется, что баланс не ушел
+в минус, число успешных покупок равно balance // price, а сумма журнала
+coin_transactions сходится с балансом. Для сравнения та же нагрузка идет по
+прежней схеме (SELECT coins, проверка в Python, UPDATE coins = coins - ?) — только само
+списание, без остальной работы /api/send_gift, поэтому его скорость приведена
+для справки, а главное в этой строке — перерасход.
+
+Запуск:  python benchmarks/bench_coin_ledger.py [--threads 32] [--balance 5000] [--price 10]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def create_buyer(buyer_id, balance):
+    with app.db_connection() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO users (id, password, displayName, role, coins)
+            VALUES (?, 'x', ?, 'user', ?)
+        """, (buyer_id, buyer_id, balance))
+        conn.commit()
+
+
+def create_gift(price):
+    gift_id = f"bench_gift_{price}"
+    with app.db_connection() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO gifts (id, name, price, image_url, created_by, quantity, is_active)
+            VALUES (?, 'Бенчмарк', ?, '', 'admin', -1, TRUE)
+        """, (gift_id, price))
+        conn.commit()
+    app.invalidate_gift_catalog()
+    return gift_id
+
+
+def legacy_purchase(buyer_id, price):
+    """Прежняя схема: чтение баланса и списание — отдельные шаги."""
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT coins FROM users WHERE id = ?", (buyer_id,))
+        if (cursor.fetchone()[0] or 0) < price:
+            return False
+        time.sleep(0)  # отдаем GIL, как это сделал бы любой другой код между чтением и записью
+        cursor.execute("UPDATE users SET coins = coins - ? WHERE id = ?", (price, buyer_id))
+        conn.commit()
+        return True
+
+
+def ledger_purchase(client, buyer_id, gift_id):
+    reply = client.post("/api/send_gift", json={
+        "sender_id": buyer_id, "receiver_id": "bob", "gift_id": gift_id
+    })
+    assert reply.status_code in (200, 400), reply.get_json()
+    return reply.status_code == 200
+
+
+def run(threads, attempts, purchase):
+    counts = []
+    lock = threading.Lock()
+
+    def buyer():
+        bought = sum(purchase() for _ in range(attempts))
+        with lock:
+            counts.append(bought)
+
+    workers = [threading.Thread(target=buyer) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts), threads * attempts / (time.perf_counter() - started)
+
+
+def balance_of(buyer_id):
+    with app.db_connection() as conn:
+        return conn.execute("SELECT coins FROM users WHERE id = ?", (buyer_id,)).fetchone()[0]
+
+
+def ledger_of(buyer_id):
+    with app.db_connection() as conn:
+        return conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(amount), 0), MIN(balance_after)
+            FROM coin_transactions WHERE user_id = ?
+        """, (buyer_id,)).fetchone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--balance", type=int, default=5000)
+    parser.add_argument("--price", type=int, default=10)
+    args = parser.parse_args()
+    expected = args.balance // args.price
+    # Попыток с запасом: половина потоков не должна успеть купить
+    attempts = 2 * expected // args.threads + 1
+    gift_id = create_gift(args.price)
+
+    print(f"threads={args.threads} attempts/thread={attempts} balance={args.balance} "
+          f"price={args.price} ожидается покупок={expected}\n")
+    print(f"{'':<22} {'покупок':>8} {'баланс':>8} {'попыток/с':>10}")
+
+    create_buyer("legacy_buyer", args.balance)
+    bought, rate = run(args.threads, attempts, lambda: legacy_purchase("legacy_buyer", args.price))
+    print(f"{'SELECT + UPDATE':<22} {bought:>8} {balance_of('legacy_buyer'):>8} {rate:>10.0f}")
+
+    create_buyer("ledger_buyer", args.balance)
+    client = app.app.test_client()
+    bought, rate = run(args.threads, attempts, lambda: ledger_purchase(client, "ledger_buyer", gift_id))
+    balance = balance_of("ledger_buyer")
+    print(f"{'условный UPDATE':<22} {bought:>8} {balance:>8} {rate:>10.0f}")
+
+    entries, total, min_balance = ledger_of("ledger_buyer")
+    print(f"\nжурнал: записей={entries} сумма={total} минимальный баланс={min_balance}")
+    assert balance >= 0 and bought == expected, "перерасход монет"
+    assert entries == bought and args.balance + total == balance, "журнал не сходится с балансом"
+    print("перерасхода нет, журнал сходится с балансом")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Нагрузочный тест распродажи лимитированного подарка.
+
+10 000 покупателей (по умолчанию) одновременно отправляют один и тот же
+лимитированный подарок через /api/send_gift. Тест идет дважды: обычная запись
+(каждый запрос сам берет блокировку записи SQLite) и режим распродажи
+(очередь покупок одного писателя + отказ без базы после распродажи).
+Проверяется, что продано ровно столько, сколько было в наличии, и печатаются
+время распродажи, задержки и число отказов без обращения к базе.
+
+Запуск:  python benchmarks/bench_flash_sale.py [--buyers 10000] [--stock 100] [--concurrency 256]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def create_buyers(count):
+    with app.db_connection() as conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO users (id, password, displayName, role, coins)
+            VALUES (?, 'x', ?, 'user', 100)
+        """, ((f"buyer{i}", f"Покупатель {i}") for i in range(count)))
+        conn.commit()
+
+
+def create_gift(gift_id, stock):
+    with app.db_connection() as conn:
+        conn.execute("""
+            INSERT INTO gifts (id, name, price, image_url, created_by, quantity, is_active)
+            VALUES (?, 'Распродажа', 10, '', 'admin', ?, TRUE)
+        """, (gift_id, stock))
+        conn.commit()
+    app.invalidate_gift_catalog()
+
+
+def run(gift_id, buyers, concurrency):
+    local = threading.local()
+    results = []
+    lock = threading.Lock()
+
+    def buy(number):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        started = time.perf_counter()
+        reply = client.post("/api/send_gift", json={
+            "sender_id": f"buyer{number}", "receiver_id": "bob", "gift_id": gift_id
+        })
+        elapsed = (time.perf_counter() - started) * 1000
+        assert reply.status_code in (200, 400), reply.get_json()
+        with lock:
+            results.append((reply.status_code == 200, elapsed, time.perf_counter()))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(buy, range(buyers)))
+    total = time.perf_counter() - started
+    sold_at = max((at for ok, _, at in results if ok), default=started) - started
+    latencies = sorted(ms for _, ms, _ in results)
+    return {
+        "sold": sum(ok for ok, _, _ in results),
+        "sold_out_s": sold_at,
+        "total_s": total,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+    }
+
+
+def check(gift_id, stock, sold):
+    with app.db_connection() as conn:
+        left = conn.execute("SELECT quantity FROM gifts WHERE id = ?", (gift_id,)).fetchone()[0]
+        owned = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM user_inventory WHERE gift_id = ?",
+                             (gift_id,)).fetchone()[0]
+        debits = conn.execute("SELECT COUNT(*) FROM coin_transactions WHERE reason = 'gift_send' AND ref_id = ?",
+                              (gift_id,)).fetchone()[0]
+    assert sold == stock == owned == debits and left == 0, (
+        f"продано {sold}, в инвентаре {owned}, списаний {debits}, осталось {left} из {stock}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--buyers", type=int, default=10000)
+    parser.add_argument("--stock", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=256)
+    args = parser.parse_args()
+    create_buyers(args.buyers)
+
+    print(f"buyers={args.buyers} stock={args.stock} concurrency={args.concurrency}\n")
+    print(f"{'':<16} {'продано':>8} {'распродано, с':>14} {'всего, с':>9} "
+          f"{'p50, мс':>8} {'p99, мс':>8} {'отказов без базы':>17}")
+    for name, writer in (("обычная запись", None), ("распродажа", app.WriteBatcher(app.db_pool))):
+        gift_id = f"flash_{name.split()[0]}"
+        create_gift(gift_id, args.stock)
+        app.flash_sale_writer = writer
+        app.sold_out_gifts = app.SoldOutGifts()
+        result = run(gift_id, args.buyers, args.concurrency)
+        check(gift_id, args.stock, result["sold"])
+        print(f"{name:<16} {result['sold']:>8} {result['sold_out_s']:>14.2f} {result['total_s']:>9.2f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{app.sold_out_gifts.metrics()['fast_rejected']:>17}")
+    print("\nперепродаж нет: остаток 0, инвентарь и журнал монет совпадают с числом продаж")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Бенчмарк страниц маркета NFT на большом числе выставленных токенов.
+
+Заполняет nft_items синтетическими выставленными NFT (по умолчанию миллион,
+по нескольким базовым подаркам), затем для каждой сортировки замеряет первую
+страницу и страницу глубоко в выдаче (по next_cursor), с фильтром по подарку и
+без него, а также floor по подаркам с холодным и прогретым кэшем.
+
+Запуск:  python benchmarks/bench_nft_market.py [--items 1000000] [--gifts 20] [--depth 200]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def fill(n_items, n_gifts, rnd):
+    gift_ids = [f"bench_gift{i}" for i in range(n_gifts)]
+    with app.db_connection() as conn:
+        conn.executemany("""
+            INSERT INTO gifts (id, name, price, image_url, created_by, quantity, is_active, upgradeable)
+            VALUES (?, ?, 10, '', 'admin', -1, TRUE, TRUE)
+        """, ((gift_id, f"Подарок {i}") for i, gift_id in enumerate(gift_ids)))
+        conn.commit()
+        # Частями, чтобы не держать блокировку записи (ее ждет, например, очередь задач)
+        for start in range(0, n_items, 50000):
+            conn.executemany("""
+                INSERT INTO nft_items (token_id, base_gift_id, owner_id, creator_admin_id, original_sender_id,
+                                       serial_number, bg_variant, price, is_listed, created_at)
+                VALUES (?, ?, ?, 'admin', 'admin', ?, ?, ?, ?, ?)
+            """, ((f"nft_{i:08d}", gift_ids[i % n_gifts], f"user{i % 5000}", i // n_gifts + 1,
+                   rnd.randint(1, 5), rnd.randint(1, 100000), int(rnd.random() < 0.9),
+                   f"2026-01-01T00:{(i // 60) % 60:02d}:{i % 60:02d}.{i:08d}")
+                  for i in range(start, min(start + 50000, n_items))))
+            conn.commit()
+        conn.execute("ANALYZE")
+    return gift_ids
+
+
+def timed_page(client, params, depth):
+    """(мс первой страницы, мс страницы номер depth) — страницы проходятся по next_cursor."""
+    started = time.perf_counter()
+    data = client.get("/api/nft/market", query_string=params).get_json()
+    first_ms = (time.perf_counter() - started) * 1000
+    for _ in range(depth - 2):
+        data = client.get("/api/nft/market", query_string={**params, "cursor": data["next_cursor"]}).get_json()
+    started = time.perf_counter()
+    client.get("/api/nft/market", query_string={**params, "cursor": data["next_cursor"]}).get_json()
+    return first_ms, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=1000000)
+    parser.add_argument("--gifts", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=200)
+    args = parser.parse_args()
+    rnd = random.Random(42)
+
+    started = time.perf_counter()
+    gift_ids = fill(args.items, args.gifts, rnd)
+    print(f"items={args.items} gifts={args.gifts} depth={args.depth} "
+          f"(заполнение {time.perf_counter() - started:.1f} с)\n")
+    client = app.app.test_client()
+
+    print(f"{'сортировка':<12} {'фильтр':<22} {'стр. 1, мс':>11} {f'стр. {args.depth}, мс':>13}")
+    for sort in app.NFT_MARKET_SORTS:
+        for name, extra in (("все", {}), ("подарок", {"gift_id": gift_ids[0]}),
+                            ("подарок + цена", {"gift_id": gift_ids[0], "min_price": 20000, "max_price": 60000})):
+            first_ms, deep_ms = timed_page(client, {"sort": sort, **extra}, args.depth)
+            print(f"{sort:<12} {name:<22} {first_ms:>11.2f} {deep_ms:>13.2f}")
+
+    for label in ("холодный", "прогретый"):
+        started = time.perf_counter()
+        floors = client.get("/api/nft/market/floors").get_json()["floors"]
+        print(f"\nfloor по {len(floors)} подаркам, кэш {label}: {(time.perf_counter() - started) * 1000:.2f} мс", end="")
+    print()
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Бенчмарк статусов онлайн: last_seen в базе против PresenceService в памяти.
+
+Прежняя схема: каждый heartbeat — UPDATE users SET last_seen с коммитом, каждый
+запрос статуса — SELECT last_seen и разбор даты. Новая: heartbeat и статус
+обслуживаются из памяти, last_seen пишется в базу пакетом раз в интервал.
+Печатаются heartbeat-ы и статусы в секунду и число записей в базу.
+
+Запуск:  python benchmarks/bench_presence.py [--users 2000] [--rounds 5] [--watch 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def create_users(count):
+    with app.db_connection() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (id, password, displayName, role, coins) VALUES (?, 'x', ?, 'user', 0)",
+            ((f"p{i}", f"p{i}") for i in range(count)))
+        conn.commit()
+    return [f"p{i}" for i in range(count)]
+
+
+def legacy_heartbeat(user_id):
+    with app.db_connection() as conn:
+        conn.execute("UPDATE users SET last_seen = ? WHERE id = ?",
+                     (app.datetime.now().isoformat(timespec='seconds'), user_id))
+        conn.commit()
+
+
+def legacy_status(user_ids):
+    with app.db_connection() as conn:
+        return {user_id: app.presence_from_last_seen(
+                    conn.execute("SELECT last_seen FROM users WHERE id = ?", (user_id,)).fetchone()[0])
+                for user_id in user_ids}
+
+
+def measure(users, rounds, watch, heartbeat, status):
+    """Каждый пользователь шлет heartbeat и спрашивает статусы watch собеседников."""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for user_id in users:
+            heartbeat(user_id)
+    heartbeat_rate = rounds * len(users) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for number in range(len(users)):
+            status(users[number:number + watch])
+    status_rate = rounds * len(users) / (time.perf_counter() - started)
+    return heartbeat_rate, status_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--watch", type=int, default=20)
+    args = parser.parse_args()
+    users = create_users(args.users)
+
+    print(f"users={args.users} rounds={args.rounds} watch={args.watch}\n")
+    print(f"{'':<16} {'heartbeat/с':>12} {'запросов статуса/с':>20} {'записей в базу':>16}")
+    legacy = measure(users, args.rounds, args.watch, legacy_heartbeat, legacy_status)
+    print(f"{'last_seen в базе':<16} {legacy[0]:>12.0f} {legacy[1]:>20.0f} {args.rounds * args.users:>16}")
+
+    service = app.presence
+    current = measure(users, args.rounds, args.watch, service.heartbeat, service.bulk)
+    service.flush()
+    rows = service.metrics()["flushed_rows"]
+    print(f"{'PresenceService':<16} {current[0]:>12.0f} {current[1]:>20.0f} {rows:>16}")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
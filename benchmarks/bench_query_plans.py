@@ -0,0 +1,120 @@
+"""
+Бенчмарк горячих запросов до и после миграции с индексами.
+
+Создает временную базу со схемой без индексов, заполняет ее синтетическими
+данными, печатает EXPLAIN QUERY PLAN и среднее время каждого запроса,
+затем применяет миграции из app.py и повторяет замеры (SCAN -> SEARCH).
+
+Запуск:  python benchmarks/bench_query_plans.py [--messages 200000] [--nfts 50000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+QUERIES = [
+    ("history", """
+        SELECT uuid, seq, sender_id, text, timestamp, created_at, gift_id, is_read
+        FROM messages WHERE chat_id = :chat_id ORDER BY seq DESC LIMIT 51
+    """),
+    ("mark_read", """
+        UPDATE messages SET is_read = 1
+        WHERE chat_id = :chat_id AND sender_id = :user_id AND is_read = 0
+    """),
+    ("nft_serial", "SELECT COUNT(*) FROM nft_items WHERE base_gift_id = :gift_id"),
+    ("nft_owner", """
+        SELECT * FROM nft_items WHERE owner_id = :user_id ORDER BY created_at DESC
+    """),
+    ("nft_market", """
+        SELECT * FROM nft_items WHERE is_listed = 1 ORDER BY created_at DESC LIMIT 50
+    """),
+    ("room_members", "SELECT room_id FROM room_members WHERE user_id = :user_id"),
+]
+
+
+def populate(conn, n_messages, n_nfts, n_users=2000, n_chats=5000, n_gifts=50):
+    cursor = conn.cursor()
+    rnd = random.Random(42)
+    users = [f"user{i}" for i in range(n_users)]
+    cursor.executemany(
+        "INSERT INTO users (id, password, displayName) VALUES (?, 'pass', ?)",
+        [(u, u) for u in users])
+    chats = [f"chat{i}" for i in range(n_chats)]
+    cursor.executemany(
+        """INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, is_read, seq, created_at)
+           VALUES (?, ?, ?, 'text', '12:00', ?, ?, '2024-01-01T12:00:00')""",
+        ((f"m{i}", rnd.choice(chats), rnd.choice(users), rnd.randint(0, 1), i + 1)
+         for i in range(n_messages)))
+    cursor.executemany(
+        """INSERT INTO nft_items (token_id, base_gift_id, owner_id, creator_admin_id, original_sender_id,
+                                  serial_number, bg_variant, price, is_listed, created_at)
+           VALUES (?, ?, ?, 'admin', 'admin', ?, 1, 100, ?, ?)""",
+        ((f"nft{i}", f"gift{rnd.randrange(n_gifts)}", rnd.choice(users), i,
+          1 if rnd.random() < 0.05 else 0, f"2024-01-01T{i % 24:02d}:00:{i % 60:02d}")
+         for i in range(n_nfts)))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO room_members (room_id, user_id) VALUES (?, ?)",
+        ((f"room{rnd.randrange(500)}", rnd.choice(users)) for _ in range(n_users * 5)))
+    conn.commit()
+
+
+def measure(conn, params, repeat):
+    results = {}
+    for name, sql in QUERIES:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params).fetchall()
+            conn.rollback()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        results[name] = (" | ".join(row[3] for row in plan), elapsed_ms)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--nfts", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(os.path.join(TMP_DIR, "bench.db"))
+    app.create_base_tables(conn.cursor())
+    app._add_column(conn.cursor(), "messages", "is_read", "INTEGER DEFAULT 0")
+    conn.commit()
+    populate(conn, args.messages, args.nfts)
+    params = {"chat_id": "chat42", "user_id": "user7", "gift_id": "gift3"}
+
+    before = measure(conn, params, args.repeat)
+    app.apply_migrations(conn)
+    conn.execute("ANALYZE")
+    conn.commit()
+    after = measure(conn, params, args.repeat)
+
+    print(f"messages={args.messages} nft_items={args.nfts} repeat={args.repeat}\n")
+    for name, _ in QUERIES:
+        plan_before, ms_before = before[name]
+        plan_after, ms_after = after[name]
+        print(f"{name}")
+        print(f"  до:    {ms_before:9.3f} мс  {plan_before}")
+        print(f"  после: {ms_after:9.3f} мс  {plan_after}")
+        print(f"  ускорение: x{ms_before / max(ms_after, 1e-6):.1f}\n")
+    conn.close()
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Бенчмарк отметок прочтения при частом polling'е истории.
+
+Читатели опрашивают историю своих чатов (/api/messages action=history) с паузой
+--interval между запросами, а отправители в это время пишут им сообщения.
+Прежняя схема повторяется вызовом UPDATE messages SET is_read = 1 ... с коммитом
+после каждого запроса истории; новая только читает базу, а продвинувшиеся отметки
+пишет пачками (read_receipts). Печатаются запросы истории в секунду, задержки
+запроса истории и число транзакций записи ради отметок прочтения.
+
+Запуск:  python benchmarks/bench_read_receipts.py [--readers 16] [--senders 4] [--interval 0.02] [--seconds 5]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def legacy_mark_read(chat_id, partner_id):
+    """Прежняя отметка: запись и коммит на каждый запрос истории."""
+    with app.db_connection() as conn:
+        conn.execute("UPDATE messages SET is_read = 1 WHERE chat_id = ? AND sender_id = ? AND is_read = 0",
+                     (chat_id, partner_id))
+        conn.commit()
+
+
+def run(readers, senders, interval, seconds, legacy):
+    stop = time.monotonic() + seconds
+    latencies = []
+    sent = []
+    lock = threading.Lock()
+
+    def reader(number):
+        client = app.app.test_client()
+        user_id, partner_id = f"reader{number}", f"sender{number % senders}"
+        chat_id = app.get_chat_id(user_id, partner_id)
+        own = []
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            reply = client.post("/api/messages", json={"action": "history", "user_a": user_id, "user_b": partner_id})
+            assert reply.status_code == 200, reply.get_json()
+            if legacy:
+                legacy_mark_read(chat_id, partner_id)
+            own.append((time.perf_counter() - started) * 1000)
+            time.sleep(interval)
+        with lock:
+            latencies.extend(own)
+
+    def sender(number):
+        client = app.app.test_client()
+        i = 0
+        while time.monotonic() < stop:
+            reply = client.post("/api/messages", json={
+                "action": "send", "sender_id": f"sender{number}",
+                "receiver_id": f"reader{(number + i * senders) % readers}", "text": f"сообщение {i}"
+            })
+            assert reply.status_code == 200, reply.get_json()
+            i += 1
+        with lock:
+            sent.append(i)
+
+    workers = ([threading.Thread(target=reader, args=(number,)) for number in range(readers)]
+               + [threading.Thread(target=sender, args=(number,)) for number in range(senders)])
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    return (len(latencies) / seconds, latencies[len(latencies) // 2],
+            latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)], len(latencies), sum(sent))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--interval", type=float, default=0.02)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"readers={args.readers} senders={args.senders} interval={args.interval} seconds={args.seconds}\n")
+    print(f"{'':<20} {'история/с':>10} {'p50, мс':>9} {'p99, мс':>9} {'сообщений':>10} {'транзакций отметок':>19}")
+    rate, p50, p99, polls, sent = run(args.readers, args.senders, args.interval, args.seconds, legacy=True)
+    print(f"{'UPDATE на запрос':<20} {rate:>10.0f} {p50:>9.2f} {p99:>9.2f} {sent:>10} {polls:>19}")
+
+    rate, p50, p99, _, sent = run(args.readers, args.senders, args.interval, args.seconds, legacy=False)
+    app.read_receipts.flush()
+    metrics = app.read_receipts.metrics()
+    print(f"{'отметки пачками':<20} {rate:>10.0f} {p50:>9.2f} {p99:>9.2f} {sent:>10} {metrics['flushes']:>19}")
+    print(f"\nотметок записано: {metrics['flushed_rows']} (из {metrics['receipts']} продвижений)")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
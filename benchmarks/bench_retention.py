@@ -0,0 +1,104 @@
+"""
+Бенчмарк архивации сообщений (retention).
+
+Заполняет базу перепиской, большая часть которой старше срока архивации, и запускает
+обслуживание run_retention: перенос в архив, incremental vacuum. Печатаются размер
+живой базы до и после, объем файлов архива, время обслуживания и время запроса
+истории — последней страницы (из messages) и самой старой (из архива).
+
+Запуск:  python benchmarks/bench_retention.py [--chats 200] [--messages 1000] [--old-share 0.9]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее и архив во временный каталог
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+os.environ["VAULT_ARCHIVE_DIR"] = os.path.join(TMP_DIR, "archive")
+
+import app  # noqa: E402
+
+
+def fill(chats, messages, old_share):
+    """Переписка в chats личных чатах; старая часть — за год до срока архивации."""
+    old_count = int(messages * old_share)
+    start = datetime.now() - timedelta(days=app.MESSAGE_ARCHIVE_AFTER_DAYS + 365)
+    step = timedelta(days=365) / max(old_count, 1)
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        seq = cursor.execute("SELECT value FROM counters WHERE name = 'message_seq'").fetchone()[0]
+        for i in range(messages):
+            created = start + step * i if i < old_count else datetime.now()
+            rows = []
+            for chat in range(chats):
+                seq += 1
+                sender = f"u{chat}" if i % 2 else f"v{chat}"
+                rows.append((f"m{seq}", app.get_chat_id(f"u{chat}", f"v{chat}"), sender,
+                             f"Сообщение {i} в чате {chat}: договорились встретиться завтра в {i % 24}:00",
+                             created.strftime("%H:%M"), seq, created.isoformat(timespec='seconds')))
+            cursor.executemany("""
+                INSERT INTO messages (uuid, chat_id, sender_id, text, timestamp, is_read, seq, created_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+            """, rows)
+        cursor.execute("UPDATE counters SET value = ? WHERE name = 'message_seq'", (seq,))
+        cursor.executemany("""
+            INSERT OR IGNORE INTO chat_summaries (user_id, chat_id, partner_id) VALUES (?, ?, ?)
+        """, [(f"u{chat}", app.get_chat_id(f"u{chat}", f"v{chat}"), f"v{chat}") for chat in range(chats)])
+        conn.commit()
+
+
+def history_ms(client, **cursor):
+    started = time.perf_counter()
+    reply = client.post("/api/messages", json={"action": "history", "user_a": "u7", "user_b": "v7", **cursor})
+    assert reply.status_code == 200, reply.get_json()
+    return (time.perf_counter() - started) * 1000, reply.get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--old-share", type=float, default=0.9)
+    args = parser.parse_args()
+    fill(args.chats, args.messages, args.old_share)
+    # Режим incremental vacuum включает задача vacuum после миграций
+    app.run_vacuum_job(None, {})
+    client = app.app.test_client()
+
+    before = app.retention_storage_stats()
+    latest_before, _ = history_ms(client)
+    started = time.perf_counter()
+    result = app.run_retention()
+    elapsed = time.perf_counter() - started
+    after = app.retention_storage_stats()
+    latest_after, _ = history_ms(client)
+    with app.db_connection() as conn:
+        first_archived = conn.execute("SELECT MIN(first_seq) FROM message_archive WHERE chat_id = ?",
+                                      (app.get_chat_id("u7", "v7"),)).fetchone()[0]
+    # Страница самых старых сообщений: seq в чате идут с шагом chats
+    oldest_ms, page = history_ms(client, before_seq=first_archived + 50 * args.chats + 1)
+
+    mb = 1024 * 1024
+    print(f"chats={args.chats} messages/chat={args.messages} old_share={args.old_share}\n")
+    print(f"живых сообщений: {before['live_messages']} -> {after['live_messages']}")
+    print(f"файл базы: {before['db_bytes'] / mb:.1f} МБ -> {after['db_bytes'] / mb:.1f} МБ "
+          f"(свободно {after['free_bytes'] / mb:.1f} МБ, cache_size {after['cache_bytes'] / mb:.1f} МБ)")
+    archive_bytes = sum(after["archive_partitions"].values())
+    print(f"архив: {after['archived_messages']} сообщений, {after['archive_blocks']} блоков, "
+          f"{len(after['archive_partitions'])} файлов, {archive_bytes / mb:.1f} МБ")
+    print(f"обслуживание: {elapsed:.1f} с, возвращено страниц: {result['vacuumed_pages']}")
+    print(f"история, последняя страница: {latest_before:.2f} мс -> {latest_after:.2f} мс")
+    print(f"история, страница из архива: {oldest_ms:.2f} мс ({len(page['messages'])} сообщений)")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
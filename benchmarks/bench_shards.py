@@ -0,0 +1,99 @@
+"""
+Бенчмарк шардирования сообщений (VAULT_MESSAGE_SHARDS) на параллельной отправке.
+
+Потоки отправляют сообщения через /api/messages action=send, каждый в свой личный чат,
+так что чаты расходятся по шардам. Число шардов задается при импорте app.py, поэтому
+каждая раскладка меряется в отдельном процессе на новой временной базе. Печатаются
+пропускная способность, задержки и число сообщений в каждом шарде; --batching включает
+групповой коммит (VAULT_WRITE_BATCHING=1) для основной базы и шардов.
+
+Запуск:  python benchmarks/bench_shards.py [--shards 0,2,4,8] [--threads 16] [--messages 200] [--batching]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def run(threads, messages):
+    """Один замер в процессе-потомке: app.py импортируется с раскладкой из окружения."""
+    import app
+
+    latencies = []
+    lock = threading.Lock()
+
+    def sender(number):
+        client = app.app.test_client()
+        own = []
+        for i in range(messages):
+            started = time.perf_counter()
+            reply = client.post("/api/messages", json={
+                "action": "send", "sender_id": f"bench{number}", "receiver_id": f"peer{number}",
+                "text": f"сообщение {i}"
+            })
+            own.append((time.perf_counter() - started) * 1000)
+            assert reply.status_code == 200, reply.get_json()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=sender, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    per_shard = []
+    for shard in app.message_shards:
+        with shard.connection() as conn:
+            per_shard.append(conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0])
+    return {"rate": len(latencies) / elapsed, "p50": latencies[len(latencies) // 2],
+            "p99": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)], "per_shard": per_shard}
+
+
+def measure(shards, threads, messages, batching):
+    tmp_dir = tempfile.mkdtemp(prefix="vault_bench_")
+    env = dict(os.environ, VAULT_DB_PATH=os.path.join(tmp_dir, "app.db"),
+               VAULT_MESSAGE_SHARDS=str(shards), VAULT_WRITE_BATCHING="1" if batching else "0")
+    try:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--threads", str(threads),
+             "--messages", str(messages)],
+            env=env, check=True, capture_output=True, text=True).stdout
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", default="0,2,4,8", help="раскладки через запятую (0 — основная база)")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--batching", action="store_true", help="групповой коммит (VAULT_WRITE_BATCHING=1)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run(args.threads, args.messages)))
+        return
+
+    print(f"threads={args.threads} messages/thread={args.messages} batching={args.batching}\n")
+    print(f"{'шардов':<8} {'сообщ./с':>10} {'p50, мс':>9} {'p99, мс':>9}  сообщений по шардам")
+    for shards in (int(value) for value in args.shards.split(",")):
+        result = measure(shards, args.threads, args.messages, args.batching)
+        name = str(shards) if shards else "нет"
+        print(f"{name:<8} {result['rate']:>10.0f} {result['p50']:>9.2f} {result['p99']:>9.2f}  "
+              f"{' '.join(str(count) for count in result['per_shard'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Бенчмарк подсказок поиска (TypeaheadIndex) на синтетических пользователях.
+
+Загружает индекс без базы, затем замеряет время поиска по случайным префиксам
+без кэша (каждый префикс впервые) и с кэшем (повторные префиксы),
+а также время точечного обновления имени.
+
+Запуск:  python benchmarks/bench_typeahead.py [--users 1000000] [--queries 20000]
+"""
+import argparse
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+FIRST_NAMES = ["Алексей", "Мария", "Иван", "Ольга", "Дмитрий", "Анна", "Сергей", "Елена",
+               "Alex", "Maria", "John", "Kate", "Max", "Nina", "Paul", "Vera"]
+LAST_NAMES = ["Иванов", "Смирнова", "Кузнецов", "Попова", "Волков", "Орлова",
+              "Smith", "Brown", "Taylor", "Wilson", "Clark", "Young"]
+
+
+def random_word(rnd, length):
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def generate_rows(n_users, rnd):
+    for i in range(n_users):
+        name = f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}"
+        yield ("user", f"{random_word(rnd, 5)}{i}", name, "", "")
+
+
+def timed(fn, queries):
+    started = time.perf_counter()
+    for query in queries:
+        fn(query)
+    return (time.perf_counter() - started) * 1e6 / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=20000)
+    args = parser.parse_args()
+    rnd = random.Random(42)
+
+    index = app.TypeaheadIndex()
+    started = time.perf_counter()
+    index.load(generate_rows(args.users, rnd))
+    load_seconds = time.perf_counter() - started
+
+    # Префиксы длиной 1-4 символа: по ID (латиница) и по именам
+    names = [word.lower() for word in FIRST_NAMES + LAST_NAMES]
+    queries = []
+    for _ in range(args.queries):
+        source = rnd.choice(names) if rnd.random() < 0.5 else random_word(rnd, 4)
+        queries.append(source[:rnd.randint(1, 4)])
+
+    index._cache_size = 0
+    cold_us = timed(index.lookup, queries)
+    index._cache_size = app.TYPEAHEAD_CACHE_SIZE
+    index._cache.clear()
+    for query in set(queries[:app.TYPEAHEAD_CACHE_SIZE]):
+        index.lookup(query)
+    warm_queries = [rnd.choice(queries[:app.TYPEAHEAD_CACHE_SIZE]) for _ in range(args.queries)]
+    warm_us = timed(index.lookup, warm_queries)
+
+    renames = [(ref_id, f"{rnd.choice(FIRST_NAMES)} {random_word(rnd, 6)}")
+               for _, ref_id in rnd.sample(list(index._entries), 200)]
+    started = time.perf_counter()
+    for ref_id, name in renames:
+        index.put("user", ref_id, name)
+    put_us = (time.perf_counter() - started) * 1e6 / len(renames)
+
+    print(f"users={args.users} keys={len(index._keys)} queries={args.queries}\n")
+    print(f"загрузка индекса:     {load_seconds:9.2f} с")
+    print(f"поиск без кэша:       {cold_us:9.1f} мкс/запрос")
+    print(f"поиск с кэшем:        {warm_us:9.1f} мкс/запрос")
+    print(f"обновление имени:     {put_us:9.1f} мкс/запись")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Бенчмарк группового коммита (WriteBatcher) на параллельной отправке сообщений.
+
+Несколько потоков отправляют сообщения через /api/messages action=send: сначала
+каждый запрос коммитит сам (подключение из пула), затем через WriteBatcher.
+Обе схемы работают с одним режимом PRAGMA synchronous (по умолчанию FULL — fsync
+на каждый коммит), печатаются пропускная способность, задержки и метрики групп.
+
+Запуск:  python benchmarks/bench_write_batcher.py [--threads 16] [--messages 200] [--synchronous FULL]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py при импорте инициализирует базу — направляем ее во временный файл
+TMP_DIR = tempfile.mkdtemp(prefix="vault_bench_")
+os.environ["VAULT_DB_PATH"] = os.path.join(TMP_DIR, "app.db")
+
+import app  # noqa: E402
+
+
+def use_synchronous(mode):
+    """Подключения пула (и писателя, который создается через пул) с заданным synchronous."""
+    connect = app.db_pool._connect
+
+    def connect_with_mode():
+        conn = connect()
+        conn.execute(f"PRAGMA synchronous = {mode}")
+        return conn
+
+    app.db_pool._connect = connect_with_mode
+    app.db_pool._reset()
+    app.WRITE_BATCH_SYNCHRONOUS = mode
+
+
+def run(threads, messages):
+    latencies = []
+    lock = threading.Lock()
+
+    def sender(number):
+        client = app.app.test_client()
+        own = []
+        for i in range(messages):
+            started = time.perf_counter()
+            reply = client.post("/api/messages", json={
+                "action": "send", "sender_id": f"bench{number}", "receiver_id": "bob", "text": f"сообщение {i}"
+            })
+            own.append((time.perf_counter() - started) * 1000)
+            assert reply.status_code == 200, reply.get_json()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=sender, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return (len(latencies) / elapsed, latencies[len(latencies) // 2],
+            latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args()
+    use_synchronous(args.synchronous)
+
+    print(f"threads={args.threads} messages/thread={args.messages} synchronous={args.synchronous}\n")
+    app.write_batcher = None
+    direct = run(args.threads, args.messages)
+    app.write_batcher = app.WriteBatcher(app.db_pool)
+    batched = run(args.threads, args.messages)
+
+    print(f"{'':<12} {'сообщ./с':>10} {'p50, мс':>9} {'p99, мс':>9}")
+    for name, (rate, p50, p99) in (("без групп", direct), ("группами", batched)):
+        print(f"{name:<12} {rate:>10.0f} {p50:>9.2f} {p99:>9.2f}")
+    print("\nметрики группового коммита:")
+    for key, value in app.write_batcher.metrics().items():
+        print(f"  {key}: {value}")
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
   deps = [
     pkgs.python3
     pkgs.python3Packages.flask
+    pkgs.python3Packages.pillow
     pkgs.python3Packages.pip
   ];
 }
\ No newline at end of file
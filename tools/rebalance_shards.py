@@ -0,0 +1,262 @@
+"""
+Перекладка сообщений по шардам (VAULT_MESSAGE_SHARDS) при остановленном приложении.
+
+Чат живет в шарде jump_hash(chat_id, N) (см. app.py, раздел "ШАРДЫ СООБЩЕНИЙ"), при N = 0 —
+в основной базе. Инструмент копирует чаты, у которых при новом N другое место, переключает
+раскладку в основной базе (counters, message_shards) и только после этого удаляет
+перенесенное со старого места; лишние файлы шардов удаляются целиком. Если запуск
+прервался, повторный запуск с тем же --shards доделает работу: до переключения источником
+остается старая раскладка, после — уже новая.
+
+Запуск:  python tools/rebalance_shards.py --shards 8 [--db vault_messenger.db] [--dry-run] [--no-vacuum]
+Затем:   VAULT_MESSAGE_SHARDS=8 python app.py
+"""
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+# Строк сообщений на транзакцию при копировании
+BATCH_ROWS = 5000
+# Дата для сообщений, созданных до миграции 2 (у них нет created_at)
+MIGRATED_AT = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+# Раскладка должна совпадать с app.py: message_shard_path, chat_shard_key, jump_hash, message_schema
+def shard_path(db_path, index):
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.messages-{index}{ext or '.db'}"
+
+
+def chat_shard_key(chat_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", chat_id):
+        chat_id = hashlib.md5(chat_id.encode('utf-8')).hexdigest()
+    return int(chat_id[:16], 16)
+
+
+def jump_hash(key, buckets):
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def message_schema(conn):
+    return [row[0] for row in conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE sql IS NOT NULL
+          AND (name IN ('messages', 'messages_fts', 'counters')
+               OR (type IN ('index', 'trigger') AND tbl_name = 'messages'))
+        ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END, rowid
+    """)]
+
+
+def home(chat_id, layout):
+    """Место чата при раскладке layout: номер шарда или None (основная база)."""
+    return jump_hash(chat_shard_key(chat_id), layout) if layout else None
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def create_shard(path, schema):
+    conn = sqlite3.connect(path)
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone():
+        # Как в app.py: incremental vacuum включается до WAL и первой таблицы
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        for sql in schema:
+            conn.execute(sql)
+        conn.execute("INSERT INTO counters (name, value) VALUES ('message_seq', 0)")
+        conn.commit()
+    conn.close()
+    return connect(path)
+
+
+def chats_of(conn):
+    """{chat_id: число сообщений} в файле."""
+    return dict(conn.execute("SELECT chat_id, COUNT(*) FROM messages GROUP BY chat_id"))
+
+
+def label(key):
+    return "основная база" if key is None else f"шард {key}"
+
+
+def copy_chat(source, dest, chat_id, expected):
+    """Копирует сообщения чата, заменяя то, что осталось в dest от прерванного запуска."""
+    dest.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+    cursor = source.execute("SELECT * FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,))
+    columns = [column[0] for column in cursor.description]
+    insert = f"INSERT INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(BATCH_ROWS)
+        if not rows:
+            break
+        dest.executemany(insert, rows)
+        copied += len(rows)
+    if copied != expected:
+        raise RuntimeError(f"Чат {chat_id}: скопировано {copied} сообщений из {expected}")
+    # Как миграция 15 в app.py: без даты архивация не знает возраста сообщения
+    dest.execute("UPDATE messages SET created_at = ? WHERE chat_id = ? AND created_at IS NULL",
+                 (MIGRATED_AT, chat_id))
+    return copied
+
+
+def truncate_messages(conn):
+    """Удаляет все сообщения файла без построчных триггеров FTS."""
+    triggers = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'messages'").fetchall()
+    has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DELETE FROM messages")
+    if has_fts:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+    for _, sql in triggers:
+        conn.execute(sql)
+    conn.commit()
+
+
+def max_issued_seq(main, files, current):
+    """Наибольший seq, который уже мог быть выдан или на который ссылается основная база."""
+    values = [main.execute("SELECT COALESCE(MAX(value), 0) FROM counters WHERE name = 'message_seq'").fetchone()[0]]
+    for query in ("SELECT MAX(read_seq) FROM chat_reads", "SELECT MAX(last_seq) FROM chat_summaries",
+                  "SELECT MAX(last_seq) FROM channel_state", "SELECT MAX(last_seq) FROM message_archive"):
+        try:
+            values.append(main.execute(query).fetchone()[0] or 0)
+        except sqlite3.OperationalError:
+            pass  # таблицы нет в базе старой версии
+    for key, conn in files.items():
+        values.append(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages").fetchone()[0])
+        if key is not None:
+            number = conn.execute("SELECT value FROM counters WHERE name = 'message_seq'").fetchone()
+            if number:
+                values.append(number[0] * max(current, key + 1) + key)
+    return max(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", type=int, required=True, help="новое число шардов (0 — основная база)")
+    parser.add_argument("--db", default=os.environ.get('VAULT_DB_PATH', 'vault_messenger.db'))
+    parser.add_argument("--dry-run", action="store_true", help="только показать, сколько переедет")
+    parser.add_argument("--no-vacuum", action="store_true", help="не сжимать файлы после удаления")
+    args = parser.parse_args()
+    if args.shards < 0:
+        parser.error("--shards не может быть отрицательным")
+    if not os.path.exists(args.db):
+        parser.error(f"нет базы {args.db}")
+
+    main_conn = connect(args.db)
+    row = main_conn.execute("SELECT value FROM counters WHERE name = 'message_shards'").fetchone()
+    current, target = (row[0] if row else 0), args.shards
+    print(f"раскладка: {current or 'основная база'} -> {target or 'основная база'}")
+
+    # Файлы: основная база, шарды обеих раскладок и остатки прерванных запусков
+    leftovers = {int(match.group(1)) for path in glob.glob(shard_path(args.db, "*"))
+                 if (match := re.search(r"\.messages-(\d+)\.db$", path))}
+    schema = message_schema(main_conn)
+    files = {None: main_conn}
+    for index in sorted(set(range(current)) | set(range(target)) | leftovers):
+        path = shard_path(args.db, index)
+        if os.path.exists(path):
+            files[index] = connect(path)
+        elif index < current:
+            raise SystemExit(f"нет файла шарда {path} текущей раскладки")
+        elif not args.dry_run:
+            files[index] = create_shard(path, schema)
+
+    # 1. Копирование: источник — только место чата по текущей раскладке
+    started = time.perf_counter()
+    moves = {}
+    for key, conn in files.items():
+        for chat_id, count in chats_of(conn).items():
+            if home(chat_id, current) == key and home(chat_id, target) != key:
+                moves.setdefault((key, home(chat_id, target)), []).append((chat_id, count))
+    total_chats = sum(len(chats) for chats in moves.values())
+    total_messages = sum(count for chats in moves.values() for _, count in chats)
+    for (source, dest), chats in sorted(moves.items(), key=lambda item: (item[0][0] is not None, item[0])):
+        print(f"  {label(source)} -> {label(dest)}: чатов {len(chats)}, сообщений {sum(c for _, c in chats)}")
+    print(f"переезжает чатов: {total_chats}, сообщений: {total_messages}")
+    if args.dry_run:
+        return
+
+    copied = 0
+    for (source, dest), chats in moves.items():
+        pending = 0
+        for chat_id, count in chats:
+            pending += copy_chat(files[source], files[dest], chat_id, count)
+            if pending >= BATCH_ROWS:
+                files[dest].commit()
+                copied += pending
+                pending = 0
+                print(f"  скопировано {copied} из {total_messages}", end="\r")
+        files[dest].commit()
+        copied += pending
+    if moves:
+        print(f"скопировано {copied} сообщений за {time.perf_counter() - started:.1f} с")
+
+    # 2. Переключение: счетчики новых шардов продолжают номера, затем раскладка в основной базе
+    # (value + 1) * target + index > issued: новые seq больше всех выданных
+    issued = max_issued_seq(main_conn, files, current)
+    for index in range(target):
+        files[index].execute("""
+            INSERT INTO counters (name, value) VALUES ('message_seq', ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (issued // target,))
+        files[index].commit()
+    if not target:
+        main_conn.execute("""
+            INSERT INTO counters (name, value) VALUES ('message_seq', ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (issued,))
+    main_conn.execute("""
+        INSERT INTO counters (name, value) VALUES ('message_shards', ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+    """, (target,))
+    main_conn.commit()
+    print(f"раскладка переключена: {target or 'основная база'}, seq продолжается после {issued}")
+
+    # 3. Очистка: все, что лежит не на своем месте по новой раскладке
+    shrunk = []
+    for key, conn in list(files.items()):
+        if key is not None and key >= target:
+            conn.close()
+            del files[key]
+            for path in glob.glob(shard_path(args.db, key) + "*"):
+                os.remove(path)
+            print(f"  {label(key)}: файл удален")
+            continue
+        stray = [chat_id for chat_id in chats_of(conn) if home(chat_id, target) != key]
+        if not stray:
+            continue
+        if key is None:
+            truncate_messages(conn)
+        else:
+            conn.executemany("DELETE FROM messages WHERE chat_id = ?", [(chat_id,) for chat_id in stray])
+            conn.commit()
+        shrunk.append(key)
+        print(f"  {label(key)}: удалено чатов {len(stray)}")
+
+    if not args.no_vacuum:
+        for key in shrunk:
+            started = time.perf_counter()
+            files[key].execute("VACUUM")
+            print(f"  {label(key)}: VACUUM {time.perf_counter() - started:.1f} с")
+    for conn in files.values():
+        conn.close()
+    print("готово")
+
+
+if __name__ == "__main__":
+    main()
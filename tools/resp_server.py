@@ -0,0 +1,269 @@
+"""
+Локальный сервер с протоколом Redis (RESP) для разработки и проверки сигналинга звонков.
+
+Хранит данные в памяти и поддерживает только команды, которые использует
+RedisSignalingStore: PING, AUTH, SELECT, GET, SET [EX], DEL, EXPIRE, INCR,
+RPUSH, LRANGE, LTRIM, SADD, SREM, SMEMBERS, ZADD, ZREM, ZRANGEBYSCORE,
+MULTI/EXEC/DISCARD, FLUSHALL. Транзакции выполняются под общей блокировкой.
+
+Запуск:  python tools/resp_server.py [--host 127.0.0.1] [--port 6379]
+Затем:   VAULT_SIGNALING_BACKEND=redis VAULT_REDIS_URL=redis://127.0.0.1:6379/0 python app.py
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class CommandError(Exception):
+    pass
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _get(self, key, kind):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, kind):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _set(self, key, value):
+        self.data[key] = value
+        self.expires.pop(key, None)
+
+    def _drop_if_empty(self, key, value):
+        if not value:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    def execute(self, name, args):
+        handler = getattr(self, "cmd_" + name.lower(), None)
+        if handler is None:
+            raise CommandError(f"ERR unknown command '{name}'")
+        return handler(*args)
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_auth(self, *args):
+        return "OK"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    def cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, key, value, *options):
+        self._set(key, value)
+        if len(options) >= 2 and options[0].upper() == b"EX":
+            self.expires[key] = time.time() + int(options[1])
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_incr(self, key):
+        value = int(self._get(key, bytes) or 0) + 1
+        expires_at = self.expires.get(key)
+        self.data[key] = str(value).encode()
+        if expires_at is not None:
+            self.expires[key] = expires_at
+        return value
+
+    def cmd_rpush(self, key, *values):
+        items = self._get(key, list)
+        if items is None:
+            items = []
+            self._set(key, items)
+        items.extend(values)
+        return len(items)
+
+    @staticmethod
+    def _range(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1)
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._get(key, list) or []
+        start, stop = self._range(len(items), start, stop)
+        return items[start:stop + 1]
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key, list)
+        if items is not None:
+            start, stop = self._range(len(items), start, stop)
+            items[:] = items[start:stop + 1]
+            self._drop_if_empty(key, items)
+        return "OK"
+
+    def cmd_sadd(self, key, *members):
+        members_set = self._get(key, set)
+        if members_set is None:
+            members_set = set()
+            self._set(key, members_set)
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        return added
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key, set)
+        if members_set is None:
+            return 0
+        removed = len(members_set & set(members))
+        members_set.difference_update(members)
+        self._drop_if_empty(key, members_set)
+        return removed
+
+    def cmd_smembers(self, key):
+        return sorted(self._get(key, set) or ())
+
+    def cmd_zadd(self, key, *pairs):
+        scores = self._get(key, dict)
+        if scores is None:
+            scores = {}
+            self._set(key, scores)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in scores
+            scores[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        scores = self._get(key, dict)
+        if scores is None:
+            return 0
+        removed = sum(scores.pop(member, None) is not None for member in members)
+        self._drop_if_empty(key, scores)
+        return removed
+
+    def cmd_zrangebyscore(self, key, low, high):
+        scores = self._get(key, dict) or {}
+        low, high = float(low), float(high)
+        return [member for member, score in sorted(scores.items(), key=lambda item: (item[1], item[0]))
+                if low <= score <= high]
+
+
+def encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, CommandError):
+        return b"-" + str(value).encode() + b"\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+" + value.encode() + b"\r\n"
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # inline-команда (например, из telnet)
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def run(self, args):
+        store = self.server.store
+        try:
+            with store.lock:
+                return store.execute(args[0].decode(), args[1:])
+        except CommandError as e:
+            return e
+        except (TypeError, ValueError) as e:
+            return CommandError(f"ERR {e}")
+
+    def handle(self):
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            name = args[0].upper()
+            if name == b"MULTI":
+                queued = []
+                reply = "OK"
+            elif name == b"DISCARD":
+                queued = None
+                reply = "OK"
+            elif name == b"EXEC":
+                if queued is None:
+                    reply = CommandError("ERR EXEC without MULTI")
+                else:
+                    with self.server.store.lock:
+                        reply = [self.run(command) for command in queued]
+                    queued = None
+            elif queued is not None:
+                queued.append(args)
+                reply = "QUEUED"
+            else:
+                reply = self.run(args)
+            self.wfile.write(encode(reply))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        self.store = Store()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    with Server((args.host, args.port)) as server:
+        print(f"RESP-сервер слушает {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()